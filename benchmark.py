@@ -0,0 +1,245 @@
+# Benchmark of the recommenders: fit time, per query latency, batch throughput,
+# peak memory and quality, written as JSON so that runs can be compared over time
+#
+#   python benchmark.py --output bench.json
+#   python benchmark.py --synthetic 20000 5000 1000000 --models MostPop BiasBaseline UserKNN ALS
+
+# library
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+import numpy as np
+import pandas as pd
+import scipy
+
+# local library
+from recscratch.utils.processing import content_processing, rating_processing
+from recscratch.utils.evaluation import evaluate_recommendations, rating_metrics
+from recscratch.non_personalized import MeanRating, MostPop, BiasBaseline
+from recscratch.content_based import ContentBased
+from recscratch.memory_based import UserKNN, ItemKNN
+from recscratch.model_based import ALS
+
+MODELS = ["MeanRating", "MostPop", "BiasBaseline", "ContentBased", "UserKNN", "ItemKNN", "ALS"]
+
+
+# Support function
+# random train / test split of ratings.csv for the quality, the pairs of ratings_test.csv as the scoring workload
+## (ratings_test.csv holds every rating of its items: as a test set, all of its items would be cold)
+def load_movielens(link_folder, seed=None):
+    train, test = rating_processing(link_folder, "ratings.csv", "userId", "movieId", "rating", 0.8, seed)
+    workload = rating_processing(link_folder, "ratings_test.csv", "userId", "movieId", "rating")
+    movies = content_processing(link_folder, "movies_metadata_test.csv", ['title', 'overview'])
+    return train.reset_index(drop=True), test.reset_index(drop=True), workload, movies
+
+# ratings with a long tail of item popularity (zipf) and user activity, test_size of them held out
+def synthetic_ratings(n_users, n_items, n_ratings, test_size=0.2, seed=None):
+    rng = np.random.default_rng(seed)
+    item_weights = 1 / np.arange(1, n_items + 1) ** 0.8
+    user_weights = 1 / np.arange(1, n_users + 1) ** 0.5
+    ratings = pd.DataFrame({
+        "userid": rng.choice(n_users, n_ratings, p=user_weights / user_weights.sum()).astype(np.int32),
+        "itemid": rng.permutation(n_items)[rng.choice(n_items, n_ratings, p=item_weights / item_weights.sum())].astype(np.int32),
+        "rating": (rng.integers(1, 11, n_ratings) / 2).astype(np.float32),
+    }).drop_duplicates(subset=["userid", "itemid"], ignore_index=True)
+    is_test = rng.random(len(ratings)) < test_size
+    return ratings[~is_test].reset_index(drop=True), ratings[is_test].reset_index(drop=True)
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+# p50 / p99 latency in milliseconds of query(x) over the sample
+def latency(query, sample):
+    times = []
+    for x in sample:
+        _, elapsed = timed(query, x)
+        times.append(elapsed * 1000)
+    return {"p50_ms": float(np.percentile(times, 50)), "p99_ms": float(np.percentile(times, 99)),
+            "n_queries": len(times)} if times else {}
+
+# items per second of one call of batch(xs)
+def throughput(batch, xs):
+    _, elapsed = timed(batch, xs)
+    return {"batch_size": len(xs), "batch_s": elapsed, "per_s": len(xs) / elapsed if elapsed else None}
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+def quality(itemids, userids, test, n_items, topK):
+    return evaluate_recommendations(itemids, userids, test, K=topK, threshold=4, n_items=n_items)
+
+# RMSE / MAE on the pairs the model could predict (0 means no prediction) and the share of those pairs
+def prediction_quality(test, y_pred):
+    predicted = y_pred != 0
+    metrics = rating_metrics(test["rating"].to_numpy()[predicted], y_pred[predicted])
+    metrics["predicted"] = float(predicted.mean()) if len(predicted) else 0.0
+    return metrics
+
+
+# Benchmark of each model: fit time, latency, throughput, quality
+def bench_mean_rating(train, test, workload, movies, args, sample):
+    model = MeanRating()
+    _, fit_s = timed(model.avg_calculate, train)
+    predictions = model.get_recommendations(test)
+    return {"fit_s": fit_s,
+            "latency": latency(lambda u: model.get_recommendations(test[test["userid"] == u]), sample),
+            "throughput": throughput(model.get_recommendations, workload),
+            "quality": rating_metrics(predictions["rating"], predictions["AvgRating"])}
+
+def bench_most_pop(train, test, workload, movies, args, sample):
+    model = MostPop()
+    _, fit_s = timed(model.item_count, train)
+    userids = test["userid"].unique()
+    itemids, _ = model.recommend_batch(userids, args.topk)
+    return {"fit_s": fit_s,
+            "latency": latency(lambda u: model.recommend_batch([u], args.topk), sample),
+            "throughput": throughput(lambda xs: model.recommend_batch(xs, args.topk), userids),
+            "quality": quality(itemids, userids, test, len(model.ranked_itemids), args.topk)}
+
+def bench_bias_baseline(train, test, workload, movies, args, sample):
+    model = BiasBaseline()
+    _, fit_s = timed(model.fit, train)
+    userids = test["userid"].unique()
+    itemids, _ = model.recommend_batch(userids, args.topk)
+    metrics = quality(itemids, userids, test, model.matrix.n_items, args.topk)
+    metrics.update(prediction_quality(test, model.predict_batch(test)))
+    return {"fit_s": fit_s,
+            "latency": latency(lambda u: model.recommend_batch([u], args.topk), sample),
+            "throughput": throughput(lambda xs: model.recommend_batch(xs, args.topk), userids),
+            "predict_throughput": throughput(model.predict_batch, workload),
+            "quality": metrics}
+
+def bench_content_based(train, test, workload, movies, args, sample):
+    if movies is None:
+        return {"skipped": "no content file for synthetic ratings"}
+    model = ContentBased()
+
+    def fit():
+        tfidf = model.fit_tfidf(model.processing_on_list(movies['overview']))
+        return model.fit_similarity_all_data(tfidf, topK=args.knn), model.indexing_item(movies, 'title')
+
+    (cosine_sim, item2item_encoded), fit_s = timed(fit)
+    titles = movies['title'].drop_duplicates().to_numpy()
+    rng = np.random.default_rng(args.seed)
+    title_sample = rng.choice(titles, min(args.queries, len(titles)), replace=False)
+    return {"fit_s": fit_s,
+            "latency": latency(lambda t: model.get_recommendations(t, cosine_sim, item2item_encoded, args.topk), title_sample),
+            "throughput": throughput(lambda xs: model.get_recommendations_batch(xs, cosine_sim, item2item_encoded, args.topk), titles),
+            "quality": None}   # item to item similarity, no user ground truth
+
+def bench_user_knn(train, test, workload, movies, args, sample):
+    model = UserKNN(train)
+    _, fit_s = timed(model.fit, args.knn, args.sim)
+    userids = test["userid"].unique()
+    itemids, _ = model.recommend_batch(userids, args.knn, args.sim, args.topk)
+    metrics = quality(itemids, userids, test, model.matrix.n_items, args.topk)
+    metrics.update(prediction_quality(test, model.predict_batch(test, args.knn, args.sim)))
+    return {"fit_s": fit_s,
+            "latency": latency(lambda u: model.get_recommendations(u, args.knn, args.sim, args.topk), sample),
+            "throughput": throughput(lambda xs: model.recommend_batch(xs, args.knn, args.sim, args.topk), userids),
+            "predict_throughput": throughput(lambda pairs: model.predict_batch(pairs, args.knn, args.sim), workload),
+            "quality": metrics}
+
+def bench_item_knn(train, test, workload, movies, args, sample):
+    model = ItemKNN(train)
+    _, fit_s = timed(model.fit, args.knn, args.sim)
+    itemids = test["itemid"].unique()
+    # ItemKNN ranks users for an item: the ground truth is the test set seen from the items
+    userids, _ = model.recommend_batch(itemids, args.knn, args.sim, args.topk)
+    transposed = test.rename(columns={"userid": "itemid", "itemid": "userid"})
+    metrics = quality(userids, itemids, transposed, model.matrix.n_users, args.topk)
+    metrics.update(prediction_quality(test, model.predict_batch(test, args.knn, args.sim)))
+    item_sample = np.random.default_rng(args.seed).choice(itemids, min(args.queries, len(itemids)), replace=False)
+    return {"fit_s": fit_s,
+            "latency": latency(lambda i: model.get_recommendations(i, args.knn, args.sim, args.topk), item_sample),
+            "throughput": throughput(lambda xs: model.recommend_batch(xs, args.knn, args.sim, args.topk), itemids),
+            "predict_throughput": throughput(lambda pairs: model.predict_batch(pairs, args.knn, args.sim), workload),
+            "quality": metrics}
+
+def bench_als(train, test, workload, movies, args, sample):
+    model = ALS(train, factors=args.factors, seed=args.seed)
+    _, fit_s = timed(model.fit)
+    userids = test["userid"].unique()
+    itemids, _ = model.recommend_batch(userids, args.topk)
+    metrics = quality(itemids, userids, test, model.matrix.n_items, args.topk)
+    metrics.update(prediction_quality(test, model.predict_batch(test)))
+    return {"fit_s": fit_s,
+            "latency": latency(lambda u: model.recommend_batch([u], args.topk), sample),
+            "throughput": throughput(lambda xs: model.recommend_batch(xs, args.topk), userids),
+            "predict_throughput": throughput(model.predict_batch, workload),
+            "quality": metrics}
+
+BENCHMARKS = {
+    "MeanRating": bench_mean_rating, "MostPop": bench_most_pop, "BiasBaseline": bench_bias_baseline,
+    "ContentBased": bench_content_based, "UserKNN": bench_user_knn, "ItemKNN": bench_item_knn, "ALS": bench_als,
+}
+
+# one model, with the peak memory of the process it ran in
+def run_model(name, train, test, workload, movies, args):
+    userids = test["userid"].unique()
+    sample = np.random.default_rng(args.seed).choice(userids, min(args.queries, len(userids)), replace=False)
+    result = BENCHMARKS[name](train, test, workload, movies, args, sample)
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+def run(args):
+    if args.synthetic:
+        n_users, n_items, n_ratings = args.synthetic
+        (train, test), movies = synthetic_ratings(n_users, n_items, n_ratings, seed=args.seed), None
+        workload = test
+        dataset = {"name": "synthetic", "n_users": n_users, "n_items": n_items, "n_ratings": n_ratings}
+    else:
+        train, test, workload, movies = load_movielens(args.data, args.seed)
+        dataset = {"name": args.data}
+    dataset.update({"n_train": len(train), "n_test": len(test), "n_workload": len(workload)})
+
+    results = {}
+    for name in args.models:
+        if args.isolate:
+            # a fresh process per model: the peak RSS is the one of this model only
+            with multiprocessing.get_context("spawn").Pool(1) as pool:
+                results[name] = pool.apply(run_model, (name, train, test, workload, movies, args))
+        else:
+            results[name] = run_model(name, train, test, workload, movies, args)
+        print("{:<13} fit {:8.3f}s".format(name, results[name].get("fit_s", 0)), file=sys.stderr)
+
+    # Output: json-serializable dict
+    return {
+        "meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                 "platform": platform.platform(), "numpy": np.__version__, "pandas": pd.__version__,
+                 "scipy": scipy.__version__, "args": vars(args), "dataset": dataset},
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", type=str, default="data_example/Movielens/ml-latest-small", help="Movielens folder")
+    parser.add_argument("--synthetic", type=int, nargs=3, metavar=("N_USERS", "N_ITEMS", "N_RATINGS"),
+                        help="generated ratings instead of Movielens")
+    parser.add_argument("--models", nargs="+", default=MODELS, choices=MODELS)
+    parser.add_argument("--topk", type=int, default=10, help="length of the recommendation lists")
+    parser.add_argument("--knn", type=int, default=40, help="neighbors of the KNN models and content similarity")
+    parser.add_argument("--sim", type=str, default="cosine", choices=["cosine", "pearson"])
+    parser.add_argument("--factors", type=int, default=20, help="latent factors of ALS")
+    parser.add_argument("--queries", type=int, default=100, help="single queries of the latency")
+    parser.add_argument("--seed", type=int, default=22)
+    parser.add_argument("--no-isolate", dest="isolate", action="store_false",
+                        help="run every model in this process (the peak RSS is then cumulative)")
+    parser.add_argument("--output", type=str, default=None, help="json file, stdout by default")
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
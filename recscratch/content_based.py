@@ -3,24 +3,87 @@
 # library
 import pandas as pd
 import numpy as np
+from scipy import sparse
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import linear_kernel, cosine_similarity
-from tqdm import tqdm
+import os
 import re
-from nltk.tokenize import word_tokenize
+import weakref
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from nltk.corpus import stopwords
 # nltk.download('stopwords')
 # nltk.download('punkt')
 
 # local library
 from recscratch.utils.processing import content_processing 
+from recscratch.utils.ann import IVFIndex
+from recscratch.utils.cache import CachedModel
+from recscratch.utils.instrumentation import count, progress, timer
+from recscratch.utils.parallel import get_n_jobs
+from recscratch.utils.persistence import check_model, load_arrays, save_arrays, sparse_arrays, sparse_from_arrays
+from recscratch.utils.similarity import topk_dense, topk_per_row
+from recscratch.utils.tfidf import StreamingTfidf, append_rows
 
+# compiled preprocessing pipeline
+NON_WORD = re.compile(r'\W+')
+# the only splits word_tokenize still makes once non-word characters are gone: cannot -> can not, gonna -> gon na...
+CONTRACTIONS = re.compile(r'\b(can(?=not\b)|gim(?=me\b)|gon(?=na\b)|got(?=ta\b)|lem(?=me\b)|wan(?=na\s))')
+STOPWORDS = None
+
+# bytes of one entry of a sparse block product (value, index and the intermediates of the product)
+PRODUCT_ENTRY_BYTES = 32
+
+
+# Support function
+# english stopwords, read from the NLTK corpus once per process
+def get_stopwords():
+    global STOPWORDS
+    if STOPWORDS is None:
+        STOPWORDS = frozenset(stopwords.words("english"))
+    return STOPWORDS
+
+# lowercase, remove punctuation and special characters, remove stopwords, word tokenize
+def processing_text(data):
+    # Input: string
+    stopword_set = get_stopwords()
+    data = ' '.join([word for word in NON_WORD.sub(' ', data.lower()).split() if word not in stopword_set])
+    # Output: string, same as word_tokenize on the cleaned words
+    return CONTRACTIONS.sub(r'\1 ', data + ' ').strip()
+
+def processing_on_chunk(chunk):
+    return [processing_text(data) for data in chunk]
+
+# lists of chunk_size consecutive documents
+def iter_chunks(col, chunk_size):
+    chunk = []
+    for data in col:
+        chunk.append(data)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class ContentBased(CachedModel): 
+    def __init__(self):
+        # index -> title array of the last item2item_encoded
+        self.item2item_encoded = None
+        self.index2item = None
+        # fitted artifacts restored by load()
+        self.cosine_sim = None
+        self.tfidf_matrix = None
+        self.vectorizer = None
+        # weak references of the (cosine_sim, item2item_encoded) of the cached results
+        self.cache_inputs = None
 
-class ContentBased(): 
     # Support function
     # indexing the titles
     def indexing_item(self, col, title_col):
         item2item_encoded = pd.Series(col.index, index=col[title_col]).drop_duplicates()
+        self.get_index2item(item2item_encoded)
+        self.bump_version()
         return item2item_encoded
     def get_name_of_item(self, item2item_encoded, index, title_col):
         name_item = item2item_encoded.iloc[index][title_col]
@@ -29,27 +92,34 @@ class ContentBased():
     # language processing function
     def processing_on_1_sent(self, data):
         # Input: string
-        # lowercase
-        data = data.lower()
-        # remove punctuation and special characters
-        data = re.sub('\W+',' ', data)
-        # remove excess whitespace
-        data = data.strip()
-        # remove StopWord
-        data = ' '.join([word for word in data.split() if word not in stopwords.words("english")])
-        # word tokenize
-        data = word_tokenize(data)
-        data = ' '.join(data)
         # Output: string
-        return data
+        return processing_text(data)
     
 
     # preprocessing on list of natural language data
-    def processing_on_list(self, col):
-        list_processed = []
-        for i in tqdm(range(len(col))):
-            list_processed.append(self.processing_on_1_sent(col[i]))
-        return list_processed
+    ## n_jobs > 1 cleans chunks of chunk_size documents on a process pool (-1: all cores)
+    def processing_on_list(self, col, n_jobs=1, chunk_size=1000):
+        # Output: list of string, in the order of col
+        return list(self.processing_on_stream(col, n_jobs, chunk_size))
+
+    # preprocessing on any iterable of documents, yielded in order while the next chunks are processed
+    def processing_on_stream(self, col, n_jobs=1, chunk_size=1000):
+        n_jobs = get_n_jobs(n_jobs)
+        chunks = progress(iter_chunks(col, chunk_size), "text processing")
+        if n_jobs == 1:
+            for chunk in chunks:
+                yield from processing_on_chunk(chunk)
+            return
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(processing_on_chunk, chunk))
+                # at most 2 chunks per worker in flight: memory stays bounded on long streams
+                if len(pending) >= 2 * n_jobs:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
     
     # feature extraction with tf_idf
     def fit_tfidf(self, col):
@@ -58,11 +128,57 @@ class ContentBased():
 
         # Output: tfidf of content
         return tfidf_matrix
+
+    # feature extraction with tf_idf on a stream of document chunks
+    ## n_features=None: growing vocabulary, n_features=int: hashing trick
+    def fit_tfidf_stream(self, chunks, n_features=None):
+        # Input: iterable of lists of documents
+        vectorizer = StreamingTfidf(stop_words='english', n_features=n_features)
+        tfidf_matrix = vectorizer.fit_transform_stream(chunks)
+        # Output: fitted vectorizer (for new items), tfidf of content
+        return vectorizer, tfidf_matrix
+
+    # tf-idf rows of new items appended to the catalog, the catalog rows are not re-vectorized
+    ## tfidf_matrix: rows weighted by vectorizer as it is now (fit_tfidf_stream or the last add_items_tfidf)
+    ## reweight=True: the catalog rows move to the updated idf too, so old and new rows share one weighting
+    ## (equal to fit_tfidf_stream on all the documents), reweight=False keeps the catalog rows as they are
+    def add_items_tfidf(self, vectorizer, tfidf_matrix, col, reweight=True):
+        idf_before = vectorizer.idf()
+        vectorizer.partial_fit(col)
+        self.bump_version()
+        if reweight:
+            tfidf_matrix = vectorizer.reweight(tfidf_matrix, idf_before)
+        # Output: tfidf of content with the new rows at the end
+        return append_rows(tfidf_matrix, vectorizer.transform(col))
     
     # calculate similarity on all of data
-    def fit_similarity_all_data(self, overview_matrix): 
+    ## topK=None: dense N x N kernel, topK=int: sparse N x N kernel keeping the topK largest entries
+    ## of each row (the item itself excluded), computed block_size rows at a time
+    ## block_size=None: rows per block from memory_budget_mb. tf-idf rows share common terms, so a block
+    ## product is close to dense (block_size x N entries): the block stays under the budget even then
+    def fit_similarity_all_data(self, overview_matrix, topK=None, block_size=None, memory_budget_mb=256): 
         # Input: shape: (num_of_sentence, embedding_dim)
-        distance_similarity = linear_kernel(overview_matrix, overview_matrix)
+        self.bump_version()
+        if topK is None:
+            distance_similarity = linear_kernel(overview_matrix, overview_matrix)
+            return distance_similarity
+
+        overview_matrix = sparse.csr_matrix(overview_matrix)
+        overview_T = overview_matrix.T.tocsc()
+        n_items = overview_matrix.shape[0]
+        if block_size is None:
+            block_size = max(int(memory_budget_mb * 2 ** 20) // (PRODUCT_ENTRY_BYTES * max(n_items, 1)), 1)
+        rows, cols, values = [], [], []
+        for start in range(0, n_items, block_size):
+            block = overview_matrix[start:start + block_size] @ overview_T
+            neighbors, scores = topk_per_row(block, topK, exclude=np.arange(start, start + block.shape[0]))
+            position, slot = np.nonzero(neighbors >= 0)
+            rows.append(position + start)
+            cols.append(neighbors[position, slot])
+            values.append(scores[position, slot])
+        distance_similarity = sparse.csr_matrix(
+            (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape=(n_items, n_items))
+        # Output: scipy.sparse csr matrix with at most topK values per row
         return distance_similarity
 
     # calculate similarity on one vec of data
@@ -73,18 +189,138 @@ class ContentBased():
         # Output: shape (one_vec, list_vec)
         return sim_synthesis
 
-    # get recommendation for 1 item
-    def get_recommendations(self, title_name, cosine_sim, item2item_encoded, topK=10):
+    # approximate nearest neighbor index instead of the N x N similarity matrix
+    def fit_ann_index(self, overview_matrix, n_lists=None, n_probes=8, seed=None):
+        # Input: shape: (num_of_sentence, embedding_dim)
+        self.bump_version()
+        return IVFIndex(n_lists, n_probes, seed=seed).build(overview_matrix)
+
+    # index of a title, the first row when the title is duplicated
+    def get_item_index(self, item2item_encoded, title_name):
         item_index = item2item_encoded[title_name]
-        
-        sim_scores = list(enumerate(cosine_sim[item_index]))
-        sim_scores = sorted(sim_scores, key=lambda x: x[1], reverse=True)
-        sim_scores = sim_scores[1:topK]
+        if isinstance(item_index, pd.Series):
+            item_index = item_index.iloc[0]
+        return int(item_index)
+
+    # index -> title array, built once per item2item_encoded
+    def get_index2item(self, item2item_encoded):
+        if self.item2item_encoded is not item2item_encoded:
+            index2item = np.empty(int(item2item_encoded.max()) + 1, dtype=object)
+            # the first title of an index wins, as in a scan of item2item_encoded
+            first = ~pd.Index(item2item_encoded.values).duplicated()
+            index2item[item2item_encoded.values[first]] = item2item_encoded.index[first]
+            self.item2item_encoded, self.index2item = item2item_encoded, index2item
+        return self.index2item
+
+    # topK most similar item indexes of each item index, the item itself excluded
+    def top_similar(self, cosine_sim, item_indexes, topK):
+        item_indexes = np.asarray(item_indexes, dtype=np.int64)
+        if isinstance(cosine_sim, IVFIndex):
+            neighbors, _ = cosine_sim.query_items(item_indexes, topK)
+            return neighbors
+
+        if sparse.issparse(cosine_sim):
+            rows = sparse.csr_matrix(cosine_sim[item_indexes])
+            neighbors = np.full((len(item_indexes), topK), -1, dtype=np.int64)
+            for r, item_index in enumerate(item_indexes):
+                start, end = rows.indptr[r], rows.indptr[r + 1]
+                cols, values = rows.indices[start:end], rows.data[start:end]
+                keep = cols != item_index
+                cols, values = cols[keep], values[keep]
+                order = np.lexsort((cols, -values))[:topK]   # score descending, then index ascending
+                neighbors[r, :len(order)] = cols[order]
+            return neighbors
 
-        item_encoded = [i[0] for i in sim_scores]
-        item_names = [title for title, index in item2item_encoded.items() if index in item_encoded]
+        rows = np.array(cosine_sim[item_indexes], dtype=np.float64, ndmin=2)
+        rows[np.arange(len(item_indexes)), item_indexes] = -np.inf
+        # topk_dense breaks ties on the larger column: reversed columns keep the lower index first
+        n_items = rows.shape[1]
+        reversed_top = topk_dense(rows[:, ::-1], topK)
+        # Output: (n, topK) item indexes padded with -1
+        return np.where(reversed_top >= 0, n_items - 1 - reversed_top, -1)
+
+    # the cached results belong to one (cosine_sim, item2item_encoded) pair: another pair starts a new
+    # version, a collected one too (its id() can be reused by a new object)
+    def track_cache_inputs(self, cosine_sim, item2item_encoded):
+        inputs = self.cache_inputs
+        if inputs is None or inputs[0]() is not cosine_sim or inputs[1]() is not item2item_encoded:
+            self.bump_version()
+            self.cache_inputs = (weakref.ref(cosine_sim), weakref.ref(item2item_encoded))
+
+    # get recommendation for 1 item
+    ## cosine_sim: dense or sparse similarity matrix of fit_similarity_all_data or IVFIndex of fit_ann_index
+    ## the result cache (enable_cache) holds the results of the last (cosine_sim, item2item_encoded) pair:
+    ## call bump_version() after changing one of them in place
+    def get_recommendations(self, title_name, cosine_sim, item2item_encoded, topK=10):
+        compute = lambda: self.get_recommendations_batch([title_name], cosine_sim, item2item_encoded, topK)[0]
+        if self.cache is None:
+            return compute()
+        try:
+            self.track_cache_inputs(cosine_sim, item2item_encoded)
+        except TypeError:
+            # objects without weak references: not cached
+            return compute()
         # Output: list of item names
-        return item_names
+        return list(self.cached((title_name, topK), compute))
+
+    # get recommendation for many items in one pass
+    def get_recommendations_batch(self, title_names, cosine_sim, item2item_encoded, topK=10):
+        index2item = self.get_index2item(item2item_encoded)
+        item_indexes = [self.get_item_index(item2item_encoded, title_name) for title_name in title_names]
+        count("content.queries", len(item_indexes))
+        with timer("content.ranking"):
+            neighbors = self.top_similar(cosine_sim, item_indexes, topK)
+        # Output: list of list of item names, ranked by similarity
+        return [index2item[row[row >= 0]].tolist() for row in neighbors]
+
+    # write the titles, the similarity (dense, sparse or IVFIndex), the tf-idf matrix and the
+    # streaming vectorizer as .npy files plus a manifest, the IVFIndex in an ann_index sub folder
+    def save(self, path, item2item_encoded, cosine_sim=None, tfidf_matrix=None, vectorizer=None):
+        arrays = {"titles": item2item_encoded.index.to_numpy(), "title_indexes": item2item_encoded.to_numpy()}
+        meta = {"model": type(self).__name__, "cosine_sim": None, "tfidf_shape": None, "vectorizer": None}
+
+        if isinstance(cosine_sim, IVFIndex):
+            cosine_sim.save(os.path.join(path, "ann_index"))
+            meta["cosine_sim"] = "ann"
+        elif sparse.issparse(cosine_sim):
+            arrays.update(sparse_arrays("cosine_sim", cosine_sim))
+            meta["cosine_sim"] = {"sparse": list(cosine_sim.shape)}
+        elif cosine_sim is not None:
+            arrays["cosine_sim"] = np.asarray(cosine_sim)
+            meta["cosine_sim"] = "dense"
+
+        if tfidf_matrix is not None:
+            arrays.update(sparse_arrays("tfidf", tfidf_matrix))
+            meta["tfidf_shape"] = list(tfidf_matrix.shape)
+        if vectorizer is not None:
+            vectorizer_arrays, meta["vectorizer"] = vectorizer.get_state()
+            arrays.update({"vectorizer_" + name: array for name, array in vectorizer_arrays.items()})
+        return save_arrays(path, arrays, meta)
+
+    # model of a saved folder with item2item_encoded, cosine_sim, tfidf_matrix, vectorizer set (None when not saved)
+    ## mmap=True maps the arrays read-only: a dense similarity matrix is not read into memory
+    @classmethod
+    def load(cls, path, mmap=True):
+        arrays, meta = load_arrays(path, mmap)
+        check_model(meta, cls)
+        model = cls()
+        item2item_encoded = pd.Series(np.asarray(arrays["title_indexes"]), index=np.asarray(arrays["titles"], dtype=object))
+        model.get_index2item(item2item_encoded)
+
+        if meta["cosine_sim"] == "ann":
+            model.cosine_sim = IVFIndex.load(os.path.join(path, "ann_index"), mmap)
+        elif meta["cosine_sim"] == "dense":
+            model.cosine_sim = arrays["cosine_sim"]
+        elif meta["cosine_sim"] is not None:
+            model.cosine_sim = sparse_from_arrays(arrays, "cosine_sim", meta["cosine_sim"]["sparse"])
+
+        if meta["tfidf_shape"] is not None:
+            model.tfidf_matrix = sparse_from_arrays(arrays, "tfidf", meta["tfidf_shape"])
+        if meta["vectorizer"] is not None:
+            vectorizer_arrays = {name[len("vectorizer_"):]: array for name, array in arrays.items()
+                                 if name.startswith("vectorizer_")}
+            model.vectorizer = StreamingTfidf.from_state(vectorizer_arrays, meta["vectorizer"])
+        return model
 
 if __name__ == "__main__":
     
@@ -0,0 +1,177 @@
+# Hybrid of Content-based and Collaborative Filtering: the content rows and the rated items share one
+# item encoder (MovieLens movieId <-> tmdbId of the metadata through links.csv), users are scored on both
+# and the blend moves from content to collaborative as the history of a user grows
+
+# library
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# local library
+from recscratch.utils.processing import content_processing, rating_processing
+from recscratch.utils.instrumentation import count, progress, timer
+from recscratch.utils.similarity import topk_dense
+from recscratch.memory_based import ItemKNN
+
+
+# Support function
+# item id of every content row through the links table, -1 when the row has no link
+## args: links: dataframe of links.csv, content: content dataframe, content_col: id column of content,
+## link_col: same id in links, item_col: item id of the ratings in links
+def link_content(links, content, content_col='id', link_col='tmdbId', item_col='movieId'):
+    links = links.dropna(subset=[link_col]).drop_duplicates(subset=[link_col], keep='first')
+    link_ids = pd.Index(pd.to_numeric(links[link_col], errors='coerce'))
+    content_ids = pd.to_numeric(content[content_col], errors='coerce')   # metadata ids can be malformed
+    position = link_ids.get_indexer(content_ids)
+    itemids = links[item_col].to_numpy()[np.maximum(position, 0)]
+    # Output: np.ndarray (n_content_rows,) of item ids
+    return np.where(position >= 0, itemids, -1)
+
+# rows scaled to unit l2 norm, zero rows stay zero
+def normalize_rows(matrix):
+    matrix = sparse.csr_matrix(matrix, dtype=np.float64)
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms) @ matrix
+
+
+class Hybrid():
+    # collaborative: fitted ItemKNN (item-item products) or UserKNN (neighbor aggregation) of the ratings
+    # tfidf_matrix: tf-idf rows of the content, content_itemids: item id of every content row (link_content)
+    ## args: history_scale: ratings count where the collaborative weight reaches 0.5,
+    ## K_number, sim_name: neighborhood of the collaborative scores
+    def __init__(self, collaborative, tfidf_matrix, content_itemids, history_scale=20, K_number=40, sim_name='cosine'):
+        self.collaborative = collaborative
+        self.history_scale = history_scale
+        self.K_number = K_number
+        self.sim_name = sim_name
+
+        # shared item encoder: rated items and content items
+        content_itemids = np.asarray(content_itemids)
+        linked = np.flatnonzero(content_itemids != -1)
+        matrix = collaborative.matrix
+        self.item_encoder = pd.Index(matrix.itemids).union(pd.Index(pd.unique(content_itemids[linked])))
+        self.itemids = self.item_encoder.to_numpy()
+        self.rated_items = self.item_encoder.get_indexer(matrix.itemids)   # collaborative col -> item index
+
+        # content feature of every item, the first content row of an item wins, items without content are empty
+        rows = self.item_encoder.get_indexer(content_itemids[linked])
+        _, first = np.unique(rows, return_index=True)
+        placement = sparse.csr_matrix((np.ones(len(first)), (rows[first], linked[first])),
+                                      shape=(len(self.itemids), tfidf_matrix.shape[0]))
+        self.features = normalize_rows(placement @ sparse.csr_matrix(tfidf_matrix))
+        self.features_T = self.features.T.tocsr()
+
+        # user histories on the shared item index
+        self.user_items = sparse.csr_matrix(
+            (matrix.csr.data, self.rated_items[matrix.csr.indices], matrix.csr.indptr),
+            shape=(matrix.n_users, len(self.itemids)))
+        self.user_encoder = matrix.user_encoder
+        rating_min, rating_max = (matrix.csr.data.min(), matrix.csr.data.max()) if matrix.csr.nnz else (0, 1)
+        self.rating_range = (float(rating_min), float(max(rating_max - rating_min, 1e-12)))
+
+    # Support function
+    # weight of the collaborative scores for history lengths
+    def collaborative_weight(self, n_history):
+        return n_history / (n_history + self.history_scale)
+
+    # sparse histories (b, n_items) of userids, rows of history (userid, itemid, rating) when given
+    def user_rows(self, userids, history=None):
+        if history is None:
+            users = self.user_encoder.get_indexer(userids)
+            rows = self.user_items[np.maximum(users, 0)]
+            return rows.multiply((users >= 0)[:, None]).tocsr()   # unknown users have no history
+        users = pd.Index(userids).get_indexer(history["userid"])
+        items = self.item_encoder.get_indexer(history["itemid"])
+        keep = (users >= 0) & (items >= 0)
+        rows = sparse.csr_matrix((history["rating"].to_numpy(dtype=np.float64)[keep], (users[keep], items[keep])),
+                                 shape=(len(userids), len(self.itemids)))
+        rows.sum_duplicates()
+        return rows
+
+    # cosine of the rating-weighted tf-idf profile of each user with every item
+    def content_scores(self, rows):
+        with timer("hybrid.content"):
+            profiles = normalize_rows(rows @ self.features)
+            return (profiles @ self.features_T).toarray()
+
+    # collaborative predictions of known users scaled to [0, 1] on the shared item index, nan without prediction
+    def collaborative_scores(self, userids):
+        scores = np.full((len(userids), len(self.itemids)), np.nan)
+        users = self.collaborative.matrix.encode_users(userids)
+        known = np.flatnonzero(users >= 0)
+        if len(known) == 0:
+            return scores
+        with timer("hybrid.collaborative"):
+            if isinstance(self.collaborative, ItemKNN):
+                rating = self.collaborative.user_scores(users[known], self.K_number, self.sim_name)
+            else:
+                rating = self.collaborative.aggregate_block(users[known], self.K_number, self.sim_name)
+            scores[known[:, None], self.rated_items[None, :]] = (rating - self.rating_range[0]) / self.rating_range[1]
+        return scores
+
+    # blended scores of a block of users, nan for seen items and items without evidence
+    def score_block(self, userids, history=None):
+        rows = self.user_rows(userids, history)
+        weight = self.collaborative_weight(rows.getnnz(axis=1).astype(np.float64))[:, None]
+        content = self.content_scores(rows)
+        # collaborative pass only for the users whose blend uses it
+        collaborative = np.full(content.shape, np.nan)
+        uses_history = np.flatnonzero(weight[:, 0] > 0)
+        if len(uses_history):
+            collaborative[uses_history] = self.collaborative_scores(np.asarray(userids)[uses_history])
+        has_score = (content != 0) | ~np.isnan(collaborative)
+        score = (1 - weight) * content + weight * np.nan_to_num(collaborative)
+        score[~has_score] = np.nan
+        seen = rows.tocoo()
+        score[seen.row, seen.col] = np.nan
+        # Output: dense array (b, n_items)
+        return np.round(score, 12)
+
+    # topK items of many users, batch_size users per product
+    ## history: ratings of the queried users (e.g. users unknown to the ratings), default the fitted ratings
+    def recommend_batch(self, userids, topK=10, batch_size=256, history=None):
+        userids = np.asarray(userids)
+        itemids = np.empty((len(userids), topK), dtype=self.itemids.dtype)
+        itemids[:] = -1 if itemids.dtype.kind in 'iuf' else None
+        scores = np.full((len(userids), topK), np.nan)
+
+        count("hybrid.queries", len(userids))
+        for start in progress(range(0, len(userids), batch_size), "recommending"):
+            batch = userids[start:start + batch_size]
+            batch_history = None if history is None else history[history["userid"].isin(batch)]
+            score = self.score_block(batch, batch_history)
+            with timer("hybrid.ranking"):
+                top = topk_dense(score, topK)
+            found = top >= 0
+            batch_ids, batch_scores = itemids[start:start + batch_size], scores[start:start + batch_size]
+            batch_ids[found] = self.itemids[top[found]]
+            batch_scores[found] = np.take_along_axis(score, np.where(found, top, 0), axis=1)[found]
+
+        # Output: itemids (n_users, topK) padded with -1 (None for string ids), scores (n_users, topK) padded with nan
+        return itemids, scores
+
+    # get recommendation for 1 user
+    def get_recommendations(self, userid, topK=10, history=None):
+        itemids, scores = self.recommend_batch([userid], topK, history=history)
+        found = ~np.isnan(scores[0])
+        # output: [(score, itemid)]
+        return list(zip(scores[0][found].tolist(), itemids[0][found].tolist()))
+
+
+if __name__ == "__main__":
+    from recscratch.content_based import ContentBased
+
+    ## Movielens dataset ##
+    link_folder = "../data_example/Movielens/ml-latest-small"
+    X_train, X_test = rating_processing(link_folder, "ratings.csv", "userId", "movieId", "rating", 0.9, 22)
+    movies = content_processing(link_folder, "movies_metadata_test.csv", ['id', 'title', 'overview'])
+    links = pd.read_csv(link_folder + "/links.csv")
+
+    ## Test function ##
+    content_based = ContentBased()
+    tfidf_feature = content_based.fit_tfidf(content_based.processing_on_list(movies['overview']))
+    itemKNN = ItemKNN(X_train).fit(K_number=40, sim_name='cosine')
+    hybrid = Hybrid(itemKNN, tfidf_feature, link_content(links, movies))
+    print(hybrid.get_recommendations(1, topK=10))
+    print(hybrid.recommend_batch([1, 2, 3], topK=10))
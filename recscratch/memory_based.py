@@ -1,141 +1,516 @@
 # Memory-based is in the Collaborative Filtering method of Recommendation 
 
 # library
-from math import sqrt, isnan
-from numpy.linalg import norm
-from numpy import dot
-from tqdm import tqdm
+import numpy as np
+import pandas as pd
+from scipy import sparse
 
 # local library
-from recscratch.utils.processing import rating_processing 
-
-class UserKNN():
+from recscratch.utils.processing import rating_processing, split_pairs
+from recscratch.utils.cache import CachedModel
+from recscratch.utils.instrumentation import count, logger, progress, timer
+from recscratch.utils.parallel import get_n_jobs, map_shards
+from recscratch.utils.persistence import check_model, load_arrays, save_arrays
+from recscratch.utils.rating_matrix import RatingMatrix
+from recscratch.utils.similarity import CoratedSimilarity, indicator, neighbor_table, neighbor_table_out_of_core, topk_dense, topk_per_row
+
+# Support function
+# Pearson calculation on the co-rated entries of two sparse rows
+def pearson_on_rows(index1, value1, index2, value2):
+    _, pos1, pos2 = np.intersect1d(index1, index2, assume_unique=True, return_indices=True)
+    if len(pos1) == 0:
+        return 0
+
+    rating1 = value1[pos1] - value1[pos1].mean()  # centered on the co-rated mean of row1
+    rating2 = value2[pos2] - value2[pos2].mean()  # centered on the co-rated mean of row2
+
+    numerator = np.dot(rating1, rating2)
+    denominator = np.sqrt(np.dot(rating1, rating1)) * np.sqrt(np.dot(rating2, rating2))
+
+    # output: float
+    if denominator == 0:
+        return 0
+    return numerator / denominator
+
+# Cosine calculation on the co-rated entries of two sparse rows
+def cosine_on_rows(index1, value1, index2, value2):
+    _, pos1, pos2 = np.intersect1d(index1, index2, assume_unique=True, return_indices=True)
+    if len(pos1) == 0:
+        return 0
+
+    rating1 = value1[pos1]
+    rating2 = value2[pos2]
+    denominator = np.linalg.norm(rating1) * np.linalg.norm(rating2)
+
+    # output: float
+    if denominator == 0:
+        return 0
+    return np.dot(rating1, rating2) / denominator
+
+# sort (score, id) pairs descending on score, then on id (same order as sorting tuples)
+def rank_pairs(scores, ids):
+    order = np.lexsort((ids, scores))[::-1]
+    return list(zip(scores[order].tolist(), ids[order].tolist()))
+
+
+class BaseKNN(CachedModel):
+    # Neighborhood model on the rows of the sparse rating matrix:
+    # rows are users for UserKNN and items for ItemKNN, cols are the other side.
     # ratings: ratings dataframe
     def __init__(self, ratings):
         self.ratings = ratings
-    
+        self.set_matrix(RatingMatrix(ratings))
+
+    def set_matrix(self, matrix):
+        self.matrix = matrix
+        self.set_orientation()
+        # top-K neighbor table, filled by fit()
+        self.neighbors = None
+        self.neighbor_scores = None
+        self.fit_params = None
+        self.similarity = None
+        self.indicator = None
+        self.bump_version()
+
+    # fitted arrays and parameters, enough to score without the ratings dataframe
+    def get_state(self):
+        arrays = self.matrix.get_state()
+        if self.fit_params is not None:
+            arrays["neighbors"] = self.neighbors
+            arrays["neighbor_scores"] = self.neighbor_scores
+        meta = {"model": type(self).__name__, "fit_params": self.fit_params}
+        return arrays, meta
+
+    # model on the arrays of get_state, without the ratings dataframe
+    @classmethod
+    def from_state(cls, arrays, meta):
+        model = cls.__new__(cls)
+        model.ratings = None
+        model.set_matrix(RatingMatrix.from_state(arrays))
+        if meta.get("fit_params") is not None:
+            model.neighbors = arrays["neighbors"]
+            model.neighbor_scores = arrays["neighbor_scores"]
+            model.fit_params = tuple(meta["fit_params"])
+        return model
+
+    # write the rating matrix, encoders and neighbor table as .npy files plus a manifest
+    def save(self, path):
+        arrays, meta = self.get_state()
+        return save_arrays(path, arrays, meta)
+
+    # model of a saved folder, mmap=True maps the arrays read-only (shared between processes)
+    @classmethod
+    def load(cls, path, mmap=True):
+        arrays, meta = load_arrays(path, mmap)
+        check_model(meta, cls)
+        return cls.from_state(arrays, meta)
+
     # Support function
-    # get rating from the user-item pair
-    def get_rating(self, userid, itemid):
-        rating_data = self.ratings.loc[(self.ratings.userid == userid) & (self.ratings.itemid == itemid), 'rating']
-        if rating_data.empty:
-            return None  # Return None or handle the case when the rating data is not found
-        return (rating_data.iloc[0])
-    # get items of user's history
-    def get_itemids_his(self,userid):
-        return (self.ratings.loc[(self.ratings.userid==userid), 'itemid'].tolist())
+    # index of one row id, -1 when unknown
+    def row_index(self, row_id):
+        return int(self.encode_row([row_id])[0])
+    # (indexes, ratings) of one row
+    def get_row(self, row):
+        start, end = self.rows.indptr[row], self.rows.indptr[row + 1]
+        return self.rows.indices[start:end], self.rows.data[start:end]
+
+    # similarity of two row indexes
+    def row_similarity(self, row1, row2, similarity_name):
+        index1, value1 = self.get_row(row1)
+        index2, value2 = self.get_row(row2)
+        if similarity_name == 'pearson':
+            return pearson_on_rows(index1, value1, index2, value2)
+        if similarity_name == 'cosine':
+            return cosine_on_rows(index1, value1, index2, value2)
+        raise ValueError("similarity_name must be 'cosine' or 'pearson', got {!r}".format(similarity_name))
+
+    # precompute the top-K neighbor table of every row, block by block
+    ## args: K_number=40, sim_name=['cosine', 'pearson'], block_size=256 rows per block
+    def fit(self, K_number=40, sim_name='cosine', block_size=256):
+        logger.info("neighbor table is being calculated by %s (K=%d)", sim_name, K_number)
+        with timer("knn.fit"):
+            self.neighbors, self.neighbor_scores = neighbor_table(self.rows, K_number, sim_name, block_size, self.get_similarity())
+        self.fit_params = (K_number, sim_name)
+        self.bump_version()
+        return self
+
+    # fit on the rows read block by block under a memory budget, the neighbor table is written to folder
+    # and memory-mapped: peak memory does not grow with the number of ratings
+    ## args: folder of the table, K_number=40, sim_name=['cosine', 'pearson'], memory_budget_mb of the blocks
+    def fit_out_of_core(self, folder, K_number=40, sim_name='cosine', memory_budget_mb=1024):
+        logger.info("neighbor table is being calculated out of core by %s (K=%d, %g MB)", sim_name, K_number, memory_budget_mb)
+        with timer("knn.fit"):
+            self.neighbors, self.neighbor_scores = neighbor_table_out_of_core(
+                self.rows, K_number, sim_name, folder, int(memory_budget_mb * 2 ** 20))
+        self.fit_params = (K_number, sim_name)
+        self.bump_version()
+        return self
+
+    # model on a rating matrix written by write_rating_matrix (or a saved model), memory-mapped
+    @classmethod
+    def load_matrix(cls, path):
+        arrays, _ = load_arrays(path, mmap=True)
+        return cls.from_state(arrays, {})
+
+    # vectorized co-rated similarity of the rows, built on first use
+    def get_similarity(self):
+        if self.similarity is None:
+            self.similarity = CoratedSimilarity(self.rows)
+        return self.similarity
+
+    # Online updates: new / removed ratings patch the matrix and the neighbor table without a full refit
+    # add ratings (dataframe with userid, itemid, rating), a pair already rated gets the new rating
+    def add_ratings(self, ratings, block_size=256):
+        return self.update_ratings(add=ratings, block_size=block_size)
+
+    # remove the (userid, itemid) pairs of a dataframe, unknown pairs are ignored
+    def remove_ratings(self, ratings, block_size=256):
+        return self.update_ratings(remove=ratings, block_size=block_size)
+
+    def update_ratings(self, add=None, remove=None, block_size=256):
+        old_row_ids = self.row_ids
+        neighbors, neighbor_scores, fit_params = self.neighbors, self.neighbor_scores, self.fit_params
+        matrix, _, _ = self.matrix.updated(add, remove)
+        self.set_matrix(matrix)
+        # the ratings dataframe is not kept in sync: the matrix holds the ratings from now on
+        self.ratings = None
+        if fit_params is None:
+            return self
+
+        changed = [frame for frame in (add, remove) if frame is not None]
+        dirty_rows = self.encode_row(pd.concat([frame[self.row_column] for frame in changed]))
+        changed_cols = self.encode_col(pd.concat([frame[self.col_column] for frame in changed]))
+        known = (dirty_rows >= 0) & (changed_cols >= 0)
+        self.fit_params = fit_params
+        logger.info("neighbor table is being updated on %d ratings", np.count_nonzero(known))
+        with timer("knn.update"):
+            self.neighbors, self.neighbor_scores = self.patch_neighbors(
+                neighbors, neighbor_scores, self.encode_row(old_row_ids),
+                np.unique(dirty_rows[known]), np.unique(changed_cols[known]), block_size)
+        self.bump_version()
+        return self
+
+    # neighbor table of the updated rows: the dirty rows (whose ratings changed) are recomputed, and so are
+    # the rows whose top-K can move, i.e. that co-rate a changed col with a dirty row and either hold a dirty
+    # row in their list or see a dirty row rank above their K-th neighbor
+    def patch_neighbors(self, neighbors, neighbor_scores, row_map, dirty, changed_cols, block_size=256):
+        # Input: neighbor table on the old row indexes, old row index -> new row index
+        K, sim_name = self.fit_params
+        n_rows = self.rows.shape[0]
+        similarity = self.get_similarity()
+
+        table = np.full((n_rows, K), -1, dtype=np.int32)
+        table[row_map] = np.where(neighbors >= 0, row_map[np.maximum(neighbors, 0)], -1)
+        table_scores = np.zeros((n_rows, K), dtype=np.float64)
+        table_scores[row_map] = neighbor_scores
+        if K == 0:
+            return table, table_scores
+        last, last_score = table[:, K - 1], table_scores[:, K - 1]
+
+        # only the rows rating a changed col can see their similarity with a dirty row move
+        is_dirty = np.zeros(n_rows + 1, dtype=bool)   # the extra False entry is read by the -1 padding
+        is_dirty[dirty] = True
+        affected = np.unique(similarity.values_T[changed_cols].indices)
+        affected = affected[~is_dirty[affected]]
+        # a list that is not full, or that holds negative scores, depends on the count of zero scores
+        recompute = is_dirty[table[affected]].any(axis=1) | (last[affected] < 0) | (last_score[affected] < 0)
+        if n_rows > len(row_map):
+            negative = np.flatnonzero((table_scores < 0).any(axis=1))
+            redo = negative[~is_dirty[negative]]
+        else:
+            redo = np.empty(0, dtype=np.int64)
+
+        for start in range(0, len(dirty), block_size):
+            block = dirty[start:start + block_size]
+            scores = similarity.block(self.rows[block], sim_name)
+            # a full list with a positive K-th score only changes when a dirty row ranks above it
+            new_scores = scores[:, affected].toarray()
+            above = (new_scores > last_score[affected]) | \
+                    ((new_scores == last_score[affected]) & (block[:, None] > last[affected]))
+            recompute |= above.any(axis=0)
+            table[block], table_scores[block] = topk_per_row(scores, K, exclude=block)
+
+        redo = np.union1d(redo, affected[recompute])
+        for start in range(0, len(redo), block_size):
+            block = redo[start:start + block_size]
+            scores = similarity.block(self.rows[block], sim_name)
+            table[block], table_scores[block] = topk_per_row(scores, K, exclude=block)
+
+        logger.debug("%d dirty rows, %d neighbor lists recomputed", len(dirty), len(redo))
+        # Output: (n_rows, K) row indexes padded with -1, (n_rows, K) scores padded with 0
+        return table, table_scores
+
+    # K nearest row indexes of one row index, from the neighbor table when it covers the query
+    def nearest_rows(self, row, K_number, similarity_name):
+        if self.fit_params is not None and self.fit_params[1] == similarity_name and K_number <= self.fit_params[0]:
+            neighbors = self.neighbors[row, :K_number]
+            scores = self.neighbor_scores[row, :K_number]
+        else:
+            logger.debug("similarity is being calculated by %s", similarity_name)
+            with timer("knn.neighbor_search"):
+                scores = self.get_similarity().block(self.rows[row], similarity_name)
+                neighbors, scores = topk_per_row(scores, K_number, exclude=[row])
+                neighbors, scores = neighbors[0], scores[0]
+        keep = neighbors >= 0
+        # output: row indexes, scores (descending)
+        return neighbors[keep], scores[keep]
+
+    # get K row nearest
+    def most_similar_rows(self, row_id, K_number, similarity_name):
+        row = self.row_index(row_id)
+        if row < 0:
+            return []
+        neighbors, scores = self.nearest_rows(row, K_number, similarity_name)
+
+        # output: [(score, id)]
+        return list(zip(scores.tolist(), self.row_ids[neighbors].tolist()))
+
+    # Aggregate weighted ratings of the nearest rows on the cols not in the row's history
+    def recommend_cols(self, row_id, K_number, sim_name, topK = None):
+        row = self.row_index(row_id)
+        if row < 0:
+            return []
+        neighbors, scores = self.nearest_rows(row, K_number, sim_name)
+        if len(neighbors) == 0:
+            return []
+
+        count("knn.queries")
+        with timer("knn.aggregation"):
+            # history of the nearest rows, each entry weighted by the similarity of its row
+            starts, ends = self.rows.indptr[neighbors], self.rows.indptr[neighbors + 1]
+            positions = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+            cols = self.rows.indices[positions]
+            weights = np.repeat(scores, ends - starts)
+            values = self.rows.data[positions] * weights
+
+            # col of other row's history only
+            seen, _ = self.get_row(row)
+            keep = ~np.isin(cols, seen)
+            cols, values, weights = cols[keep], values[keep], weights[keep]
+
+            n_cols = self.rows.shape[1]
+            total = np.bincount(cols, weights=values, minlength=n_cols)
+            sum_similarity = np.bincount(cols, weights=weights, minlength=n_cols)
 
-    # Pearson calculation
-    def pearson_correlation_score(self, userid1, userid2):
-        both_item_count = []
-        list_item_user1 = self.ratings.loc[self.ratings.userid == userid1, 'itemid'].to_list()
-        list_item_user2 = self.ratings.loc[self.ratings.userid == userid2, 'itemid'].to_list()
+            # calculate rating according to Aggregate weighted ratings
+            candidates = np.unique(cols)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rating = total[candidates] / sum_similarity[candidates]
+            keep = np.isfinite(rating)
+            # round-off is cut so equal ratings tie on the id order whatever the summation order
+            rating = np.round(rating, 12)
 
-        for element in list_item_user1:
-            if element in list_item_user2:
-                both_item_count.append(element)
+        with timer("knn.ranking"):
+            list_ranking = rank_pairs(rating[keep], self.col_ids[candidates[keep]])
 
-        if (len(both_item_count) == 0):
-            return 0
+        # output: [(ratings, id)]
+        if topK != None:
+            return list_ranking[:topK]
+        return list_ranking
 
-        rating_sum_1 = sum([self.get_rating(userid1, i) for i in both_item_count])
-        avg_rating_sum_1 = rating_sum_1 / len(both_item_count)  # mean rating of user1
-        rating_sum_2 = sum([self.get_rating(userid2, i) for i in both_item_count])
-        avg_rating_sum_2 = rating_sum_2 / len(both_item_count)  # mean rating of user2
+    # sparse (len(rows), n_rows) matrix of the K nearest neighbor similarities of row indexes
+    def neighbor_weights(self, rows, K_number, similarity_name):
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.fit_params is not None and self.fit_params[1] == similarity_name and K_number <= self.fit_params[0]:
+            neighbors = self.neighbors[rows, :K_number]
+            scores = self.neighbor_scores[rows, :K_number]
+        else:
+            with timer("knn.neighbor_search"):
+                similarity = self.get_similarity().block(self.rows[rows], similarity_name)
+                neighbors, scores = topk_per_row(similarity, K_number, exclude=rows)
+        position, slot = np.nonzero(neighbors >= 0)
+        return sparse.csr_matrix((scores[position, slot], (position, neighbors[position, slot])),
+                                 shape=(len(rows), self.rows.shape[0]))
+
+    # Aggregate weighted ratings of a block of row indexes on all cols, one sparse product each
+    def aggregate_block(self, rows, K_number, sim_name):
+        weights = self.neighbor_weights(rows, K_number, sim_name)
+        with timer("knn.aggregation"):
+            total = (weights @ self.rows).toarray()
+            sum_similarity = (weights @ self.get_indicator()).toarray()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rating = total / sum_similarity
+            # col of other row's history only
+            rating[self.get_indicator()[rows].toarray() > 0] = np.nan
+            rating[~np.isfinite(rating)] = np.nan
+            rating = np.round(rating, 12)
+        # Output: dense array (len(rows), n_cols), nan when there is no prediction
+        return rating
+
+    # Aggregate weighted ratings of (row, col) pairs: each pair reads the neighbor weights of its row and
+    # the ratings of its col only, the cost follows the number of pairs (e.g. candidates), not n_cols
+    ## rows: block of row indexes, pair_rows: position of each pair's row in rows, pair_cols: col of each pair
+    def aggregate_pairs(self, rows, pair_rows, pair_cols, K_number, sim_name):
+        weights = self.neighbor_weights(rows, K_number, sim_name)[pair_rows]   # (n_pairs, n_rows)
+        with timer("knn.aggregation"):
+            ratings = self.columns[pair_cols]                                   # (n_pairs, n_rows)
+            weighted = weights.multiply(ratings)
+            count("knn.aggregated_entries", weighted.nnz)
+            total = np.asarray(weighted.sum(axis=1)).ravel()
+            sum_similarity = np.asarray(weights.multiply(indicator(ratings)).sum(axis=1)).ravel()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rating = total / sum_similarity
+            # col of other row's history only
+            seen = np.asarray(self.get_indicator()[np.asarray(rows)[pair_rows], pair_cols]).ravel() > 0
+            rating[seen | ~np.isfinite(rating)] = np.nan
+        # Output: (n_pairs,) ratings, nan when there is no prediction
+        return np.round(rating, 12)
+
+    # same sparsity structure as the rows with every rating set to 1, built on first use
+    def get_indicator(self):
+        if self.indicator is None:
+            self.indicator = indicator(self.rows)
+        return self.indicator
+
+    # topK cols of many row ids, one block of rows per sparse product
+    def recommend_batch_rows(self, row_list, K_number, sim_name, topK=10, batch_size=256):
+        rows = self.encode_row(row_list)
+        col_ids = np.empty((len(rows), topK), dtype=self.col_ids.dtype)
+        col_ids[:] = -1 if col_ids.dtype.kind in 'iuf' else None
+        scores = np.full((len(rows), topK), np.nan)
+
+        known = np.flatnonzero(rows >= 0)
+        count("knn.queries", len(known))
+        for start in progress(range(0, len(known), batch_size), "recommending"):
+            batch = known[start:start + batch_size]
+            rating = self.aggregate_block(rows[batch], K_number, sim_name)
+            with timer("knn.ranking"):
+                top = topk_dense(rating, topK)
+            found = top >= 0
+            batch_ids, batch_scores = col_ids[batch], scores[batch]
+            batch_ids[found] = self.col_ids[top[found]]
+            batch_scores[found] = np.take_along_axis(rating, np.where(found, top, 0), axis=1)[found]
+            col_ids[batch], scores[batch] = batch_ids, batch_scores
+
+        # Output: ids (n, topK) padded with -1 (None for string ids), scores (n, topK) padded with nan
+        return col_ids, scores
+
+    # score of each (row id, col id) pair, rows grouped so the neighbors of each distinct row are read once
+    ## missing: value of the pairs without a prediction
+    def predict_batch_pairs(self, row_list, col_list, K_number, sim_name, batch_size=256, n_jobs=1, missing=0):
+        if get_n_jobs(n_jobs) > 1:
+            return self.predict_parallel(row_list, col_list, K_number, sim_name, batch_size, n_jobs, missing)
+        rows = self.encode_row(row_list)
+        cols = self.encode_col(col_list)
+        y_pred = np.full(len(rows), missing, dtype=np.float64)
+
+        known = np.flatnonzero((rows >= 0) & (cols >= 0))
+        unique_rows, inverse = np.unique(rows[known], return_inverse=True)
+        count("knn.predictions", len(known))
+        for start in progress(range(0, len(unique_rows), batch_size), "predicting"):
+            in_batch = (inverse >= start) & (inverse < start + batch_size)
+            y_pred[known[in_batch]] = self.aggregate_pairs(unique_rows[start:start + batch_size], inverse[in_batch] - start,
+                                                           cols[known[in_batch]], K_number, sim_name)
+
+        # Output: np.ndarray, missing when there is no prediction
+        y_pred[~np.isfinite(y_pred)] = missing
+        return y_pred
 
-        numerator = sum([(self.get_rating(userid1, i) - avg_rating_sum_1) * (self.get_rating(userid2, i) - avg_rating_sum_2) for i in both_item_count])
-        denominator = sqrt(sum([pow((self.get_rating(userid1, i) - avg_rating_sum_1), 2) for i in both_item_count])) * sqrt(sum([pow((self.get_rating(userid2, i) - avg_rating_sum_2), 2) for i in both_item_count]))
+    # predict_batch_pairs sharded over a process pool, each distinct row goes to a single worker
+    ## the workers read the fitted neighbor table: fit(K_number, sim_name) first
+    def predict_parallel(self, row_list, col_list, K_number, sim_name, batch_size, n_jobs, missing=0):
+        if self.fit_params is None or self.fit_params[1] != sim_name or K_number > self.fit_params[0]:
+            raise ValueError("n_jobs > 1 needs a neighbor table of {} with K >= {}: call fit(K_number={}, sim_name={!r}) "
+                             "first (fitted: {})".format(sim_name, K_number, K_number, sim_name, self.fit_params))
+
+        row_list, col_list = np.asarray(row_list), np.asarray(col_list)
+        rows = self.encode_row(row_list)
+        order = np.argsort(rows, kind='stable')
+        # cut the sorted pairs at the row boundary closest after each equal split point
+        _, starts = np.unique(rows[order], return_index=True)
+        n_shards = min(get_n_jobs(n_jobs), len(starts)) or 1
+        targets = np.arange(1, n_shards) * len(order) / n_shards
+        cuts = np.unique(starts[np.minimum(np.searchsorted(starts, targets), len(starts) - 1)])
+        shards = [shard for shard in np.split(order, cuts[cuts > 0]) if len(shard)]
+        shards_args = [(row_list[shard], col_list[shard], K_number, sim_name, batch_size, 1, missing) for shard in shards]
+
+        y_pred = np.zeros(len(order), dtype=np.float64)
+        for shard, shard_pred in zip(shards, map_shards(self, 'predict_batch_pairs', shards_args, n_jobs)):
+            y_pred[shard] = shard_pred
+        # Output: np.ndarray in the input order
+        return y_pred
 
-        # output: int
-        if (denominator == 0):
-            return 0
-        return numerator/denominator
-    
-    # Cosine calculation
-    def distance_similarity_score(self,userid1,userid2):
-        both_watch_count = 0
-        for element in self.ratings.loc[self.ratings.userid==userid1,'itemid'].tolist():
-            if element in self.ratings.loc[self.ratings.userid==userid2,'itemid'].tolist():
-                both_watch_count += 1
-        if both_watch_count == 0 :
-            return 0
+    # nan predictions (no neighborhood prediction) scored by fallback, e.g. a BiasBaseline
+    def fill_missing(self, y_pred, userid_list, itemid_list, fallback):
+        missing = np.isnan(y_pred)
+        if missing.any():
+            y_pred[missing] = fallback.predict_pairs(np.asarray(userid_list)[missing], np.asarray(itemid_list)[missing])
+        return y_pred
 
-        rating1 = []
-        rating2 = []
-        for element in self.ratings.loc[self.ratings.userid==userid1,'itemid'].tolist():
-            if element in self.ratings.loc[self.ratings.userid==userid2,'itemid'].tolist():
-                rating1.append(self.get_rating(userid1,element))
-                rating2.append(self.get_rating(userid2,element))
 
-        denominator = norm(rating1)*norm(rating2)
+class UserKNN(BaseKNN):
+    # ratings: ratings dataframe
+    def __init__(self, ratings):
+        super().__init__(ratings)
+
+    # rows are users, cols are items
+    def set_orientation(self):
+        self.rows = self.matrix.csr
+        self.columns = self.matrix.item_user()    # col x row view of rows (no copy)
+        self.row_column, self.col_column = "userid", "itemid"
+        self.row_ids = self.matrix.userids
+        self.col_ids = self.matrix.itemids
+        self.encode_row = self.matrix.encode_users
+        self.encode_col = self.matrix.encode_items
 
-        # output: int
-        if denominator == 0:
+    # Support function
+    # get rating from the user-item pair
+    def get_rating(self, userid, itemid):
+        return self.matrix.get_rating(userid, itemid)
+    # get items of user's history
+    def get_itemids_his(self, userid):
+        user_index = self.matrix.encode_user(userid)
+        if user_index < 0:
+            return []
+        items, _ = self.matrix.user_row(user_index)
+        return self.matrix.itemids[items].tolist()
+
+    # Pearson calculation
+    def pearson_correlation_score(self, userid1, userid2):
+        users = self.matrix.encode_users([userid1, userid2])
+        if (users < 0).any():
             return 0
-        return dot(rating1, rating2)/denominator
+        return self.row_similarity(users[0], users[1], 'pearson')
+    
+    # Cosine calculation
+    def distance_similarity_score(self, userid1, userid2):
+        users = self.matrix.encode_users([userid1, userid2])
+        if (users < 0).any():
+            return 0
+        return self.row_similarity(users[0], users[1], 'cosine')
 
     # get K user nearest
     def get_most_similar_user(self, userid, K_number_user, similarity_name):
-        userid_in_rat = self.ratings.userid.unique().tolist()
-
-        if similarity_name == 'pearson':
-            print("===similarity is being calculated by pearson...===")
-            similarity_score =  [(self.pearson_correlation_score(userid, user_i), user_i) for user_i in tqdm(userid_in_rat) if user_i != userid]
-
-        if similarity_name == 'cosine':
-            print("===similarity is being calculated by cosine...===")
-            similarity_score =  [(self.distance_similarity_score(userid, user_i), user_i) for user_i in tqdm(userid_in_rat) if user_i != userid]
-
-        similarity_score.sort() # ascending
-        similarity_score.reverse() # descending
-
         # output: [(score, userid)]
-        return similarity_score[:K_number_user]
+        return self.most_similar_rows(userid, K_number_user, similarity_name)
 
     # get recommendation for 1 user
     ## args: userid, K_number_user=10, sim_name=['cosine', 'pearson'], topK=10
     def get_recommendations(self, userid, K_number_user, sim_name, topK = None):
-        total = {}
-        sum_similarity = {}
-        list_user_nearest = self.get_most_similar_user(userid, K_number_user, sim_name)
-        
-        print("===recommending...===")
-        for similarity_score, user_id in tqdm(list_user_nearest): # loop each user in list nearest user 
-            score = similarity_score
-            itemids = self.get_itemids_his(user_id)
-            
-            for itemid in itemids:
-                # item id of other user's history
-                if itemid not in self.get_itemids_his(userid):
-                    if itemid not in total:
-                        total[itemid] = 0
-                        sum_similarity[itemid] = 0
-
-                    total[itemid] += self.get_rating(user_id, itemid)*score
-                    sum_similarity[itemid] += score
-
-            # calculate rating according to Aggregate weighted ratings
-            list_ranking = []
-            for userid, tot in total.items():
-                if sum_similarity[userid] == 0:
-                    list_ranking.append((0,userid))
-                else:
-                    rating = tot/(sum_similarity[userid])
-                    list_ranking.append((rating,userid))
-
-        # calculate rating according to Aggregate weighted ratings
-        list_ranking = [(tot/sum_similarity[itemid], itemid) for itemid, tot in total.items()]
-        list_ranking = [tup for tup in list_ranking if not isnan(tup[0])]
-
-        list_ranking.sort()
-        list_ranking.reverse()
-
-        # output: [(ratings, itemid)]
-        if topK != None:
-            return list_ranking[:topK]
-        return list_ranking
+        # output: [(ratings, itemid)], served from the result cache when enabled
+        return list(self.cached((userid, K_number_user, sim_name, topK),
+                                lambda: self.recommend_cols(userid, K_number_user, sim_name, topK)))
+
+    # get recommendation for many users, users are scored block by block
+    ## args: userids, K_number_user=40, sim_name=['cosine', 'pearson'], topK=10, batch_size=256 users per product
+    def recommend_batch(self, userids, K_number_user=40, sim_name='cosine', topK=10, batch_size=256):
+        # output: itemids (n_users, topK), ratings (n_users, topK)
+        return self.recommend_batch_rows(userids, K_number_user, sim_name, topK, batch_size)
+
+    # predict the rating of many (userid, itemid) pairs
+    ## fallback: model with predict_pairs(userids, itemids) for the pairs without a prediction
+    def predict_batch(self, pairs, K_number_user=40, sim_name='cosine', batch_size=256, n_jobs=1, fallback=None):
+        # Input: dataframe with userid, itemid columns or array of (userid, itemid)
+        userid_list, itemid_list = split_pairs(pairs)
+        if fallback is None:
+            # output: np.ndarray of ratings, 0 when there is no prediction
+            return self.predict_batch_pairs(userid_list, itemid_list, K_number_user, sim_name, batch_size, n_jobs)
+        y_pred = self.predict_batch_pairs(userid_list, itemid_list, K_number_user, sim_name, batch_size, n_jobs, missing=np.nan)
+        # output: np.ndarray of ratings, the fallback rating when there is no prediction
+        return self.fill_missing(y_pred, userid_list, itemid_list, fallback)
     
-    def get_recommendation_on_dataframe(self, df, K=40, sim_name='cosine'):
+    ## n_jobs > 1 shards the dataframe over a process pool (-1: all cores), on the neighbor table of fit()
+    def get_recommendation_on_dataframe(self, df, K=40, sim_name='cosine', n_jobs=1):
         # Input: dataframe
             # example:
             #
@@ -145,161 +520,163 @@ class UserKNN():
             # 7     ,1    
             # 15    ,1
             # ...
-        y_pred = []
         userid_list = df['userid'].tolist()
         itemid_list = df['itemid'].tolist()
         
-        print("------ Predicting on dataframe with {} records ------".format(len(userid_list)))
-
-        for i in range(len(userid_list)):        # each user
-            list_R = self.get_recommendations(userid_list[i], K, sim_name)  
-
-            # print("list_R", len(list_R))
-
-            check = 0
-            for j in list_R:
-                if(itemid_list[i] == j[1]):     #j[1] itemID
-                    y_pred.append(j[0]) #j[0] score
-                    check = 1
-            if(check == 0):
-                y_pred.append(0)
-            print('----- Predicting on {}th'.format(i), 'is {}'.format(y_pred[i]))
+        logger.info("predicting on dataframe with %d records", len(userid_list))
         # Output: list
-        return y_pred
+        return self.predict_batch_pairs(userid_list, itemid_list, K, sim_name, n_jobs=n_jobs).tolist()
 
-class ItemKNN():
+class ItemKNN(BaseKNN):
     # ratings: ratings dataframe
     def __init__(self, ratings):
-        self.ratings = ratings
+        super().__init__(ratings)
+
+    # rows are items, cols are users
+    def set_orientation(self):
+        self.rows = self.matrix.item_user()
+        self.columns = self.matrix.csr
+        self.row_column, self.col_column = "itemid", "userid"
+        self.row_ids = self.matrix.itemids
+        self.col_ids = self.matrix.userids
+        self.encode_row = self.matrix.encode_items
+        self.encode_col = self.matrix.encode_users
+
+    def set_matrix(self, matrix):
+        super().set_matrix(matrix)
+        # sparse item-item top-K similarity of the item-to-user mode, built on first use
+        self.item_similarity = None
+        self.item_similarity_T = None
+        self.item_similarity_key = None
     
     # Support function
     # get rating from the user-item pair
     def get_rating(self, userid, itemid):
-        rating_data = self.ratings.loc[(self.ratings.userid == userid) & (self.ratings.itemid == itemid), 'rating']
-        if rating_data.empty:
-            return None  # Return None or handle the case when the rating data is not found
-        return rating_data.iloc[0]
+        return self.matrix.get_rating(userid, itemid)
     # get users of item's history
     def get_userids_his(self, itemid):
-        return (self.ratings.loc[(self.ratings.itemid==itemid), 'userid'].tolist())
+        item_index = self.matrix.encode_item(itemid)
+        if item_index < 0:
+            return []
+        users, _ = self.matrix.item_column(item_index)
+        return self.matrix.userids[users].tolist()
 
     # Pearson calculation
     def pearson_correlation_score(self, itemid1, itemid2):
-        both_user_count = []
-        list_user_item1 = self.ratings.loc[self.ratings.itemid == itemid1, 'userid'].to_list()
-        list_user_item2 = self.ratings.loc[self.ratings.itemid == itemid2, 'userid'].to_list()
-
-        for userid in list_user_item1:
-            if userid in list_user_item2:
-                both_user_count.append(userid)
-        if len(both_user_count) == 0:
+        items = self.matrix.encode_items([itemid1, itemid2])
+        if (items < 0).any():
             return 0
-
-        rating_sum_1 = sum([self.get_rating(i, itemid1) for i in both_user_count])
-        avg_rating_sum_1 = rating_sum_1 / len(both_user_count)  # mean rating of item1
-        rating_sum_2 = sum([self.get_rating(i, itemid2) for i in both_user_count])
-        avg_rating_sum_2 = rating_sum_2 / len(both_user_count)  # mean rating of item2
-
-        numerator = sum([(self.get_rating(i, itemid1) - avg_rating_sum_1) * (self.get_rating(i, itemid2) - avg_rating_sum_2) for i in both_user_count])
-        denominator = sqrt(sum([pow((self.get_rating(i, itemid1) - avg_rating_sum_1), 2) for i in both_user_count])) * sqrt(sum([pow((self.get_rating(i, itemid2) - avg_rating_sum_2), 2) for i in both_user_count]))
-
-        # output: int
-        if denominator == 0:
-            return 0
-        return numerator / denominator
+        return self.row_similarity(items[0], items[1], 'pearson')
     
     # Cosine calculation
-    def distance_similarity_score(self,itemid1,itemid2):
-        both_item_count = 0
-        for element in self.ratings.loc[self.ratings.itemid==itemid1,'userid'].tolist():
-            if element in self.ratings.loc[self.ratings.itemid==itemid2,'userid'].tolist():
-                both_item_count += 1
-        if both_item_count == 0 :
-            return 0
-
-        rating1 = []
-        rating2 = []
-        for element in self.ratings.loc[self.ratings.itemid==itemid1,'userid'].tolist():
-            if element in self.ratings.loc[self.ratings.itemid==itemid2,'userid'].tolist():
-                rating1.append(self.get_rating(element,itemid1))
-                rating2.append(self.get_rating(element,itemid2))
-
-        denominator = norm(rating1)*norm(rating2)
-
-        # # output: int
-        if denominator == 0:
+    def distance_similarity_score(self, itemid1, itemid2):
+        items = self.matrix.encode_items([itemid1, itemid2])
+        if (items < 0).any():
             return 0
-        return dot(rating1, rating2)/denominator
+        return self.row_similarity(items[0], items[1], 'cosine')
 
     # get K item nearest
     def get_most_similar_item(self, itemid, K_number_item, similarity_name):
-        itemid_in_rat = self.ratings.itemid.unique().tolist()
-
-        if similarity_name == 'pearson':
-            print("===similarity is being calculated by pearson...===")
-            similarity_score =  [(self.pearson_correlation_score(itemid, user_i), user_i) for user_i in tqdm(itemid_in_rat) if user_i != itemid]
-
-        if similarity_name == 'cosine':
-            print("===similarity is being calculated by cosine...===")
-            similarity_score =  [(self.distance_similarity_score(itemid, user_i), user_i) for user_i in tqdm(itemid_in_rat) if user_i != itemid]
-
-        similarity_score.sort() # ascending
-        similarity_score.reverse() # descending
-
         # output: [(score, itemid)]
-        return similarity_score[:K_number_item]
+        return self.most_similar_rows(itemid, K_number_item, similarity_name)
 
-    # get recommendation for 1 user
+    # get recommendation for 1 item
     ## args: itemid, K_number_item=10, sim_name=['cosine', 'pearson'], topK=10
     def get_recommendations(self, itemid, K_number_item, sim_name, topK = None):
-
-        total = {}
-        sum_similarity = {}
-        list_item_nearest = self.get_most_similar_item(itemid, K_number_item, sim_name)
-
-        print("===recommending...===")
-        for similarity_score, item_id in tqdm(list_item_nearest): # loop each item in list nearest item
-            score = similarity_score
-            userids = self.get_userids_his(item_id)
-
-            for userid in userids:
-                # userid of other item's history
-                if userid not in self.get_userids_his(itemid):
-                    if userid not in total:
-                        total[userid] = 0
-                        sum_similarity[userid] = 0
-
-                    total[userid] += self.get_rating(userid, item_id)*score
-                    sum_similarity[userid] += score
-
-            # calculate rating according to Aggregate weighted ratings
-            list_ranking = []
-            for itemid, tot in total.items():
-                if sum_similarity[itemid] == 0:
-                    list_ranking.append((0,itemid))
-                else:
-                    rating = tot/(sum_similarity[itemid])
-                    list_ranking.append((rating,itemid))
-
-        for userid, tot in total.items():
-            if sum_similarity[userid] != 0:  # Check if denominator is non-zero
-                ranking_value = tot / sum_similarity[userid]
-                list_ranking.append((ranking_value, userid))
-            else:
-            # Handle the case when the denominator is zero
-                list_ranking.append((0, userid))  # Assign a default value, such as 0
-
-        list_ranking = [tup for tup in list_ranking if not isnan(tup[0])]
-
-        list_ranking.sort()
-        list_ranking.reverse()
-
-        # output: [(ratings, userid)]
-        if topK != None:
-            return list_ranking[:topK]
-        return list_ranking
+        # output: [(ratings, userid)], served from the result cache when enabled
+        return list(self.cached((itemid, K_number_item, sim_name, topK),
+                                lambda: self.recommend_cols(itemid, K_number_item, sim_name, topK)))
+
+    # get recommendation for many items, items are scored block by block
+    ## args: itemids, K_number_item=40, sim_name=['cosine', 'pearson'], topK=10, batch_size=256 items per product
+    def recommend_batch(self, itemids, K_number_item=40, sim_name='cosine', topK=10, batch_size=256):
+        # output: userids (n_items, topK), ratings (n_items, topK)
+        return self.recommend_batch_rows(itemids, K_number_item, sim_name, topK, batch_size)
+
+    # predict the rating of many (userid, itemid) pairs
+    ## fallback: model with predict_pairs(userids, itemids) for the pairs without a prediction
+    def predict_batch(self, pairs, K_number_item=40, sim_name='cosine', batch_size=256, n_jobs=1, fallback=None):
+        # Input: dataframe with userid, itemid columns or array of (userid, itemid)
+        userid_list, itemid_list = split_pairs(pairs)
+        if fallback is None:
+            # output: np.ndarray of ratings, 0 when there is no prediction
+            return self.predict_batch_pairs(itemid_list, userid_list, K_number_item, sim_name, batch_size, n_jobs)
+        y_pred = self.predict_batch_pairs(itemid_list, userid_list, K_number_item, sim_name, batch_size, n_jobs, missing=np.nan)
+        # output: np.ndarray of ratings, the fallback rating when there is no prediction
+        return self.fill_missing(y_pred, userid_list, itemid_list, fallback)
     
-    def get_recommendation_on_dataframe(self, df, K=40, sim_name='cosine'):
+    # Item-to-user mode: "users who liked X also liked Y", items recommended to users
+    # sparse (n_items, n_items) matrix of the top-K neighbors of every item (row j holds the neighbors of item j),
+    # read from the neighbor table, fitted first when it does not cover K_number and sim_name
+    def get_item_similarity(self, K_number_item=40, sim_name='cosine'):
+        if self.fit_params is None or self.fit_params[1] != sim_name or K_number_item > self.fit_params[0]:
+            self.fit(K_number_item, sim_name)
+        key = (self.version, K_number_item, sim_name)
+        if self.item_similarity_key != key:
+            neighbors = self.neighbors[:, :K_number_item]
+            position, slot = np.nonzero(neighbors >= 0)
+            n_items = self.rows.shape[0]
+            self.item_similarity = sparse.csr_matrix(
+                (self.neighbor_scores[position, slot], (position, neighbors[position, slot])), shape=(n_items, n_items))
+            self.item_similarity_T = self.item_similarity.T.tocsr()   # operand of the user products
+            self.item_similarity_key = key
+        return self.item_similarity
+
+    # topK unseen items of many users: the sparse rating rows of a block of users times the item-item matrix
+    ## normalize=True: weighted average of the user's ratings on the neighbors of an item (the predict_batch rating),
+    ## normalize=False: sum of similarity * rating (items close to many rated items first)
+    def recommend_to_users(self, userids, K_number_item=40, sim_name='cosine', topK=10, batch_size=256, normalize=True):
+        users = self.matrix.encode_users(userids)
+        itemids = np.empty((len(users), topK), dtype=self.matrix.itemids.dtype)
+        itemids[:] = -1 if itemids.dtype.kind in 'iuf' else None
+        scores = np.full((len(users), topK), np.nan)
+
+        known = np.flatnonzero(users >= 0)
+        count("knn.queries", len(known))
+        for start in progress(range(0, len(known), batch_size), "recommending"):
+            batch = known[start:start + batch_size]
+            rating = self.user_scores(users[batch], K_number_item, sim_name, normalize)
+            with timer("knn.ranking"):
+                top = topk_dense(rating, topK)
+            found = top >= 0
+            batch_ids, batch_scores = itemids[batch], scores[batch]
+            batch_ids[found] = self.matrix.itemids[top[found]]
+            batch_scores[found] = np.take_along_axis(rating, np.where(found, top, 0), axis=1)[found]
+            itemids[batch], scores[batch] = batch_ids, batch_scores
+
+        # Output: itemids (n_users, topK) padded with -1 (None for string ids), scores (n_users, topK) padded with nan
+        return itemids, scores
+
+    # scores of a block of user indexes on every item, one sparse product with the item-item matrix
+    def user_scores(self, users, K_number_item=40, sim_name='cosine', normalize=True):
+        self.get_item_similarity(K_number_item, sim_name)
+        similarity_T = self.item_similarity_T
+        user_rows = self.matrix.csr[users]
+        with timer("knn.aggregation"):
+            rating = (user_rows @ similarity_T).toarray()
+            if normalize:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    rating = rating / (indicator(user_rows) @ similarity_T).toarray()
+                rating[~np.isfinite(rating)] = np.nan
+            else:
+                rating[rating == 0] = np.nan   # no rated item among the neighbors
+            seen = user_rows.tocoo()
+            rating[seen.row, seen.col] = np.nan
+            rating = np.round(rating, 12)
+        # Output: dense array (len(users), n_items), nan for the seen items and the items without a score
+        return rating
+
+    # topK unseen items of 1 user
+    def get_user_recommendations(self, userid, K_number_item=40, sim_name='cosine', topK=10, normalize=True):
+        def recommend():
+            itemids, scores = self.recommend_to_users([userid], K_number_item, sim_name, topK, normalize=normalize)
+            found = ~np.isnan(scores[0])
+            return list(zip(scores[0][found].tolist(), itemids[0][found].tolist()))
+        # output: [(score, itemid)], served from the result cache when enabled
+        return list(self.cached(("user", userid, K_number_item, sim_name, topK, normalize), recommend))
+
+    ## n_jobs > 1 shards the dataframe over a process pool (-1: all cores), on the neighbor table of fit()
+    def get_recommendation_on_dataframe(self, df, K=40, sim_name='cosine', n_jobs=1):
         # Input: dataframe
             # example:
             #
@@ -309,27 +686,12 @@ class ItemKNN():
             # 7     ,1    
             # 15    ,1
             # ...
-        y_pred = []
         userid_list = df['userid'].tolist()
         itemid_list = df['itemid'].tolist()
         
-        print("------ Predicting on dataframe with {} records ------".format(len(itemid_list)))
-
-        for i in range(len(itemid_list)):        # each user
-            list_R = self.get_recommendations(itemid_list[i], K, sim_name)  
-
-            # print("list_R", len(list_R))
-
-            check = 0
-            for j in list_R:
-                if(userid_list[i] == j[1]):     #j[1] itemID
-                    y_pred.append(j[0]) #j[0] score
-                    check = 1
-            if(check == 0):
-                y_pred.append(0)
-            print('----- Predicting on {}th'.format(i), 'is {}'.format(y_pred[i]))
+        logger.info("predicting on dataframe with %d records", len(itemid_list))
         # Output: list
-        return y_pred
+        return self.predict_batch_pairs(itemid_list, userid_list, K, sim_name, n_jobs=n_jobs).tolist()
 
 if __name__ == "__main__":
     
@@ -350,4 +712,12 @@ if __name__ == "__main__":
     # itemKNN = ItemKNN(ratings)
     # itemKNN.get_recommendations(1, K=100, sim_name='pearson')
     # itemKNN.get_recommendation_on_dataframe(X_test, K=100, sim_name='pearson')
-    # itemKNN.get_recommendation_on_dataframe(X_test, K=100, sim_name='cosine')
\ No newline at end of file
+    # itemKNN.get_recommendation_on_dataframe(X_test, K=100, sim_name='cosine')
+
+    ## Out of core fit under a fractional budget (0.5 MB): same neighbor table as fit() ##
+    import tempfile
+    itemKNN = ItemKNN(X_train).fit(K_number=20, sim_name='cosine')
+    itemKNN_out_of_core = ItemKNN(X_train).fit_out_of_core(tempfile.mkdtemp(prefix="recscratch-"), K_number=20,
+                                                           sim_name='cosine', memory_budget_mb=0.5)
+    assert np.array_equal(itemKNN.neighbors, itemKNN_out_of_core.neighbors)
+    assert np.allclose(itemKNN.neighbor_scores, itemKNN_out_of_core.neighbor_scores)
@@ -0,0 +1,234 @@
+# Model-based is in the Collaborative Filtering method of Recommendation:
+# users and items are embedded in k latent factors fitted by alternating least squares
+
+# library
+import numpy as np
+from scipy import sparse
+from concurrent.futures import ThreadPoolExecutor
+
+# local library
+from recscratch.utils.processing import rating_processing, split_pairs
+from recscratch.utils.instrumentation import count, logger, progress, timer
+from recscratch.utils.persistence import check_model, load_arrays, save_arrays
+from recscratch.utils.rating_matrix import RatingMatrix
+from recscratch.utils.similarity import topk_dense
+
+# float64 values held at once by a block of the least squares solve
+BLOCK_BYTES = 64 * 2 ** 20
+
+
+# Support function
+# solve the rows start:end: (sum_j w_j y_j y_j^T + gram + reg I) x = sum_j c_j y_j
+def solve_block(weights, targets, fixed, gram, reg, start, end):
+    # Input: csr of the w_j and csr of the c_j (rows x cols), fixed factors y (n_cols, k)
+    n_cols, k = fixed.shape
+    block = weights[start:end]
+    # sum_j w_j y_j y_j^T of every row is the sparse product with the outer products y_j y_j^T of the
+    # columns: they are built once per column (not per rating), a few factors at a time
+    A = np.empty((end - start, k * k))
+    step = max(BLOCK_BYTES // (8 * k * n_cols), 1)
+    for a in range(0, k, step):
+        outer = (fixed[:, a:a + step, None] * fixed[:, None, :]).reshape(n_cols, -1)
+        A[:, a * k:(a + step) * k] = block @ outer
+    A = A.reshape(-1, k, k) + gram + reg[start:end, None, None] * np.eye(k)
+    b = targets[start:end] @ fixed
+    return np.linalg.solve(A, b[:, :, None])[:, :, 0]
+
+# one half-step of ALS: the factors of every row given the fixed factors of the columns
+def least_squares(weights, targets, fixed, gram, reg, n_threads=1):
+    weights, targets = sparse.csr_matrix(weights), sparse.csr_matrix(targets)
+    n_rows, k = weights.shape[0], fixed.shape[1]
+    solved = np.zeros((n_rows, k))
+    block_size = max(BLOCK_BYTES // (8 * k * k), 1)
+    if n_threads > 1:
+        block_size = min(block_size, -(-n_rows // n_threads))   # at least one block per thread
+    blocks = [(start, min(start + block_size, n_rows)) for start in range(0, n_rows, block_size)]
+
+    def solve(bounds):
+        solved[bounds[0]:bounds[1]] = solve_block(weights, targets, fixed, gram, reg, *bounds)
+
+    if n_threads > 1:
+        # sparse products and solves release the GIL: the blocks run on threads without copying the matrices
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(solve, blocks))
+    else:
+        for bounds in blocks:
+            solve(bounds)
+    # Output: (n_rows, k)
+    return solved
+
+
+class BaseMF():
+    # Latent factor model on the sparse rating matrix: score(u, i) = offset + x_u . y_i
+    # ratings: ratings dataframe
+    ## args: factors=k, reg: l2 regularization, n_iter: ALS sweeps, n_threads: threads of the per row solves
+    def __init__(self, ratings, factors=20, reg=0.1, n_iter=10, n_threads=1, seed=None):
+        self.ratings = ratings
+        self.matrix = RatingMatrix(ratings)
+        self.factors = factors
+        self.reg = reg
+        self.n_iter = n_iter
+        self.n_threads = n_threads
+        self.seed = seed
+        self.user_factors = None
+        self.item_factors = None
+        self.offset = 0.0
+
+    # alternate the user and item solves
+    def fit(self):
+        rng = np.random.default_rng(self.seed)
+        user_items = self.matrix.csr
+        item_users = self.matrix.item_user().tocsr()
+        self.user_factors = rng.normal(scale=0.01, size=(self.matrix.n_users, self.factors))
+        self.item_factors = rng.normal(scale=0.01, size=(self.matrix.n_items, self.factors))
+        self.offset = self.get_offset()
+        logger.info("%s is being fitted (factors=%d, n_iter=%d)", type(self).__name__, self.factors, self.n_iter)
+        for _ in progress(range(self.n_iter), "ALS sweeps"):
+            with timer("als.user_solve"):
+                self.user_factors = self.solve_side(user_items, self.item_factors)
+            with timer("als.item_solve"):
+                self.item_factors = self.solve_side(item_users, self.user_factors)
+        return self
+
+    # fitted arrays and parameters
+    def get_state(self):
+        arrays = self.matrix.get_state()
+        arrays.update({"user_factors": self.user_factors, "item_factors": self.item_factors})
+        meta = {"model": type(self).__name__, "factors": self.factors, "reg": self.reg, "n_iter": self.n_iter,
+                "n_threads": self.n_threads, "seed": self.seed, "offset": self.offset, "params": self.get_params()}
+        return arrays, meta
+
+    @classmethod
+    def from_state(cls, arrays, meta):
+        model = cls.__new__(cls)
+        model.ratings = None
+        model.matrix = RatingMatrix.from_state(arrays)
+        for name in ["factors", "reg", "n_iter", "n_threads", "seed", "offset"]:
+            setattr(model, name, meta[name])
+        for name, value in meta["params"].items():
+            setattr(model, name, value)
+        model.user_factors, model.item_factors = arrays["user_factors"], arrays["item_factors"]
+        return model
+
+    # write the rating matrix, the encoders and the factors as .npy files plus a manifest
+    def save(self, path):
+        arrays, meta = self.get_state()
+        return save_arrays(path, arrays, meta)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        arrays, meta = load_arrays(path, mmap)
+        check_model(meta, cls)
+        return cls.from_state(arrays, meta)
+
+    # Support function
+    def get_params(self):
+        return {}
+
+    # score of each (user index, item index) pair, nan for an unknown index
+    def score_pairs(self, users, items):
+        known = (users >= 0) & (items >= 0)
+        y_pred = np.full(len(users), np.nan)
+        y_pred[known] = self.offset + np.einsum('nk,nk->n', self.user_factors[users[known]],
+                                                self.item_factors[items[known]])
+        return y_pred
+
+    # predict the rating of many (userid, itemid) pairs
+    ## fallback: model with predict_pairs(userids, itemids) for unknown users / items
+    def predict_batch(self, pairs, fallback=None):
+        # Input: dataframe with userid, itemid columns or array of (userid, itemid)
+        userid_list, itemid_list = split_pairs(pairs)
+        y_pred = self.score_pairs(self.matrix.encode_users(userid_list), self.matrix.encode_items(itemid_list))
+        missing = np.isnan(y_pred)
+        if fallback is not None and missing.any():
+            y_pred[missing] = fallback.predict_pairs(np.asarray(userid_list)[missing], np.asarray(itemid_list)[missing])
+        # output: np.ndarray of ratings, 0 (or the fallback rating) when there is no prediction
+        y_pred[np.isnan(y_pred)] = 0
+        return y_pred
+
+    # get recommendation for many users: dense factor products, batch_size users at a time
+    ## exclude_seen=True: the rated items of a user are not recommended
+    def recommend_batch(self, userids, topK=10, batch_size=1024, exclude_seen=True):
+        users = self.matrix.encode_users(userids)
+        itemids = np.empty((len(users), topK), dtype=self.matrix.itemids.dtype)
+        itemids[:] = -1 if itemids.dtype.kind in 'iuf' else None
+        scores = np.full((len(users), topK), np.nan)
+
+        known = np.flatnonzero(users >= 0)
+        count("als.queries", len(known))
+        for start in range(0, len(known), batch_size):
+            batch = known[start:start + batch_size]
+            with timer("als.scoring"):
+                rating = self.offset + self.user_factors[users[batch]] @ self.item_factors.T
+                if exclude_seen:
+                    seen = self.matrix.csr[users[batch]].tocoo()
+                    rating[seen.row, seen.col] = np.nan
+            with timer("als.ranking"):
+                top = topk_dense(rating, topK)
+            found = top >= 0
+            batch_ids, batch_scores = itemids[batch], scores[batch]
+            batch_ids[found] = self.matrix.itemids[top[found]]
+            batch_scores[found] = np.take_along_axis(rating, np.where(found, top, 0), axis=1)[found]
+            itemids[batch], scores[batch] = batch_ids, batch_scores
+
+        # output: itemids (n_users, topK) padded with -1 (None for string ids), scores (n_users, topK) padded with nan
+        return itemids, scores
+
+    # get recommendation for 1 user
+    def get_recommendations(self, userid, topK=10):
+        itemids, scores = self.recommend_batch([userid], topK)
+        found = ~np.isnan(scores[0])
+        # output: [(score, itemid)]
+        return list(zip(scores[0][found].tolist(), itemids[0][found].tolist()))
+
+
+class ALS(BaseMF):
+    # Explicit feedback: least squares on the observed ratings centered on the global mean,
+    # regularization weighted by the number of ratings of the row (weighted-lambda ALS)
+    def get_offset(self):
+        return float(self.matrix.csr.data.mean()) if self.matrix.csr.nnz else 0.0
+
+    def solve_side(self, rows, fixed):
+        weights = rows.copy()
+        weights.data = np.ones_like(weights.data)
+        targets = rows.copy()
+        targets.data = targets.data - self.offset
+        reg = self.reg * np.maximum(np.diff(rows.indptr), 1)   # rows without rating solve to 0
+        return least_squares(weights, targets, fixed, 0.0, reg, self.n_threads)
+
+
+class ImplicitALS(BaseMF):
+    # Implicit feedback (Hu, Koren, Volinsky 2008): every rated item is a positive preference
+    # with confidence 1 + alpha * rating, every other item a negative preference with confidence 1
+    def __init__(self, ratings, factors=20, reg=0.1, n_iter=10, n_threads=1, seed=None, alpha=40.0):
+        super().__init__(ratings, factors, reg, n_iter, n_threads, seed)
+        self.alpha = alpha
+
+    def get_params(self):
+        return {"alpha": self.alpha}
+
+    def get_offset(self):
+        return 0.0
+
+    def solve_side(self, rows, fixed):
+        weights = rows.copy()
+        weights.data = self.alpha * weights.data            # confidence - 1 on the rated items
+        targets = rows.copy()
+        targets.data = 1 + self.alpha * targets.data        # confidence * preference (= 1)
+        gram = fixed.T @ fixed                               # unrated items, shared by every row
+        reg = np.full(rows.shape[0], float(self.reg))
+        return least_squares(weights, targets, fixed, gram, reg, self.n_threads)
+
+
+if __name__ == "__main__":
+
+    ## Movielens dataset ##
+    X_train, X_test = rating_processing("../data_example/Movielens/ml-latest-small", "ratings.csv", "userId", "movieId", "rating", 0.9, 22)
+
+    ## Test function ##
+    als = ALS(X_train, factors=20, reg=0.1, n_iter=10, seed=22).fit()
+    print(als.get_recommendations(1, topK=10))
+    print(als.predict_batch(X_test))
+
+    implicit_als = ImplicitALS(X_train, factors=20, reg=0.1, n_iter=10, seed=22).fit()
+    print(implicit_als.recommend_batch([1, 2, 3], topK=10))
@@ -2,10 +2,14 @@
 
 # library 
 import pandas as pd
-import itertools
+import numpy as np
+from scipy import sparse
 
 # local library
-from utils.processing import rating_processing
+from recscratch.utils.processing import rating_processing, split_pairs
+from recscratch.utils.persistence import check_model, ids_from_storable, load_arrays, save_arrays, sparse_arrays, sparse_from_arrays
+from recscratch.utils.rating_matrix import RatingMatrix
+from recscratch.utils.similarity import topk_dense
 
 
 def filter_by(df, filter_by_df, filter_by_cols):
@@ -31,34 +35,254 @@ class MeanRating :
             return predictions.loc[predictions['userid'] == userid]
         # Output: Data frame
         return predictions
+
+    # write the average ratings as .npy files plus a manifest
+    def save(self, path):
+        arrays = {"userids": self.users_ratings["userid"].to_numpy(),
+                  "avg_rating": self.users_ratings["AvgRating"].to_numpy()}
+        return save_arrays(path, arrays, {"model": type(self).__name__})
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        arrays, meta = load_arrays(path, mmap)
+        check_model(meta, cls)
+        model = cls()
+        model.users_ratings = pd.DataFrame({"userid": ids_from_storable(arrays["userids"]), "AvgRating": arrays["avg_rating"]})
+        return model
     
-   
+
+class BiasBaseline:
+    # rating = global mean + user bias + item bias, the biases are regularized
+    # towards 0 and fitted by alternating closed-form sweeps over the encoded ratings.
+    # Unknown users / items have a bias of 0: a cold start falls back to the global mean.
+    # Predictions are clipped to the [min, max] rating of the fitted ratings.
+    def __init__(self, reg_user = 15, reg_item = 10, n_iter = 10):
+        self.reg_user = reg_user
+        self.reg_item = reg_item
+        self.n_iter = n_iter
+        self.rating_range = None
+
+    def fit(self, df):
+        self.matrix = RatingMatrix(df)
+        csr = self.matrix.csr
+        users = np.repeat(np.arange(self.matrix.n_users), np.diff(csr.indptr))
+        items, ratings = csr.indices, csr.data
+        n_user = np.bincount(users, minlength=self.matrix.n_users)
+        n_item = np.bincount(items, minlength=self.matrix.n_items)
+
+        self.global_mean = float(ratings.mean()) if len(ratings) else 0.0
+        self.rating_range = (float(ratings.min()), float(ratings.max())) if len(ratings) else None
+        self.user_bias = np.zeros(self.matrix.n_users)
+        self.item_bias = np.zeros(self.matrix.n_items)
+        residual = ratings - self.global_mean
+        for _ in range(self.n_iter):
+            self.item_bias = np.bincount(items, residual - self.user_bias[users], minlength=self.matrix.n_items) / (self.reg_item + n_item)
+            self.user_bias = np.bincount(users, residual - self.item_bias[items], minlength=self.matrix.n_users) / (self.reg_user + n_user)
+        return self
+
+    # Support function
+    # bias of each encoded index, 0 for -1 (unknown id)
+    def biases(self, bias, indexes):
+        return np.where(indexes >= 0, bias[np.maximum(indexes, 0)], 0.0) if len(bias) else np.zeros(len(indexes))
+
+    # predictions inside the rating scale of the fitted ratings (nan stays nan)
+    def clip(self, rating):
+        if self.rating_range is None:
+            return rating
+        return np.clip(rating, *self.rating_range)
+
+    # predicted rating of each (userid, itemid) pair
+    def predict_pairs(self, userid_list, itemid_list):
+        users = self.matrix.encode_users(userid_list)
+        items = self.matrix.encode_items(itemid_list)
+        # Output: np.ndarray
+        return self.clip(self.global_mean + self.biases(self.user_bias, users) + self.biases(self.item_bias, items))
+
+    def predict(self, userid, itemid):
+        return float(self.predict_pairs([userid], [itemid])[0])
+
+    def predict_batch(self, pairs):
+        # Input: dataframe with userid, itemid columns or array of (userid, itemid)
+        # Output: np.ndarray
+        return self.predict_pairs(*split_pairs(pairs))
+
+    # Generate rating prediction for the test set, every row of df is kept
+    def get_recommendations(self, df, userid = None):
+        predictions = df.assign(Prediction=self.predict_batch(df))
+        if userid != None:
+            return predictions.loc[predictions['userid'] == userid]
+        # Output: Data frame
+        return predictions
+
+    # topK unseen items of many users by predicted rating, batch_size users at a time
+    def recommend_batch(self, userids, topK = 10, batch_size = 256):
+        users = self.matrix.encode_users(userids)
+        itemids = np.empty((len(users), topK), dtype=self.matrix.itemids.dtype)
+        itemids[:] = -1 if itemids.dtype.kind in 'iuf' else None
+        scores = np.full((len(users), topK), np.nan)
+
+        for start in range(0, len(users), batch_size):
+            batch = users[start:start + batch_size]
+            rating = self.clip(self.global_mean + self.biases(self.user_bias, batch)[:, None] + self.item_bias[None, :])
+            known = np.flatnonzero(batch >= 0)
+            seen = self.matrix.csr[batch[known]].tocoo()
+            rating[known[seen.row], seen.col] = np.nan
+            top = topk_dense(rating, topK)
+            found = top >= 0
+            batch_ids, batch_scores = itemids[start:start + batch_size], scores[start:start + batch_size]
+            batch_ids[found] = self.matrix.itemids[top[found]]
+            batch_scores[found] = np.take_along_axis(rating, np.where(found, top, 0), axis=1)[found]
+
+        # Output: itemids (n_users, topK) padded with -1 (None for string ids), ratings (n_users, topK) padded with nan
+        return itemids, scores
+
+    # write the rating matrix and the biases as .npy files plus a manifest
+    def save(self, path):
+        arrays = self.matrix.get_state()
+        arrays.update({"user_bias": self.user_bias, "item_bias": self.item_bias})
+        meta = {"model": type(self).__name__, "reg_user": self.reg_user, "reg_item": self.reg_item,
+                "n_iter": self.n_iter, "global_mean": self.global_mean, "rating_range": self.rating_range}
+        return save_arrays(path, arrays, meta)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        arrays, meta = load_arrays(path, mmap)
+        check_model(meta, cls)
+        model = cls(meta["reg_user"], meta["reg_item"], meta["n_iter"])
+        model.matrix = RatingMatrix.from_state(arrays)
+        model.user_bias, model.item_bias = arrays["user_bias"], arrays["item_bias"]
+        model.global_mean = meta["global_mean"]
+        rating_range = meta.get("rating_range")   # artifacts saved before the clipping have none
+        model.rating_range = tuple(rating_range) if rating_range is not None else None
+        return model
+
+
 class MostPop:
+    # One global ranking of the items by count, every user gets the first unseen items of it.
+    # Seen items are a sparse user x rank matrix, never a users x items cross join.
     def item_count(self, df):
-        item_counts = df["itemid"].value_counts().to_frame().reset_index()
+        item_counts = df["itemid"].value_counts()
+        item_counts = item_counts[item_counts > 0].to_frame().reset_index()  # categorical ids list unused categories
         item_counts.columns = ["itemid", "Count"]
         self.item_counts = item_counts
+        self.set_ranking()
+        # items of df are the seen items of recommend_batch / recommend_stream
+        self.seen_users, self.seen = self.seen_matrix(df)
         return item_counts
-    
-    def get_recommendations(self, df, userid = None):
-        user_item_col = ["userid", "itemid"]
 
-        # Cross join users and items
-        test_users = df['userid'].unique()
-        user_item_list = list(itertools.product(test_users, self.item_counts['itemid']))
-        users_items = pd.DataFrame(user_item_list, columns=user_item_col)
+    # Support function
+    def set_ranking(self):
+        self.ranked_itemids = self.item_counts["itemid"].to_numpy()   # rank -> itemid
+        self.ranked_counts = self.item_counts["Count"].to_numpy()
+        self.item_ranks = pd.Index(self.ranked_itemids)               # itemid -> rank
+
+    # seen items of every user of df, as a sparse (n_users, n_items) matrix on the rank positions
+    def seen_matrix(self, df, users = None):
+        if users is None:
+            users = pd.Index(pd.unique(df["userid"]))
+        user_pos = users.get_indexer(df["userid"])
+        ranks = self.item_ranks.get_indexer(df["itemid"])
+        keep = (user_pos >= 0) & (ranks >= 0)
+        seen = sparse.csr_matrix((np.ones(np.count_nonzero(keep), dtype=bool), (user_pos[keep], ranks[keep])),
+                                 shape=(len(users), len(self.ranked_itemids)))
+        seen.sum_duplicates()
+        # Output: users index, sparse matrix (n_users, n_items)
+        return users, seen
+
+    # first topN unseen rank positions of each row of a seen block
+    def top_unseen(self, seen, topN):
+        n_items = seen.shape[1]
+        topN = n_items if topN is None else min(topN, n_items)
+        # only the first topN + n_seen ranks of a user can hold its topN unseen items
+        n_seen = np.diff(seen.indptr)
+        width = min(n_items, topN + int(n_seen.max(initial=0)))
+        window = seen[:, :width].tocoo()
+        mask = np.zeros((seen.shape[0], width), dtype=bool)
+        mask[window.row, window.col] = True
 
-        # Remove seen items (items in the train set) as we will not recommend those again to the users
-        users_items_remove_seen = filter_by(users_items, df, user_item_col)
+        ranks = np.argsort(mask, axis=1, kind="stable")[:, :topN]   # unseen first, in rank order
+        unseen = ~np.take_along_axis(mask, ranks, axis=1)
+        # Output: (n, topN) rank positions padded with -1
+        return np.where(unseen, ranks, -1)
 
-        # Generate recommendations
-        recommendations = pd.merge(self.item_counts, users_items_remove_seen, on=['itemid'], how='inner')
-        
+    # ids and counts of rank positions, ids padded with -1 (None for string ids), counts padded with 0
+    def ranks_to_items(self, ranks):
+        itemids = np.empty(ranks.shape, dtype=self.ranked_itemids.dtype)
+        itemids[:] = -1 if itemids.dtype.kind in 'iuf' else None
+        counts = np.zeros(ranks.shape, dtype=self.ranked_counts.dtype)
+        found = ranks >= 0
+        itemids[found] = self.ranked_itemids[ranks[found]]
+        counts[found] = self.ranked_counts[ranks[found]]
+        return itemids, counts
+
+    # seen block of some users: rows of the item_count seen matrix, or of df when given
+    def seen_block(self, userids, df = None):
+        if df is not None:
+            return self.seen_matrix(df, pd.Index(userids))[1]
+        rows = self.seen_users.get_indexer(userids)
+        block = self.seen[np.maximum(rows, 0)]
+        return block.multiply((rows >= 0)[:, None]).tocsr()   # unknown users have seen nothing
+
+    # top-N unseen items of many users, batch_size users at a time
+    ## df: ratings whose items are excluded, default the dataframe of item_count
+    def recommend_stream(self, userids, topN = 10, batch_size = 1024, df = None):
+        userids = np.asarray(userids)
+        for start in range(0, len(userids), batch_size):
+            batch = userids[start:start + batch_size]
+            ranks = self.top_unseen(self.seen_block(batch, df), topN)
+            # Output: userids (b,), itemids (b, topN), counts (b, topN)
+            yield (batch,) + self.ranks_to_items(ranks)
+
+    def recommend_batch(self, userids, topN = 10, batch_size = 1024, df = None):
+        blocks = list(self.recommend_stream(userids, topN, batch_size, df))
+        if not blocks:
+            return self.ranks_to_items(np.full((0, topN or len(self.ranked_itemids)), -1))
+        # Output: itemids (n_users, topN), counts (n_users, topN)
+        return np.concatenate([block[1] for block in blocks]), np.concatenate([block[2] for block in blocks])
+
+    # items not seen in df for every user of df, most popular first
+    ## topN=None: every unseen item, topN=int: the topN first unseen items of each user
+    def get_recommendations(self, df, userid = None, topN = None, batch_size = 1024):
+        test_users = pd.Index(pd.unique(df["userid"]))
         if userid != None:
-            return recommendations.loc[recommendations['userid'] == userid]
+            test_users = test_users[test_users == userid]
+        _, seen = self.seen_matrix(df, test_users)
+
+        ranks, user_pos = [], []
+        for start in range(0, len(test_users), batch_size):
+            block = self.top_unseen(seen[start:start + batch_size], topN)
+            row, slot = np.nonzero(block >= 0)
+            ranks.append(block[row, slot])
+            user_pos.append(row + start)
+        ranks = np.concatenate(ranks) if ranks else np.zeros(0, dtype=np.int64)
+        user_pos = np.concatenate(user_pos) if user_pos else np.zeros(0, dtype=np.int64)
+
+        # item by item in popularity order, users in their order of appearance in df
+        order = np.lexsort((user_pos, ranks))
+        recommendations = pd.DataFrame({"itemid": self.ranked_itemids[ranks[order]],
+                                        "Count": self.ranked_counts[ranks[order]],
+                                        "userid": test_users.to_numpy()[user_pos[order]]})
+        # Output: Data frame
         return recommendations
 
-        
+    # write the item counts and the seen matrix as .npy files plus a manifest
+    def save(self, path):
+        arrays = {"itemids": self.item_counts["itemid"].to_numpy(), "counts": self.item_counts["Count"].to_numpy(),
+                  "seen_users": self.seen_users.to_numpy()}
+        arrays.update(sparse_arrays("seen", self.seen))
+        return save_arrays(path, arrays, {"model": type(self).__name__})
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        arrays, meta = load_arrays(path, mmap)
+        check_model(meta, cls)
+        model = cls()
+        model.item_counts = pd.DataFrame({"itemid": ids_from_storable(arrays["itemids"]), "Count": arrays["counts"]})
+        model.set_ranking()
+        model.seen_users = pd.Index(ids_from_storable(arrays["seen_users"]))
+        model.seen = sparse_from_arrays(arrays, "seen", (len(model.seen_users), len(model.ranked_itemids)))
+        return model
+
 if __name__ == "__main__":
     # ## Movielens dataset ##
     # X_train, X_test = rating_processing("../data_example/Movielens/ml-latest-small", "ratings.csv", "userId", "movieId", "rating", 0.998, 22)
@@ -0,0 +1,292 @@
+# Two-stage recommendation: a cheap candidate generator pulls a few hundred items per user, heavier
+# scorers re-rank only those candidates. Every stage runs on a batch of users and is timed on its own
+# (instrumentation timers "pipeline.candidates.<name>", "pipeline.score.<name>", "pipeline.ranking").
+#
+#   pipeline = Pipeline(UnionCandidates(PopularCandidates(mostpop, 200), NeighborCandidates(itemKNN, 200)),
+#                       [KNNScorer(userKNN, 40, 'cosine', fallback=baseline)], topK=10)
+#   itemids, scores = pipeline.recommend_batch([1, 2, 3])
+
+# library
+import numpy as np
+import pandas as pd
+
+# local library
+from recscratch.utils.instrumentation import count, progress, timer
+from recscratch.utils.similarity import topk_dense
+
+
+# Support function
+# empty (b, n) id array of dtype, padded with -1 (None for string ids)
+def padded_ids(shape, dtype):
+    itemids = np.empty(shape, dtype=dtype)
+    itemids[:] = -1 if itemids.dtype.kind in 'iuf' else None
+    return itemids
+
+# valid entries of an id array
+def valid_ids(itemids):
+    if itemids.dtype.kind in 'iuf':
+        return itemids != -1
+    return pd.notna(itemids)
+
+# (n_users, n) mask of the items each user rated in a RatingMatrix
+def seen_mask(matrix, userids, itemids):
+    users = np.repeat(matrix.encode_users(userids), itemids.shape[1])
+    items = matrix.encode_items(itemids.ravel())
+    known = (users >= 0) & (items >= 0)
+    csr = matrix.csr
+    if csr.nnz == 0:
+        return np.zeros(itemids.shape, dtype=bool)
+    # csr entries are sorted on (row, col): the flat keys row * n_items + col are sorted too
+    seen_keys = np.repeat(np.arange(csr.shape[0], dtype=np.int64), np.diff(csr.indptr)) * csr.shape[1] + csr.indices
+    keys = users.astype(np.int64) * csr.shape[1] + items
+    position = np.minimum(np.searchsorted(seen_keys, keys), len(seen_keys) - 1)
+    return (known & (seen_keys[position] == keys)).reshape(itemids.shape)
+
+# ids of each row moved left in their order, the repeated ones dropped
+def dedupe_rows(itemids):
+    b, n = itemids.shape
+    valid = valid_ids(itemids)
+    codes, _ = pd.factorize(itemids.ravel())
+    keys = np.where(valid.ravel(), np.repeat(np.arange(b, dtype=np.int64), n) * (codes.max(initial=0) + 1) + codes, -1)
+    _, first = np.unique(keys, return_index=True)
+    keep = np.zeros(b * n, dtype=bool)
+    keep[first] = True
+    keep = (keep & (keys >= 0)).reshape(b, n)
+    order = np.argsort(~keep, axis=1, kind='stable')
+    deduped = padded_ids((b, n), itemids.dtype)
+    moved = np.take_along_axis(keep, order, axis=1)
+    deduped[moved] = np.take_along_axis(itemids, order, axis=1)[moved]
+    # Output: (b, n) ids padded with -1 (None for string ids)
+    return deduped
+
+
+# Candidate generators: candidates(userids) -> (n_users, n_candidates) item ids padded with -1 (None)
+class PopularCandidates():
+    # most popular items the user has not seen, from a MostPop after item_count
+    name = "popular"
+
+    def __init__(self, mostpop, n_candidates=200):
+        self.mostpop = mostpop
+        self.n_candidates = n_candidates
+
+    def candidates(self, userids):
+        itemids, _ = self.mostpop.recommend_batch(userids, self.n_candidates)
+        return itemids
+
+
+class NeighborCandidates():
+    # items close to the user's rated items in the item-item matrix of an ItemKNN (sum of similarity * rating)
+    name = "neighbors"
+
+    def __init__(self, itemKNN, n_candidates=200, K_number_item=40, sim_name='cosine'):
+        self.itemKNN = itemKNN
+        self.n_candidates = n_candidates
+        self.K_number_item = K_number_item
+        self.sim_name = sim_name
+
+    def candidates(self, userids):
+        itemids, _ = self.itemKNN.recommend_to_users(userids, self.K_number_item, self.sim_name,
+                                                     self.n_candidates, normalize=False)
+        return itemids
+
+
+class ContentCandidates():
+    # content neighbors of the best rated items of the user (n_seeds of them), looked up in the
+    # similarity of a ContentBased: an IVFIndex (ANN), a sparse top-K or a dense matrix
+    ## content_itemids: item id of every content row (hybrid.link_content), ratings_model: model whose
+    ## matrix holds the user histories (e.g. the KNN or MostPop training ratings through a RatingMatrix)
+    name = "content"
+
+    def __init__(self, content_based, cosine_sim, content_itemids, ratings_model, n_candidates=200, n_seeds=5):
+        self.content_based = content_based
+        self.cosine_sim = cosine_sim
+        self.content_itemids = np.asarray(content_itemids)
+        # item id -> content row, the first row of an id
+        first = np.flatnonzero(valid_ids(self.content_itemids) & ~pd.Index(self.content_itemids).duplicated())
+        self.matrix = ratings_model.matrix
+        position = pd.Index(self.content_itemids[first]).get_indexer(self.matrix.itemids)
+        self.item_content = np.where(position >= 0, first[np.maximum(position, 0)], -1)   # item index -> content row
+        self.n_candidates = n_candidates
+        self.n_seeds = n_seeds
+
+    # content rows of the best rated items with content of each user, padded with -1
+    def seeds(self, userids):
+        users = self.matrix.encode_users(userids)
+        rows = self.matrix.csr[np.maximum(users, 0)]
+        user_of = np.repeat(np.arange(len(users)), np.diff(rows.indptr))
+        content_rows = self.item_content[rows.indices]
+        keep = (content_rows >= 0) & (users[user_of] >= 0)
+        user_of, content_rows, ratings = user_of[keep], content_rows[keep], rows.data[keep]
+
+        order = np.lexsort((content_rows, -ratings, user_of))   # rating descending, then the content order
+        n_rated = np.bincount(user_of, minlength=len(users))
+        rank = np.arange(len(order)) - (np.cumsum(n_rated) - n_rated)[user_of[order]]
+        top = rank < self.n_seeds
+        seeds = np.full((len(users), self.n_seeds), -1, dtype=np.int64)
+        seeds[user_of[order][top], rank[top]] = content_rows[order][top]
+        return seeds
+
+    def candidates(self, userids):
+        content_rows = self.seeds(userids)
+        per_seed = -(-self.n_candidates // self.n_seeds)
+
+        neighbors = np.full((content_rows.size, per_seed), -1, dtype=np.int64)
+        linked = np.flatnonzero(content_rows.ravel() >= 0)
+        if len(linked):
+            neighbors[linked] = self.content_based.top_similar(self.cosine_sim, content_rows.ravel()[linked], per_seed)
+        # the seeds' lists interleaved: the best neighbor of every seed first
+        neighbors = neighbors.reshape(len(content_rows), self.n_seeds, per_seed).transpose(0, 2, 1).reshape(len(content_rows), -1)
+        itemids = padded_ids(neighbors.shape, self.content_itemids.dtype)
+        found = neighbors >= 0
+        itemids[found] = self.content_itemids[neighbors[found]]   # content rows without a link stay padded
+        itemids[seen_mask(self.matrix, userids, itemids)] = -1 if itemids.dtype.kind in 'iuf' else None
+        return dedupe_rows(itemids)[:, :self.n_candidates]
+
+
+class UnionCandidates():
+    # candidates of several generators, in the order of the generators, repeated items dropped
+    name = "union"
+
+    def __init__(self, *generators):
+        self.generators = generators
+
+    def candidates(self, userids):
+        blocks = []
+        for generator in self.generators:
+            with timer("pipeline.candidates." + generator.name):
+                blocks.append(generator.candidates(userids))
+        return dedupe_rows(np.concatenate(blocks, axis=1))
+
+
+# Scorers: score(userids, itemids) -> (n_users, n_candidates) scores, nan for no score (and padding)
+class KNNScorer():
+    # KNN rating prediction of the candidate pairs, a UserKNN or an ItemKNN (the fitted neighbor table is used
+    # when it covers K_number and sim_name) aggregated on the candidate pairs only, fallback (e.g. BiasBaseline)
+    # for the pairs without prediction
+    ## keep: candidates kept after this stage, None: all
+    name = "knn"
+
+    def __init__(self, knn, K_number=40, sim_name='cosine', fallback=None, keep=None, batch_size=256):
+        self.knn = knn
+        self.K_number = K_number
+        self.sim_name = sim_name
+        self.fallback = fallback
+        self.keep = keep
+        self.batch_size = batch_size
+
+    def score(self, userids, itemids):
+        users = np.repeat(np.asarray(userids), itemids.shape[1])
+        items = itemids.ravel()
+        valid = valid_ids(items)
+        scores = np.full(len(items), np.nan)
+        pairs = {"userid": users[valid], "itemid": items[valid]}
+        rows, cols = pairs[self.knn.row_column], pairs[self.knn.col_column]
+        y_pred = self.knn.predict_batch_pairs(rows, cols, self.K_number, self.sim_name, self.batch_size, missing=np.nan)
+        if self.fallback is not None:
+            y_pred = self.knn.fill_missing(y_pred, pairs["userid"], pairs["itemid"], self.fallback)
+        scores[valid] = y_pred
+        return scores.reshape(itemids.shape)
+
+
+class PredictorScorer():
+    # rating prediction of a model with predict_pairs(userids, itemids), e.g. BiasBaseline,
+    # or predict_batch(pairs) (ALS, ImplicitALS)
+    name = "predictor"
+
+    def __init__(self, model, keep=None):
+        self.model = model
+        self.keep = keep
+
+    def score(self, userids, itemids):
+        users = np.repeat(np.asarray(userids), itemids.shape[1])
+        items = itemids.ravel()
+        valid = valid_ids(items)
+        scores = np.full(len(items), np.nan)
+        if hasattr(self.model, "predict_pairs"):
+            scores[valid] = self.model.predict_pairs(users[valid], items[valid])
+        else:
+            scores[valid] = self.model.predict_batch(pd.DataFrame({"userid": users[valid], "itemid": items[valid]}))
+        return scores.reshape(itemids.shape)
+
+
+class Pipeline():
+    # generator: candidate generator, scorers: list of scorers applied in order on the candidates kept by the
+    # previous one, the last scores rank the topK
+    ## args: topK=10, batch_size users per pass through the stages
+    def __init__(self, generator, scorers, topK=10, batch_size=256):
+        if not scorers:
+            raise ValueError("a pipeline needs at least one scorer")
+        self.generator = generator
+        self.scorers = list(scorers)
+        self.topK = topK
+        self.batch_size = batch_size
+
+    # best n candidates of each row by score, the earlier candidate first on ties, nan never kept
+    def select(self, itemids, scores, n):
+        n_candidates = itemids.shape[1]
+        with timer("pipeline.ranking"):
+            # topk_dense breaks ties on the larger column: reversed columns keep the earlier candidate first
+            reversed_top = topk_dense(np.where(valid_ids(itemids), scores, np.nan)[:, ::-1], n)
+        top = np.where(reversed_top >= 0, n_candidates - 1 - reversed_top, -1)
+        found = top >= 0
+        selected_ids = padded_ids(top.shape, itemids.dtype)
+        selected_scores = np.full(top.shape, np.nan)
+        safe = np.where(found, top, 0)
+        selected_ids[found] = np.take_along_axis(itemids, safe, axis=1)[found]
+        selected_scores[found] = np.take_along_axis(scores, safe, axis=1)[found]
+        return selected_ids, selected_scores
+
+    # topK items of a block of users through every stage
+    def recommend_block(self, userids):
+        with timer("pipeline.candidates." + self.generator.name):
+            itemids = self.generator.candidates(userids)
+        count("pipeline.candidates", int(valid_ids(itemids).sum()))
+        for position, scorer in enumerate(self.scorers):
+            with timer("pipeline.score." + scorer.name):
+                scores = scorer.score(userids, itemids)
+            last = position == len(self.scorers) - 1
+            n = self.topK if last else (scorer.keep or itemids.shape[1])
+            itemids, scores = self.select(itemids, scores, n)
+        # Output: itemids (b, topK), scores (b, topK)
+        return itemids, scores
+
+    # topK items of many users, batch_size users at a time
+    def recommend_batch(self, userids):
+        userids = np.asarray(userids)
+        blocks = [self.recommend_block(userids[start:start + self.batch_size])
+                  for start in progress(range(0, len(userids), self.batch_size), "pipeline")]
+        count("pipeline.queries", len(userids))
+        if not blocks:
+            return padded_ids((0, self.topK), np.int64), np.full((0, self.topK), np.nan)
+        # Output: itemids (n_users, topK) padded with -1 (None for string ids), scores (n_users, topK) padded with nan
+        return np.concatenate([block[0] for block in blocks]), np.concatenate([block[1] for block in blocks])
+
+    # get recommendation for 1 user
+    def get_recommendations(self, userid):
+        itemids, scores = self.recommend_batch([userid])
+        found = ~np.isnan(scores[0])
+        # output: [(score, itemid)]
+        return list(zip(scores[0][found].tolist(), itemids[0][found].tolist()))
+
+
+if __name__ == "__main__":
+    from recscratch.memory_based import UserKNN
+    from recscratch.utils import instrumentation
+
+    ## KNNScorer reads the candidate columns only: the same ratings in a 10x larger catalog cost the same ##
+    rng = np.random.default_rng(22)
+    ratings = pd.DataFrame({"userid": rng.integers(0, 100, 5000), "itemid": rng.integers(0, 200, 5000),
+                            "rating": rng.integers(1, 6, 5000).astype(np.float64)})
+    extra_items = pd.DataFrame({"userid": 10 ** 6, "itemid": np.arange(1000, 3000), "rating": 1.0})
+    userids, candidates = np.arange(20), rng.integers(0, 200, (20, 50))
+
+    instrumentation.enable()
+    results = []
+    for catalog in (ratings, pd.concat([ratings, extra_items], ignore_index=True)):
+        instrumentation.reset_stats()
+        scores = KNNScorer(UserKNN(catalog).fit(K_number=40, sim_name='cosine')).score(userids, candidates)
+        assert scores.shape == candidates.shape
+        results.append((scores, instrumentation.get_stats()[1]["knn.aggregated_entries"]))
+    (small_scores, small_entries), (large_scores, large_entries) = results
+    assert small_entries == large_entries and np.allclose(small_scores, large_scores, equal_nan=True)
+    print("aggregated entries:", small_entries, "for", candidates.size, "candidates")
@@ -0,0 +1,256 @@
+# Serving layer of the fitted models: concurrent requests are collected over a short window
+# into one batched (vectorized) model call that runs in an executor, the results are fanned
+# back out to the awaiting callers. serve_http puts a stdlib HTTP / JSON front end on top.
+#
+#   service = RecommendationService(userKNN, topK=10, K_number=40, sim_name='cosine')
+#   await service.recommend(1)                   # [(rating, itemid)], batched with the concurrent calls
+#   serve_http(service, port=8000)               # GET /recommend?id=1, POST /recommend {"ids": [1, 2]}
+
+# library
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+# local library
+from recscratch.content_based import ContentBased
+from recscratch.memory_based import BaseKNN
+from recscratch.non_personalized import MostPop
+from recscratch.utils.instrumentation import count, logger, timer
+
+
+# Support function
+# [(score, id)] of every row of a padded (ids, scores) pair of arrays
+def ranked_lists(ids, scores, found):
+    return [list(zip(row_scores[row_found].tolist(), row_ids[row_found].tolist()))
+            for row_ids, row_scores, row_found in zip(ids, scores, found)]
+
+# batched call of a model: list of query ids -> list of results (an Exception for a failed query)
+def batch_function(model, topK=10, **params):
+    if isinstance(model, BaseKNN):
+        # UserKNN: userid -> [(rating, itemid)], ItemKNN: itemid -> [(rating, userid)]
+        K_number, sim_name = params.get("K_number", 40), params.get("sim_name", 'cosine')
+
+        def recommend(query_ids):
+            ids, scores = model.recommend_batch(query_ids, K_number, sim_name, topK)
+            return ranked_lists(ids, scores, ~np.isnan(scores))
+        return recommend, model.row_ids.dtype
+
+    if isinstance(model, MostPop):
+        # userid -> [(count, itemid)] of the top unseen items
+        def recommend(query_ids):
+            itemids, counts = model.recommend_batch(query_ids, topK, df=params.get("df"))
+            return ranked_lists(itemids, counts, counts > 0)
+        return recommend, model.seen_users.dtype
+
+    if isinstance(model, ContentBased):
+        # title -> [title], unknown titles fail alone instead of failing the batch
+        cosine_sim = params.get("cosine_sim", model.cosine_sim)
+        item2item_encoded = params.get("item2item_encoded", model.item2item_encoded)
+
+        def recommend(query_ids):
+            known = [title in item2item_encoded.index for title in query_ids]
+            results = iter(model.get_recommendations_batch(
+                [title for title, found in zip(query_ids, known) if found], cosine_sim, item2item_encoded, topK))
+            return [next(results) if found else KeyError(title) for title, found in zip(query_ids, known)]
+        return recommend, np.dtype(object)
+
+    if hasattr(model, "recommend_batch"):
+        # BiasBaseline, ALS, ImplicitALS: userid -> [(rating, itemid)]
+        def recommend(query_ids):
+            ids, scores = model.recommend_batch(query_ids, topK)
+            return ranked_lists(ids, scores, ~np.isnan(scores))
+        return recommend, model.matrix.userids.dtype
+
+    raise TypeError("no batched recommendation for {}".format(type(model).__name__))
+
+
+class MicroBatcher():
+    # Queries submitted within max_wait seconds of the first pending one (or max_batch_size of them)
+    # are passed to batch_fn in one call on the executor
+    ## batch_fn: list of queries -> list of results, an Exception result fails only its own caller
+    def __init__(self, batch_fn, max_batch_size=256, max_wait=0.002, executor=None):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.executor = executor
+        self.pending = []          # (query, future) waiting for the next flush
+        self.flush_handle = None
+        self.n_requests = 0
+        self.n_batches = 0
+
+    async def submit(self, query):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((query, future))
+        self.n_requests += 1
+        if len(self.pending) >= self.max_batch_size:
+            self.flush(loop)
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.max_wait, self.flush, loop)
+        return await future
+
+    # send the pending queries to the executor, max_batch_size at a time
+    def flush(self, loop):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        while self.pending:
+            batch, self.pending = self.pending[:self.max_batch_size], self.pending[self.max_batch_size:]
+            self.n_batches += 1
+            done = loop.run_in_executor(self.executor, self.call, [query for query, _ in batch])
+            done.add_done_callback(lambda done, batch=batch: self.fan_out(batch, done))
+
+    def call(self, queries):
+        count("serving.requests", len(queries))
+        count("serving.batches")
+        with timer("serving.batch"):
+            return self.batch_fn(queries)
+
+    @staticmethod
+    def fan_out(batch, done):
+        error = done.exception()
+        results = [error] * len(batch) if error is not None else done.result()
+        for (_, future), result in zip(batch, results):
+            if future.done():      # the caller was cancelled
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+class RecommendationService():
+    # Async facade of a fitted ContentBased, UserKNN, ItemKNN or MostPop (BiasBaseline / ALS too)
+    # model: fitted model, topK: length of the lists, params: K_number, sim_name (KNN),
+    # df (MostPop seen items), cosine_sim, item2item_encoded (ContentBased, default the loaded ones)
+    ## args: max_batch_size queries per model call, max_wait seconds of the batching window,
+    ## n_workers: threads running the model calls (1: calls are serialized on the model)
+    def __init__(self, model, topK=10, max_batch_size=256, max_wait=0.002, n_workers=1, **params):
+        self.model = model
+        batch_fn, self.id_dtype = batch_function(model, topK, **params)
+        self.executor = ThreadPoolExecutor(max_workers=n_workers)
+        self.batcher = MicroBatcher(batch_fn, max_batch_size, max_wait, self.executor)
+        self.loop = None
+
+    # recommendations of one query id
+    async def recommend(self, query_id):
+        return await self.batcher.submit(query_id)
+
+    # recommendations of many query ids, batched like concurrent calls
+    async def recommend_many(self, query_ids):
+        return await asyncio.gather(*(self.recommend(query_id) for query_id in query_ids))
+
+    # event loop on a daemon thread, for callers outside asyncio (e.g. the HTTP handler threads)
+    def start_loop(self):
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, name="recscratch-serving", daemon=True).start()
+        return self.loop
+
+    # blocking recommend from any thread
+    def recommend_sync(self, query_id, timeout=None):
+        return asyncio.run_coroutine_threadsafe(self.recommend(query_id), self.start_loop()).result(timeout)
+
+    def recommend_many_sync(self, query_ids, timeout=None):
+        return asyncio.run_coroutine_threadsafe(self.recommend_many(query_ids), self.start_loop()).result(timeout)
+
+    # query id of a request string: a number when the model ids are numbers
+    def parse_id(self, value):
+        if isinstance(value, str) and self.id_dtype.kind in 'iuf':
+            return json.loads(value)
+        return value
+
+    def stats(self):
+        n_batches = self.batcher.n_batches
+        return {"requests": self.batcher.n_requests, "batches": n_batches,
+                "mean_batch_size": self.batcher.n_requests / n_batches if n_batches else 0.0}
+
+    def close(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop = None
+        self.executor.shutdown(wait=True)
+
+
+class RecommendationHandler(BaseHTTPRequestHandler):
+    # GET /recommend?id=<id>, POST /recommend {"id": <id>} or {"ids": [<id>, ...]}, GET /stats
+    service = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/stats":
+            return self.send_json(200, self.service.stats())
+        if url.path != "/recommend":
+            return self.send_json(404, {"error": "unknown path {}".format(url.path)})
+        query = parse_qs(url.query)
+        if "id" not in query:
+            return self.send_json(400, {"error": "missing id"})
+        self.answer({"id": query["id"][0]})
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/recommend":
+            return self.send_json(404, {"error": "unknown path {}".format(self.path)})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError as error:
+            return self.send_json(400, {"error": "invalid JSON: {}".format(error)})
+        self.answer(body)
+
+    def answer(self, body):
+        try:
+            if "ids" in body:
+                ids = [self.service.parse_id(query_id) for query_id in body["ids"]]
+                return self.send_json(200, {"results": self.service.recommend_many_sync(ids)})
+            if "id" not in body:
+                return self.send_json(400, {"error": "missing id"})
+            query_id = self.service.parse_id(body["id"])
+            self.send_json(200, {"id": query_id, "recommendations": self.service.recommend_sync(query_id)})
+        except KeyError as error:
+            self.send_json(404, {"error": "unknown id {}".format(error)})
+        except ValueError as error:
+            self.send_json(400, {"error": str(error)})
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+# HTTP server of a service, one thread per connection, the model calls are batched across threads
+def make_server(service, host="127.0.0.1", port=8000):
+    handler = type("Handler", (RecommendationHandler,), {"service": service})
+    service.start_loop()
+    return ThreadingHTTPServer((host, port), handler)
+
+# blocking HTTP / JSON front end for local load testing
+def serve_http(service, host="127.0.0.1", port=8000):
+    server = make_server(service, host, port)
+    logger.info("serving %s on http://%s:%d", type(service.model).__name__, host, server.server_port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    from recscratch.memory_based import UserKNN
+    from recscratch.utils.processing import rating_processing
+
+    ## Movielens dataset ##
+    X_train, X_test = rating_processing("../data_example/Movielens/ml-latest-small", "ratings.csv", "userId", "movieId", "rating", 0.9, 22)
+
+    ## Serve UserKNN: curl "http://127.0.0.1:8000/recommend?id=1" ##
+    userKNN = UserKNN(X_train).fit(K_number=40, sim_name='cosine')
+    serve_http(RecommendationService(userKNN, topK=10, K_number=40, sim_name='cosine'))
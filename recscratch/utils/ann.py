@@ -0,0 +1,137 @@
+# Approximate nearest neighbor search on cosine similarity with an inverted file (IVF) index
+
+# library
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+# local library
+from recscratch.utils.persistence import load_arrays, save_arrays
+
+
+class IVFIndex():
+    # Items are clustered with spherical k-means into n_lists inverted lists.
+    # A query scans the n_probes lists whose centroids are the closest, then ranks
+    # the candidates of those lists with the exact cosine.
+    # n_lists=None: sqrt(n_items) lists
+    def __init__(self, n_lists=None, n_probes=8, n_iter=10, block_size=4096, seed=None):
+        self.n_lists = n_lists
+        self.n_probes = n_probes
+        self.n_iter = n_iter
+        self.block_size = block_size
+        self.seed = seed
+
+    # Support function
+    # closest centroid of every item, block by block
+    def assign(self, vectors):
+        assignment = np.empty(vectors.shape[0], dtype=np.int64)
+        for start in range(0, vectors.shape[0], self.block_size):
+            block = vectors[start:start + self.block_size]
+            assignment[start:start + self.block_size] = np.asarray(block @ self.centroids.T).argmax(axis=1)
+        return assignment
+
+    # build the inverted lists over the item vectors
+    def build(self, vectors):
+        # Input: sparse or dense matrix (n_items, dim), e.g. the tf-idf matrix
+        n_items = vectors.shape[0]
+        if n_items == 0:
+            # empty catalog: no list, every query has no candidate
+            self.vectors = sparse.csr_matrix(vectors.shape, dtype=np.float32)
+            self.centroids = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+            self.order = np.zeros(0, dtype=np.int64)
+            self.list_ptr = np.zeros(1, dtype=np.int64)
+            return self
+        self.vectors = sparse.csr_matrix(normalize(vectors), dtype=np.float32)
+        n_lists = min(self.n_lists or max(int(np.sqrt(n_items)), 1), n_items)
+        rng = np.random.default_rng(self.seed)
+
+        # spherical k-means: centroids are the normalized sums of their items
+        self.centroids = self.vectors[rng.choice(n_items, size=n_lists, replace=False)].toarray()
+        for _ in range(self.n_iter):
+            assignment = self.assign(self.vectors)
+            members = sparse.csr_matrix((np.ones(n_items, dtype=np.float32), (assignment, np.arange(n_items))),
+                                        shape=(n_lists, n_items))
+            sums = np.asarray((members @ self.vectors).todense())
+            filled = np.asarray(members.sum(axis=1)).ravel() > 0  # an empty list keeps its centroid
+            self.centroids[filled] = normalize(sums[filled])
+
+        assignment = self.assign(self.vectors)
+        self.order = np.argsort(assignment, kind="stable")                               # items grouped by list
+        self.list_ptr = np.searchsorted(assignment[self.order], np.arange(n_lists + 1))  # list l: order[ptr[l]:ptr[l+1]]
+        return self
+
+    # candidate item indexes of the lists closest to one query
+    def candidates(self, vector):
+        closeness = np.asarray(vector @ self.centroids.T).ravel()
+        n_probes = min(self.n_probes, len(closeness))
+        if n_probes == 0:
+            return np.zeros(0, dtype=np.int64)
+        lists = np.argpartition(-closeness, n_probes - 1)[:n_probes]
+        return np.concatenate([self.order[self.list_ptr[l]:self.list_ptr[l + 1]] for l in lists])
+
+    # topK approximate neighbors of one query vector
+    def query(self, vector, topK=10, exclude=None):
+        # Input: sparse or dense vector (1, dim), optional item index to leave out (the query item itself)
+        vector = sparse.csr_matrix(normalize(vector), dtype=np.float32)
+        candidates = self.candidates(vector)
+        if exclude is not None:
+            candidates = candidates[candidates != exclude]
+
+        scores = np.asarray((self.vectors[candidates] @ vector.T).todense()).ravel()
+        # score descending, then the smaller index first on ties (as top_similar and topk_per_row)
+        order = np.lexsort((candidates, -scores))[:topK]
+        # Output: item indexes, cosine scores (descending)
+        return candidates[order], scores[order]
+
+    # topK approximate neighbors of indexed items
+    def query_items(self, item_indexes, topK=10, exclude_self=True):
+        neighbors = np.full((len(item_indexes), topK), -1, dtype=np.int64)
+        scores = np.full((len(item_indexes), topK), np.nan)
+        for r, index in enumerate(item_indexes):
+            indexes, values = self.query(self.vectors[index], topK, index if exclude_self else None)
+            neighbors[r, :len(indexes)] = indexes
+            scores[r, :len(values)] = values
+        # Output: (n, topK) item indexes padded with -1, (n, topK) scores padded with nan
+        return neighbors, scores
+
+    def save(self, folder):
+        arrays = {
+            "centroids": self.centroids, "order": self.order, "list_ptr": self.list_ptr,
+            "vectors_data": self.vectors.data, "vectors_indices": self.vectors.indices,
+            "vectors_indptr": self.vectors.indptr,
+        }
+        meta = {"model": type(self).__name__, "n_lists": self.n_lists, "n_probes": self.n_probes,
+                "n_iter": self.n_iter, "block_size": self.block_size, "seed": self.seed,
+                "shape": list(self.vectors.shape)}
+        return save_arrays(folder, arrays, meta)
+
+    @classmethod
+    def load(cls, folder, mmap=True):
+        arrays, meta = load_arrays(folder, mmap)
+        index = cls(meta["n_lists"], meta["n_probes"], meta["n_iter"], meta["block_size"], meta["seed"])
+        index.centroids = arrays["centroids"]
+        index.order = arrays["order"]
+        index.list_ptr = arrays["list_ptr"]
+        index.vectors = sparse.csr_matrix((arrays["vectors_data"], arrays["vectors_indices"], arrays["vectors_indptr"]),
+                                          shape=tuple(meta["shape"]))
+        return index
+
+
+# recall@K of the index against the exact cosine top-K, on a sample of indexed items
+def ann_recall(index, topK=10, n_queries=200, seed=None):
+    rng = np.random.default_rng(seed)
+    n_items = index.vectors.shape[0]
+    queries = rng.choice(n_items, size=min(n_queries, n_items), replace=False)
+
+    exact = (index.vectors[queries] @ index.vectors.T).toarray()
+    exact[np.arange(len(queries)), queries] = -np.inf  # no self neighbor
+    approximate, _ = index.query_items(queries, topK)
+
+    hits, n_relevant = 0, 0
+    for r in range(len(queries)):
+        relevant = np.argpartition(-exact[r], topK - 1)[:topK]
+        relevant = relevant[exact[r, relevant] > 0]  # items sharing no term are not neighbors
+        hits += len(np.intersect1d(approximate[r], relevant))
+        n_relevant += len(relevant)
+    # Output: float in [0, 1]
+    return hits / n_relevant if n_relevant else 1.0
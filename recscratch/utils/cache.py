@@ -0,0 +1,113 @@
+# Opt-in result cache of the get_recommendations calls: bounded LRU with an optional TTL.
+# Keys start with the model version, so a refit or an update never serves an old result.
+#
+#   userKNN.enable_cache(maxsize=10000, ttl=300)
+#   userKNN.get_recommendations(1, 40, 'cosine', topK=10)   # computed
+#   userKNN.get_recommendations(1, 40, 'cosine', topK=10)   # dictionary lookup
+#   userKNN.cache_stats()                                   # {"hits": 1, "misses": 1, ...}
+
+# library
+import threading
+import time
+from collections import OrderedDict
+
+# local library
+from recscratch.utils.instrumentation import count
+
+
+class ResultCache():
+    # maxsize: entries kept, the least recently used is evicted first
+    # ttl: seconds an entry is served after it is stored, None: no expiry
+    def __init__(self, maxsize=1024, ttl=None, clock=time.monotonic):
+        if maxsize < 1:
+            raise ValueError("maxsize must be >= 1, got {!r}".format(maxsize))
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()   # key -> (value, expiry time or None)
+        self.lock = threading.Lock()   # serving threads share the cache
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    # (True, value) of a live entry, (False, None) otherwise
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expiry = entry
+                if expiry is None or expiry > self.clock():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    count("cache.hits")
+                    return True, value
+                del self.entries[key]
+                self.expirations += 1
+            self.misses += 1
+            count("cache.misses")
+            return False, None
+
+    def put(self, key, value):
+        expiry = None if self.ttl is None else self.clock() + self.ttl
+        with self.lock:
+            self.entries[key] = (value, expiry)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    # cached value of key, compute() is called (outside the lock) on a miss
+    def get_or_compute(self, key, compute):
+        found, value = self.lookup(key)
+        if not found:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        n_lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "expirations": self.expirations, "size": len(self.entries), "maxsize": self.maxsize,
+                "hit_rate": self.hits / n_lookups if n_lookups else 0.0}
+
+
+class CachedModel():
+    # Mixin of the models with a result cache: version counts the refits / updates,
+    # cache is None until enable_cache()
+    version = 0
+    cache = None
+
+    def enable_cache(self, maxsize=1024, ttl=None):
+        self.cache = ResultCache(maxsize, ttl)
+        return self
+
+    def disable_cache(self):
+        self.cache = None
+        return self
+
+    def cache_stats(self):
+        # Output: dict of the cache counters, None when the cache is disabled
+        return None if self.cache is None else self.cache.stats()
+
+    # a refit or an update: the cached results are dropped (their keys are outdated anyway)
+    def bump_version(self):
+        self.version += 1
+        if self.cache is not None:
+            self.cache.clear()
+
+    # result of compute() cached under (version, *key) when the cache is enabled
+    def cached(self, key, compute):
+        if self.cache is None:
+            return compute()
+        return self.cache.get_or_compute((self.version,) + tuple(key), compute)
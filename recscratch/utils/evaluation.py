@@ -1,4 +1,6 @@
 import numpy as np
+import pandas as pd
+from scipy import sparse
 
 def mean_reciprocal_rank(rs):
     rs = (np.atleast_1d(np.asarray(r)).nonzero()[0] for r in rs)
@@ -7,7 +9,7 @@ def mean_reciprocal_rank(rs):
     return rs
 
 def dcg_at_k(r, k):
-    r = np.asfarray(r)[:k]
+    r = np.asarray(r, dtype=np.float64)[:k]
     if r.size:
         return r[0] + np.sum(r[1:] / np.log2(np.arange(2, r.size + 1)))
     return 0
@@ -18,6 +20,113 @@ def ndcg_at_k(r, k):
         return 0
     return dcg_at_k(r, k) / dcg_max
 
+
+# Batched evaluation: a (n_users, K) matrix of recommended item indexes against a
+# sparse (n_users, n_items) ground truth, every metric in one vectorized pass
+
+# ground truth of the users of df: rows follow userids, columns follow item_index
+## threshold: only ratings >= threshold are relevant, graded=True keeps the rating as nDCG gain (1 otherwise)
+def truth_matrix(df, userids, item_index=None, threshold=None, graded=False):
+    if threshold is not None:
+        df = df[df["rating"] >= threshold]
+    if item_index is None:
+        item_index = pd.Index(pd.unique(df["itemid"]))
+    users = pd.Index(userids).get_indexer(df["userid"])
+    items = item_index.get_indexer(df["itemid"])
+    keep = (users >= 0) & (items >= 0)
+    gains = df["rating"].to_numpy(dtype=np.float64)[keep] if graded else np.ones(np.count_nonzero(keep))
+    truth = sparse.csr_matrix((gains, (users[keep], items[keep])), shape=(len(userids), len(item_index)))
+    truth.sum_duplicates()
+    # Output: sparse matrix (n_users, n_items), item id -> column index
+    return truth, item_index
+
+# recommended item ids -> column indexes of item_index, -1 for padding and items outside the index
+def encode_recommendations(itemids, item_index):
+    itemids = np.asarray(itemids)
+    # Output: (n_users, K) column indexes
+    return item_index.get_indexer(itemids.ravel()).reshape(itemids.shape)
+
+# gain of every recommended entry, 0 when the item is not in the ground truth of the user
+def gains_matrix(recommended, truth):
+    truth = sparse.csr_matrix(truth)
+    if not truth.has_sorted_indices:
+        truth = truth.sorted_indices()   # a sorted copy: the caller's matrix is left as it is
+    if truth.nnz == 0:
+        return np.zeros(recommended.shape)
+    n_users, n_items = truth.shape
+    # csr entries are sorted on (row, col): the flat keys row * n_items + col are sorted too
+    truth_keys = np.repeat(np.arange(n_users, dtype=np.int64), np.diff(truth.indptr)) * n_items + truth.indices
+    keys = np.arange(n_users, dtype=np.int64)[:, None] * n_items + recommended
+    pos = np.minimum(np.searchsorted(truth_keys, keys), truth.nnz - 1)
+    found = (recommended >= 0) & (truth_keys[pos] == keys)
+    # Output: (n_users, K) gains
+    return np.where(found, truth.data[pos], 0.0)
+
+# sum of the K largest gains of every row: the DCG of the best possible ranking
+def ideal_dcg(truth, K):
+    truth = sparse.csr_matrix(truth)
+    rows = np.repeat(np.arange(truth.shape[0]), np.diff(truth.indptr))
+    order = np.lexsort((-truth.data, rows))
+    rank = np.arange(len(order)) - truth.indptr[rows[order]]   # position of the gain inside its row
+    top = rank < K
+    discount = 1 / np.log2(rank[top] + 2)
+    return np.bincount(rows[order][top], truth.data[order][top] * discount, minlength=truth.shape[0])
+
+# precision@K, recall@K, MAP@K, nDCG@K, MRR, hit rate and catalog coverage
+## users without any relevant item are left out of the means, per_user=True also returns every user's values
+def ranking_metrics(recommended, truth, K=None, per_user=False, n_items=None):
+    # Input: (n_users, K) item column indexes padded with -1, sparse ground truth (n_users, n_items)
+    recommended = np.asarray(recommended)[:, :K]
+    K = recommended.shape[1]
+    truth = sparse.csr_matrix(truth)
+    gains = gains_matrix(recommended, truth)
+    relevant = gains > 0
+    n_relevant = np.diff(truth.indptr)
+    n_hits = relevant.sum(axis=1)
+
+    positions = np.arange(1, K + 1)
+    discount = 1 / np.log2(positions + 1)
+    first_hit = np.where(relevant.any(axis=1), relevant.argmax(axis=1) + 1, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision_at = np.cumsum(relevant, axis=1) / positions
+        users = {
+            "precision": n_hits / K if K else np.zeros(len(n_hits)),
+            "recall": n_hits / n_relevant,
+            "map": (precision_at * relevant).sum(axis=1) / np.minimum(n_relevant, K),
+            "ndcg": (gains * discount).sum(axis=1) / ideal_dcg(truth, K),
+            "mrr": np.where(first_hit > 0, 1 / np.maximum(first_hit, 1), 0.0),
+            "hit_rate": (n_hits > 0).astype(np.float64),
+        }
+
+    evaluated = n_relevant > 0
+    metrics = {name: float(values[evaluated].mean()) if evaluated.any() else 0.0 for name, values in users.items()}
+    n_items = truth.shape[1] if n_items is None else n_items
+    metrics["coverage"] = len(np.unique(recommended[recommended >= 0])) / n_items if n_items else 0.0
+    metrics["n_users"] = int(evaluated.sum())
+    # Output: {metric: mean}, and {metric: (n_users,) values, nan for a user without relevant item}
+    if per_user:
+        return metrics, {name: np.where(evaluated, values, np.nan) for name, values in users.items()}
+    return metrics
+
+# RMSE and MAE of rating predictions
+def rating_metrics(y_true, y_pred):
+    error = np.asarray(y_pred, dtype=np.float64) - np.asarray(y_true, dtype=np.float64)
+    if error.size == 0:
+        return {"rmse": 0.0, "mae": 0.0}
+    return {"rmse": float(np.sqrt(np.mean(error ** 2))), "mae": float(np.mean(np.abs(error)))}
+
+# evaluate the recommended item ids of userids (padded with -1 or None) on the test dataframe
+## n_items: catalog size of the coverage, default the number of distinct test and recommended items
+def evaluate_recommendations(itemids, userids, test, K=None, threshold=None, graded=False, per_user=False, n_items=None):
+    itemids = np.asarray(itemids)[:, :K]
+    valid = pd.notna(itemids) & (itemids != -1) if itemids.dtype.kind in 'iuf' else pd.notna(itemids)
+    # recommended items outside the test set are columns too: they count in the coverage, never as hits
+    item_index = pd.Index(pd.unique(np.concatenate([test["itemid"].to_numpy(), itemids[valid]])))
+    truth, _ = truth_matrix(test, userids, item_index, threshold, graded)
+    recommended = np.where(valid, encode_recommendations(itemids, item_index), -1)
+    # Output: same as ranking_metrics
+    return ranking_metrics(recommended, truth, K, per_user, n_items)
+
 if __name__ == "__main__":
    ## Test function ##
     y_true = [0., 1., 2.]
@@ -32,4 +141,3 @@ if __name__ == "__main__":
     print ("MRR", mean_reciprocal_rank(relevance))
     print ("DCG@10", dcg_at_k(relevance, 10))
     print ("nDCG@10", ndcg_at_k(relevance, 10))
-
@@ -0,0 +1,93 @@
+# Logging, opt-in progress reporting and stage timers / counters of the library.
+# Everything is off by default: a disabled timer is a shared no-op context manager,
+# so the hot paths pay one function call and one branch.
+#
+#   import logging
+#   from recscratch.utils import instrumentation
+#   logging.basicConfig(level=logging.INFO)                 # messages of the "recscratch" logger
+#   instrumentation.enable()                                # timers and counters
+#   instrumentation.add_hook(lambda stage, seconds: ...)    # export every timed stage (e.g. to a metrics client)
+#   instrumentation.get_stats()                             # {stage: {"count": n, "total_s": s}}
+
+# library
+import logging
+import time
+from contextlib import nullcontext
+
+logger = logging.getLogger("recscratch")
+logger.addHandler(logging.NullHandler())
+
+enabled = False
+progress_enabled = False
+hooks = []
+stats = {}
+counters = {}
+NO_TIMER = nullcontext()
+
+
+# Support function
+def enable(timers=True, progress=False):
+    global enabled, progress_enabled
+    enabled = timers
+    progress_enabled = progress
+
+def disable():
+    enable(False, False)
+
+# hook(stage, seconds) is called after every timed stage while timers are enabled
+def add_hook(hook):
+    hooks.append(hook)
+
+def remove_hook(hook):
+    hooks.remove(hook)
+
+def get_stats():
+    # Output: {stage: {"count": n, "total_s": seconds}}, {counter: value}
+    return {stage: dict(values) for stage, values in stats.items()}, dict(counters)
+
+def reset_stats():
+    stats.clear()
+    counters.clear()
+
+def record(stage, seconds):
+    values = stats.setdefault(stage, {"count": 0, "total_s": 0.0})
+    values["count"] += 1
+    values["total_s"] += seconds
+    for hook in hooks:
+        hook(stage, seconds)
+
+
+class StageTimer():
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+# with timer("neighbor_search"): ... times the block when timers are enabled
+def timer(stage):
+    if not enabled:
+        return NO_TIMER
+    return StageTimer(stage)
+
+# add n to a counter when timers are enabled
+def count(name, n=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + n
+
+# iterable wrapped in a tqdm progress bar when progress is enabled (and tqdm installed)
+def progress(iterable, desc=None, total=None):
+    if not progress_enabled:
+        return iterable
+    try:
+        from tqdm import tqdm
+    except ImportError:
+        logger.info("%s...", desc or "processing")
+        return iterable
+    return tqdm(iterable, desc=desc, total=total)
@@ -0,0 +1,57 @@
+# Process pool scoring of fitted models: the model state is written once per model version to
+# memory-mapped .npy files that every worker maps, only the shards are sent per task
+
+# library
+import os
+import shutil
+import tempfile
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+
+# local library
+from recscratch.utils.persistence import load_arrays, save_arrays
+
+# model rebuilt from the memory-mapped state, one per worker process
+worker_model = None
+
+
+# Support function
+def init_worker(model_class, folder):
+    global worker_model
+    arrays, meta = load_arrays(folder, mmap=True)
+    worker_model = model_class.from_state(arrays, meta)
+
+def call_worker(method_name, args):
+    return getattr(worker_model, method_name)(*args)
+
+# n_jobs=-1 uses every core
+def get_n_jobs(n_jobs):
+    if n_jobs is None or n_jobs == 0:
+        return 1
+    if n_jobs < 0:
+        return max((os.cpu_count() or 1) + 1 + n_jobs, 1)
+    return n_jobs
+
+# folder of the memory-mapped state of a model (CachedModel), written again only when its version changes:
+# repeated calls on the same fit do not re-serialize the matrix and the neighbor table
+## the folder is removed with the next version, when the model is collected or at exit
+def shared_state(model):
+    version = model.version
+    state = getattr(model, "shared_state_folder", None)
+    if state is not None and state[0] == version:
+        return state[1]
+    if state is not None:
+        state[2]()                      # remove the outdated state now
+    folder = tempfile.mkdtemp(prefix="recscratch-")
+    arrays, meta = model.get_state()
+    save_arrays(folder, arrays, meta)
+    model.shared_state_folder = (version, folder, weakref.finalize(model, shutil.rmtree, folder, True))
+    return folder
+
+# call model.method_name(*args) for every args of shards_args on a process pool
+def map_shards(model, method_name, shards_args, n_jobs):
+    folder = shared_state(model)
+    with ProcessPoolExecutor(max_workers=get_n_jobs(n_jobs), initializer=init_worker,
+                             initargs=(type(model), folder)) as executor:
+        # Output: list of results, in the order of shards_args
+        return list(executor.map(call_worker, [method_name] * len(shards_args), shards_args))
@@ -0,0 +1,86 @@
+# Array artifacts on disk: one .npy file per array plus a json manifest
+
+# library
+import json
+import os
+import numpy as np
+from scipy import sparse
+
+MANIFEST_FILE = "manifest.json"
+
+
+# Support function
+# .npy files cannot hold python objects without pickle: string ids are stored as fixed-width unicode
+def to_storable(array):
+    array = np.asarray(array)
+    if array.dtype == object:
+        return array.astype(str)
+    return array
+
+# id array of a loaded folder: fixed-width unicode back to the object dtype it was saved from,
+# so the padding of the string id outputs stays None (a unicode array would hold the string 'None')
+def ids_from_storable(array):
+    if array.dtype.kind == 'U':
+        return np.asarray(array, dtype=object)
+    return array
+
+def save_arrays(folder, arrays, meta=None):
+    # Input: folder path, {name: np.ndarray}, json-serializable dict
+    os.makedirs(folder, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(folder, name + ".npy"), to_storable(array), allow_pickle=False)
+    return write_manifest(folder, arrays, meta)
+
+def write_manifest(folder, names, meta=None):
+    manifest = {"arrays": sorted(names), "meta": meta or {}}
+    with open(os.path.join(folder, MANIFEST_FILE), "w") as file:
+        json.dump(manifest, file, indent=2)
+    return folder
+
+# writable memory-mapped .npy file of folder, filled in place by out-of-core computations
+def open_array(folder, name, shape, dtype, fill=None):
+    os.makedirs(folder, exist_ok=True)
+    array = np.lib.format.open_memmap(os.path.join(folder, name + ".npy"), mode="w+", dtype=dtype, shape=shape)
+    if fill is not None:
+        array[:] = fill
+    return array
+
+def load_arrays(folder, mmap=True):
+    # Input: folder written by save_arrays, mmap=True maps the arrays read-only instead of reading them
+    with open(os.path.join(folder, MANIFEST_FILE)) as file:
+        manifest = json.load(file)
+    mmap_mode = "r" if mmap else None
+    arrays = {name: np.load(os.path.join(folder, name + ".npy"), mmap_mode=mmap_mode, allow_pickle=False)
+              for name in manifest["arrays"]}
+    # Output: {name: np.ndarray}, meta dict
+    return arrays, manifest["meta"]
+
+# sparse csr matrix as the name_data / name_indices / name_indptr arrays
+def sparse_arrays(name, matrix):
+    matrix = sparse.csr_matrix(matrix)
+    return {name + "_data": matrix.data, name + "_indices": matrix.indices, name + "_indptr": matrix.indptr}
+
+def sparse_from_arrays(arrays, name, shape):
+    return sparse.csr_matrix((arrays[name + "_data"], arrays[name + "_indices"], arrays[name + "_indptr"]),
+                             shape=tuple(shape))
+
+# a folder of one model class cannot be loaded as another
+def check_model(meta, cls):
+    if meta.get("model") != cls.__name__:
+        raise ValueError("artifact holds a {!r} model, not {!r}".format(meta.get("model"), cls.__name__))
+
+
+if __name__ == "__main__":
+    import tempfile
+    import pandas as pd
+    from recscratch.memory_based import UserKNN
+
+    ## Save / load round trip with string ids: the padding of the loaded model stays None ##
+    ratings = pd.DataFrame({"userid": ["a", "a", "b", "b", "b", "c"], "itemid": ["x", "y", "x", "y", "z", "z"],
+                            "rating": [5.0, 3.0, 4.0, 2.0, 1.0, 5.0]})
+    folder = UserKNN(ratings).fit(K_number=5, sim_name='cosine').save(tempfile.mkdtemp(prefix="recscratch-"))
+    loaded = UserKNN.load(folder)
+    itemids, scores = loaded.recommend_batch(["a"], 5, 'cosine', topK=3)
+    assert loaded.matrix.userids.dtype == object and loaded.matrix.itemids.dtype == object
+    assert itemids[0, 0] == 'z' and all(itemid is None for itemid in itemids[0, 1:]), itemids
+    print(itemids, scores)
@@ -1,20 +1,166 @@
 # library
 import argparse
+import os
+import numpy as np
 import pandas as pd
 from sklearn.model_selection import train_test_split
 
-def content_processing(link_folder, content_file, list_content_col = []):
-    content_items = pd.read_csv(link_folder+'/'+content_file)
+# local library
+from recscratch.utils.persistence import load_arrays, save_arrays
+
+CACHE_FOLDER = ".recscratch_cache"
+
+def content_processing(link_folder, content_file, list_content_col = [], chunksize = None):
+    # chunksize: read the file in dataframes of chunksize rows (generator) instead of one dataframe
+    if chunksize:
+        return content_processing_chunks(link_folder, content_file, list_content_col, chunksize)
+    usecols = list_content_col if list_content_col != [] else None
+    content_items = pd.read_csv(link_folder+'/'+content_file, usecols=usecols)
     content_items = content_items.fillna('')
     if list_content_col != []:
         content_items = content_items[list_content_col]
     return content_items
 
+def content_processing_chunks(link_folder, content_file, list_content_col, chunksize):
+    usecols = list_content_col if list_content_col != [] else None
+    for content_items in pd.read_csv(link_folder+'/'+content_file, chunksize=chunksize, usecols=usecols):
+        content_items = content_items.fillna('')
+        if list_content_col != []:
+            content_items = content_items[list_content_col]
+        yield content_items
+
+
+# Support function
+# int32 for integer ids that fit, categorical for string ids
+def compact_ids(col):
+    if pd.api.types.is_integer_dtype(col):
+        info = np.iinfo(np.int32)
+        if len(col) == 0 or (col.min() >= info.min and col.max() <= info.max):
+            return col.astype(np.int32)
+        return col
+    if pd.api.types.is_string_dtype(col) or pd.api.types.is_object_dtype(col):
+        return col.astype("category")
+    return col
+
+# uint8 for integer ratings in [0, 255] (Book), float32 otherwise (Movielens half stars)
+def compact_ratings(col):
+    values = col.to_numpy(dtype=np.float64)
+    if len(values) and np.all(values == np.round(values)) and values.min() >= 0 and values.max() <= 255:
+        return col.astype(np.uint8)
+    return col.astype(np.float32)
+
+def compact_frame(ratings):
+    compacted = pd.DataFrame({"userid": compact_ids(ratings["userid"]),
+                              "itemid": compact_ids(ratings["itemid"]),
+                              "rating": compact_ratings(ratings["rating"])})
+    if "timestamp" in ratings:
+        compacted["timestamp"] = ratings["timestamp"].to_numpy()
+    return compacted
+
+# categorical chunks can have different categories: concat on the union of the categories
+def concat_chunks(chunks):
+    if not chunks:
+        return pd.DataFrame({"userid": [], "itemid": [], "rating": []})
+    columns = {}
+    for name in ["userid", "itemid"]:
+        parts = [chunk[name] for chunk in chunks]
+        if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            columns[name] = pd.Series(pd.api.types.union_categoricals([part.array for part in parts], sort_categories=True))
+        else:
+            columns[name] = compact_ids(pd.concat(parts, ignore_index=True))
+    ratings = pd.concat([chunk["rating"] for chunk in chunks], ignore_index=True)
+    ratings = pd.DataFrame({"userid": columns["userid"], "itemid": columns["itemid"], "rating": compact_ratings(ratings)})
+    if "timestamp" in chunks[0]:
+        ratings["timestamp"] = np.concatenate([chunk["timestamp"].to_numpy() for chunk in chunks])
+    return ratings
+
+# (userids, itemids) of a pairs dataframe or array
+def split_pairs(pairs):
+    if hasattr(pairs, 'columns'):
+        return pairs['userid'].to_numpy(), pairs['itemid'].to_numpy()
+    pairs = np.asarray(pairs)
+    return pairs[:, 0], pairs[:, 1]
+
+# renamed columns of the rating file, the time column (when given) is kept as timestamp
+def rating_columns(user_col, item_col, rating_col, time_col=None):
+    names = {user_col: "userid", item_col: "itemid", rating_col: "rating"}
+    if time_col is not None:
+        names[time_col] = "timestamp"
+    return names, list(names)
+
+# rating dataframes (userid, itemid, rating) of chunksize rows, e.g. for write_rating_matrix
+def iter_ratings(path, user_col, item_col, rating_col, chunksize, time_col=None):
+    names, usecols = rating_columns(user_col, item_col, rating_col, time_col)
+    for chunk in pd.read_csv(path, usecols=usecols, chunksize=chunksize):
+        yield chunk[usecols].rename(columns=names)
+
+# read the three rating columns (and the time column), chunksize rows at a time when given:
+# only one raw chunk is in memory
+def read_ratings(path, user_col, item_col, rating_col, compact, chunksize, time_col=None):
+    names, usecols = rating_columns(user_col, item_col, rating_col, time_col)
+    if not chunksize:
+        ratings = pd.read_csv(path, usecols=usecols)[usecols].rename(columns=names)
+        return compact_frame(ratings) if compact else ratings
+
+    chunks = []
+    for chunk in iter_ratings(path, user_col, item_col, rating_col, chunksize, time_col):
+        chunks.append(compact_frame(chunk) if compact else chunk)
+    if compact:
+        return concat_chunks(chunks)
+    return pd.concat(chunks, ignore_index=True)
+
+# columns as .npy arrays, a categorical column as its codes plus its categories
+def save_rating_cache(folder, ratings, meta):
+    arrays = {}
+    for name in ratings.columns:
+        col = ratings[name]
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            arrays[name + "_codes"] = col.cat.codes.to_numpy()
+            arrays[name + "_categories"] = col.cat.categories.to_numpy(dtype=object)
+        else:
+            arrays[name] = col.to_numpy()
+    save_arrays(folder, arrays, meta)
+
+def load_rating_cache(folder):
+    arrays, meta = load_arrays(folder, mmap=False)
+    columns = {}
+    for name in ["userid", "itemid", "rating", "timestamp"]:
+        if name in arrays:
+            columns[name] = arrays[name]
+        elif name + "_codes" in arrays:
+            categories = pd.Index(arrays[name + "_categories"].astype(object))
+            columns[name] = pd.Categorical.from_codes(arrays[name + "_codes"], categories)
+    return pd.DataFrame(columns), meta
+
+# ratings of the .npy cache when it was written from the same file (size and mtime) and the same options
+def cached_ratings(path, user_col, item_col, rating_col, compact, chunksize, time_col=None):
+    stat = os.stat(path)
+    columns = [user_col, item_col, rating_col] + ([time_col] if time_col is not None else [])
+    key = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "columns": columns, "compact": compact}
+    folder = os.path.join(os.path.dirname(path), CACHE_FOLDER, os.path.basename(path))
+    try:
+        ratings, meta = load_rating_cache(folder)
+        if meta == key:
+            return ratings
+    except (OSError, ValueError, KeyError):
+        pass
+    ratings = read_ratings(path, user_col, item_col, rating_col, compact, chunksize, time_col)
+    save_rating_cache(folder, ratings, key)
+    return ratings
+
 
-def rating_processing(link_folder, rating_file, user_col, item_col, rating_col, split_size = None, seed = None):
-    ratings = pd.read_csv(link_folder+"/"+rating_file)
-    ratings = ratings[[user_col, item_col, rating_col]]
-    ratings = ratings.rename(columns={user_col: "userid", item_col: "itemid", rating_col: "rating"})
+## compact=True (opt-in): int32 / categorical ids and uint8 / float32 ratings instead of the int64 / object / float64
+## columns of the csv, compact=False returns the columns as pandas reads them
+## chunksize: parse the csv chunksize rows at a time (files larger than memory)
+## cache=True: keep the parsed columns as .npy files next to the csv, re-parsed only when the csv changes
+## time_col: also keep this column as timestamp (e.g. for splitting.leave_last_n_split)
+def rating_processing(link_folder, rating_file, user_col, item_col, rating_col, split_size = None, seed = None,
+                      compact = False, chunksize = None, cache = False, time_col = None):
+    path = link_folder+"/"+rating_file
+    if cache:
+        ratings = cached_ratings(path, user_col, item_col, rating_col, compact, chunksize, time_col)
+    else:
+        ratings = read_ratings(path, user_col, item_col, rating_col, compact, chunksize, time_col)
     
     if split_size:
         return train_test_split(ratings, train_size=split_size, random_state=seed)
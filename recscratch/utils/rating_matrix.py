@@ -0,0 +1,214 @@
+# Indexed sparse user x item rating matrix shared by the models
+
+# library
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# local library
+from recscratch.utils.persistence import ids_from_storable, open_array, save_arrays, write_manifest
+
+
+class RatingMatrix():
+    # ratings: ratings dataframe with userid, itemid, rating columns
+    def __init__(self, ratings):
+        # keep the first rating of a duplicated user-item pair (same as a dataframe lookup)
+        ratings = ratings.drop_duplicates(subset=["userid", "itemid"], keep="first")
+
+        # dense id <-> index encoders
+        user_index, userids = pd.factorize(ratings["userid"], sort=True)
+        item_index, itemids = pd.factorize(ratings["itemid"], sort=True)
+        self.userids = np.asarray(userids)      # index -> userid
+        self.itemids = np.asarray(itemids)      # index -> itemid
+        self.user_encoder = pd.Index(userids)   # userid -> index
+        self.item_encoder = pd.Index(itemids)   # itemid -> index
+
+        # CSR for user rows, CSC for item columns
+        shape = (len(self.userids), len(self.itemids))
+        values = ratings["rating"].to_numpy(dtype=np.float64)
+        self.csr = sparse.csr_matrix((values, (user_index, item_index)), shape=shape)
+        self.csr.sort_indices()
+        self.csc = self.csr.tocsc()
+        self.csc.sort_indices()
+
+    # arrays of the matrix, the encoders are rebuilt from the id arrays
+    def get_state(self):
+        return {
+            "userids": self.userids, "itemids": self.itemids,
+            "csr_data": self.csr.data, "csr_indices": self.csr.indices, "csr_indptr": self.csr.indptr,
+            "csc_data": self.csc.data, "csc_indices": self.csc.indices, "csc_indptr": self.csc.indptr,
+        }
+
+    # matrix on the arrays of get_state (memory-mapped arrays are used in place)
+    @classmethod
+    def from_state(cls, arrays):
+        matrix = cls.__new__(cls)
+        matrix.userids = ids_from_storable(arrays["userids"])
+        matrix.itemids = ids_from_storable(arrays["itemids"])
+        matrix.user_encoder = pd.Index(matrix.userids)
+        matrix.item_encoder = pd.Index(matrix.itemids)
+        shape = (len(matrix.userids), len(matrix.itemids))
+        matrix.csr = sparse.csr_matrix((arrays["csr_data"], arrays["csr_indices"], arrays["csr_indptr"]), shape=shape)
+        matrix.csc = sparse.csc_matrix((arrays["csc_data"], arrays["csc_indices"], arrays["csc_indptr"]), shape=shape)
+        return matrix
+
+    # matrix of (user index, item index, rating) triples on the given id arrays
+    @classmethod
+    def from_coo(cls, userids, itemids, users, items, values):
+        matrix = cls.__new__(cls)
+        matrix.userids, matrix.itemids = np.asarray(userids), np.asarray(itemids)
+        matrix.user_encoder = pd.Index(matrix.userids)
+        matrix.item_encoder = pd.Index(matrix.itemids)
+        shape = (len(matrix.userids), len(matrix.itemids))
+        matrix.csr = sparse.csr_matrix((np.asarray(values, dtype=np.float64), (users, items)), shape=shape)
+        matrix.csr.sort_indices()
+        matrix.csc = matrix.csr.tocsc()
+        matrix.csc.sort_indices()
+        return matrix
+
+    # new matrix with the ratings of add (the last rating of a pair wins, over the current one too)
+    # and without the (userid, itemid) pairs of remove. Ids are never dropped, new ids take their
+    # place in the sorted id order.
+    def updated(self, add=None, remove=None):
+        userids, itemids = self.user_encoder, self.item_encoder
+        if add is not None:
+            add = add.drop_duplicates(subset=["userid", "itemid"], keep="last")
+            userids = userids.union(pd.Index(pd.unique(add["userid"])))
+            itemids = itemids.union(pd.Index(pd.unique(add["itemid"])))
+        # old index -> new index
+        user_map = userids.get_indexer(self.userids)
+        item_map = itemids.get_indexer(self.itemids)
+
+        users = user_map[np.repeat(np.arange(self.n_users), np.diff(self.csr.indptr))]
+        items = item_map[self.csr.indices]
+        values = self.csr.data
+        n_items = len(itemids)
+
+        # pairs replaced by add or deleted by remove
+        dropped = [frame for frame in (add, remove) if frame is not None]
+        if dropped:
+            drop_users = userids.get_indexer(pd.concat([frame["userid"] for frame in dropped]))
+            drop_items = itemids.get_indexer(pd.concat([frame["itemid"] for frame in dropped]))
+            known = (drop_users >= 0) & (drop_items >= 0)
+            drop_keys = drop_users[known].astype(np.int64) * n_items + drop_items[known]
+            keep = ~np.isin(users.astype(np.int64) * n_items + items, drop_keys)
+            users, items, values = users[keep], items[keep], values[keep]
+        if add is not None:
+            users = np.concatenate([users, userids.get_indexer(add["userid"])])
+            items = np.concatenate([items, itemids.get_indexer(add["itemid"])])
+            values = np.concatenate([values, add["rating"].to_numpy(dtype=np.float64)])
+
+        matrix = RatingMatrix.from_coo(np.asarray(userids), np.asarray(itemids), users, items, values)
+        # Output: new matrix, old user index -> new, old item index -> new
+        return matrix, user_map, item_map
+
+    @property
+    def n_users(self):
+        return self.csr.shape[0]
+
+    @property
+    def n_items(self):
+        return self.csr.shape[1]
+
+    # Support function
+    # ids -> dense indexes, -1 for unknown ids
+    def encode_users(self, userids):
+        return self.user_encoder.get_indexer(np.atleast_1d(userids))
+
+    def encode_items(self, itemids):
+        return self.item_encoder.get_indexer(np.atleast_1d(itemids))
+
+    def encode_user(self, userid):
+        return int(self.encode_users([userid])[0])
+
+    def encode_item(self, itemid):
+        return int(self.encode_items([itemid])[0])
+
+    # rated items (indexes, ratings) of one user index
+    def user_row(self, user_index):
+        start, end = self.csr.indptr[user_index], self.csr.indptr[user_index + 1]
+        return self.csr.indices[start:end], self.csr.data[start:end]
+
+    # rating users (indexes, ratings) of one item index
+    def item_column(self, item_index):
+        start, end = self.csc.indptr[item_index], self.csc.indptr[item_index + 1]
+        return self.csc.indices[start:end], self.csc.data[start:end]
+
+    # item x user view of the ratings in CSR layout (no copy)
+    def item_user(self):
+        return self.csc.T
+
+    # get rating from the user-item pair
+    def get_rating(self, userid, itemid):
+        user_index, item_index = self.encode_user(userid), self.encode_item(itemid)
+        if user_index < 0 or item_index < 0:
+            return None
+        items, values = self.user_row(user_index)
+        pos = np.searchsorted(items, item_index)
+        if pos < len(items) and items[pos] == item_index:
+            return values[pos]
+        return None
+
+
+# Support function
+# write the (row, index, value) triples of a block at the next free slots of their rows
+def scatter(indices, data, cursor, rows, cols, values):
+    order = np.argsort(rows, kind='stable')
+    rows, cols, values = rows[order], cols[order], values[order]
+    n_per_row = np.bincount(rows, minlength=len(cursor))
+    rank = np.arange(len(rows)) - (np.cumsum(n_per_row) - n_per_row)[rows]
+    positions = cursor[rows] + rank
+    indices[positions] = cols
+    data[positions] = values
+    cursor += n_per_row
+
+# rating matrix too large for memory, written to folder in the layout of RatingMatrix.get_state:
+# load it memory-mapped with RatingMatrix.from_state(load_arrays(folder)[0]) or BaseKNN.load_matrix(folder)
+## chunks: function returning a fresh iterable of rating dataframes (userid, itemid, rating), it is read twice,
+## e.g. lambda: read_ratings(path, ..., chunksize=10 ** 6). A (userid, itemid) pair must appear once.
+## memory_budget: bytes of the blocks of the sort and transpose passes
+def write_rating_matrix(folder, chunks, memory_budget=2 ** 30):
+    # pass 1: sorted ids and the ratings count of every id
+    user_counts, item_counts = pd.Series(dtype=np.int64), pd.Series(dtype=np.int64)
+    for chunk in chunks():
+        user_counts = user_counts.add(chunk["userid"].value_counts(), fill_value=0)
+        item_counts = item_counts.add(chunk["itemid"].value_counts(), fill_value=0)
+    user_counts, item_counts = user_counts.sort_index(), item_counts.sort_index()
+    user_encoder, item_encoder = pd.Index(user_counts.index), pd.Index(item_counts.index)
+    n_users, n_items = len(user_encoder), len(item_encoder)
+    csr_indptr = np.concatenate([[0], np.cumsum(user_counts.to_numpy(dtype=np.int64))])
+    csc_indptr = np.concatenate([[0], np.cumsum(item_counts.to_numpy(dtype=np.int64))])
+    nnz = int(csr_indptr[-1])
+
+    # pass 2: ratings scattered to their user rows
+    csr_indices = open_array(folder, "csr_indices", (nnz,), np.int32)
+    csr_data = open_array(folder, "csr_data", (nnz,), np.float64)
+    cursor = csr_indptr[:-1].copy()
+    for chunk in chunks():
+        scatter(csr_indices, csr_data, cursor, user_encoder.get_indexer(chunk["userid"]),
+                item_encoder.get_indexer(chunk["itemid"]), chunk["rating"].to_numpy(dtype=np.float64))
+
+    # item order inside every row, then the transpose: rows are streamed in order so the columns come out sorted
+    csc_indices = open_array(folder, "csc_indices", (nnz,), np.int32)
+    csc_data = open_array(folder, "csc_data", (nnz,), np.float64)
+    cursor = csc_indptr[:-1].copy()
+    block_nnz = max(int(memory_budget) // 64, 1)
+    start = 0
+    while start < n_users:
+        end = int(np.searchsorted(csr_indptr, csr_indptr[start] + block_nnz, side='right')) - 1
+        end = min(max(end, start + 1), n_users)
+        low, high = csr_indptr[start], csr_indptr[end]
+        rows = np.repeat(np.arange(start, end), np.diff(csr_indptr[start:end + 1]))
+        cols, values = np.asarray(csr_indices[low:high]), np.asarray(csr_data[low:high])
+        order = np.lexsort((cols, rows))
+        cols, values = cols[order], values[order]
+        csr_indices[low:high], csr_data[low:high] = cols, values
+        scatter(csc_indices, csc_data, cursor, cols, rows, values)
+        start = end
+
+    save_arrays(folder, {"userids": user_encoder.to_numpy(), "itemids": item_encoder.to_numpy(),
+                         "csr_indptr": csr_indptr, "csc_indptr": csc_indptr})
+    for array in (csr_indices, csr_data, csc_indices, csc_data):
+        array.flush()
+    names = ["userids", "itemids", "csr_data", "csr_indices", "csr_indptr", "csc_data", "csc_indices", "csc_indptr"]
+    return write_manifest(folder, names, {"model": None})
@@ -0,0 +1,260 @@
+# Vectorized similarity on sparse rating rows and top-K neighbor selection
+
+# library
+import numpy as np
+from scipy import sparse
+
+# local library
+from recscratch.utils.instrumentation import progress
+from recscratch.utils.persistence import open_array, write_manifest
+
+SIMILARITY_NAMES = ('cosine', 'pearson')
+
+
+# Support function
+# same sparsity structure with every stored value set to 1
+def indicator(matrix):
+    matrix = sparse.csr_matrix(matrix, copy=True)
+    matrix.data = np.ones_like(matrix.data)
+    return matrix
+
+def squared(matrix):
+    matrix = sparse.csr_matrix(matrix, copy=True)
+    matrix.data = matrix.data ** 2
+    return matrix
+
+def check_similarity_name(similarity_name):
+    if similarity_name not in SIMILARITY_NAMES:
+        raise ValueError("similarity_name must be 'cosine' or 'pearson', got {!r}".format(similarity_name))
+
+# values of a sparse product on the flat (row * n_cols + col) positions of a pattern
+def sample(product, positions):
+    return product.toarray().ravel().take(positions)
+
+
+class CoratedSimilarity():
+    # Pearson / cosine restricted to the co-rated entries of every pair of rows,
+    # computed with sparse products on a block of rows at a time.
+    # rows: sparse matrix (n_rows, n_cols), a row is a user (UserKNN) or an item (ItemKNN)
+    def __init__(self, rows):
+        rows = sparse.csr_matrix(rows)
+        self.n_rows = rows.shape[0]
+        # transposed (n_cols, n_rows) operands, built once for all blocks
+        self.values_T = rows.T.tocsr()
+        self.indicator_T = indicator(self.values_T)
+        self.squared_T = squared(self.values_T)
+
+    # similarity of a block of rows with all rows
+    def block(self, block, similarity_name):
+        # Input: sparse matrix (b, n_cols)
+        check_similarity_name(similarity_name)
+        block = sparse.csr_matrix(block)
+        block_indicator = indicator(block)
+
+        # co-rated pairs: the pattern every other product is read on
+        count = block_indicator @ self.indicator_T
+        cols = count.indices
+        positions = np.repeat(np.arange(count.shape[0]) * count.shape[1], np.diff(count.indptr)) + cols
+
+        product = sample(block @ self.values_T, positions)                    # sum r_a * r_x
+        block_square = sample(squared(block) @ self.indicator_T, positions)   # sum r_a^2 on co-rated
+        other_square = sample(block_indicator @ self.squared_T, positions)    # sum r_x^2 on co-rated
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if similarity_name == 'cosine':
+                numerator = product
+                denominator = np.sqrt(block_square * other_square)
+            else:
+                n = count.data
+                block_sum = sample(block @ self.indicator_T, positions)            # sum r_a on co-rated
+                other_sum = sample(block_indicator @ self.values_T, positions)     # sum r_x on co-rated
+                numerator = product - block_sum * other_sum / n
+                block_var = block_square - block_sum ** 2 / n
+                other_var = other_square - other_sum ** 2 / n
+                # constant co-rated ratings have zero variance, drop float round-off
+                block_var[block_var <= 1e-10 * block_square] = 0
+                other_var[other_var <= 1e-10 * other_square] = 0
+                denominator = np.sqrt(block_var * other_var)
+            similarity = numerator / denominator
+
+        # zero denominator scores 0; round-off is cut so equal scores tie on the id order
+        similarity[~np.isfinite(similarity) | (denominator == 0)] = 0
+        similarity = np.round(similarity, 12)
+
+        # Output: sparse matrix (b, n_rows) stored on the co-rated pairs, missing pairs score 0
+        return sparse.csr_matrix((similarity, cols, count.indptr), shape=count.shape)
+
+
+# K best columns of each sparse row, ordered by (score, column) descending like sorting (score, id) tuples.
+# Missing entries score 0. Zero scores are dropped after the selection: they do not weigh in an aggregation,
+# but they still rank above negative scores.
+def topk_per_row(scores, K, exclude=None):
+    # Input: sparse matrix (b, n), optional column to exclude per row (b,)
+    scores = sparse.csr_matrix(scores)
+    b, n = scores.shape
+    neighbors = np.full((b, K), -1, dtype=np.int32)
+    neighbor_scores = np.zeros((b, K), dtype=np.float64)
+
+    for r in range(b):
+        start, end = scores.indptr[r], scores.indptr[r + 1]
+        cols, values = scores.indices[start:end], scores.data[start:end]
+        n_candidates = n
+        if exclude is not None:
+            keep = cols != exclude[r]
+            cols, values = cols[keep], values[keep]
+            n_candidates -= 1
+
+        nonzero = values != 0
+        cols, values = cols[nonzero], values[nonzero]
+        n_zero = n_candidates - len(cols)
+        n_positive = np.count_nonzero(values > 0)
+        n_negative = min(max(K - n_positive - n_zero, 0), len(cols) - n_positive)
+        if n_positive > K:
+            # only the K best positives (and their ties) need an exact ordering
+            kth = np.partition(values, len(values) - K)[len(values) - K]
+            keep = values >= kth
+            cols, values = cols[keep], values[keep]
+            n_positive = len(values)
+
+        order = np.lexsort((cols, values))[::-1]
+        order = np.concatenate([order[:min(n_positive, K)], order[n_positive:n_positive + n_negative]])
+        neighbors[r, :len(order)] = cols[order]
+        neighbor_scores[r, :len(order)] = values[order]
+
+    # Output: (b, K) column indexes padded with -1, (b, K) scores padded with 0
+    return neighbors, neighbor_scores
+
+
+# K best columns of each dense row ordered by (score, column) descending, nan / -inf entries are never picked
+def topk_dense(scores, K):
+    # Input: dense array (b, n)
+    b, n = scores.shape
+    top = np.full((b, K), -1, dtype=np.int64)
+    K_part = min(K, n)
+    if K_part == 0:
+        return top
+
+    scores = np.where(np.isnan(scores), -np.inf, scores)
+    part = np.argpartition(scores, n - K_part, axis=1)[:, n - K_part:]
+    kth = np.take_along_axis(scores, part, axis=1).min(axis=1)
+    for r in range(b):
+        row = scores[r]
+        candidates = np.flatnonzero((row >= kth[r]) & (row > -np.inf))
+        order = np.lexsort((candidates, row[candidates]))[::-1][:K]
+        top[r, :len(order)] = candidates[order]
+
+    # Output: (b, K) column indexes padded with -1
+    return top
+
+
+# top-K neighbor table of every row, computed block by block
+def neighbor_table(rows, K, similarity_name, block_size=256, similarity=None):
+    # Input: sparse matrix (n_rows, n_cols), optional CoratedSimilarity already built on it
+    rows = sparse.csr_matrix(rows)
+    n_rows = rows.shape[0]
+    if similarity is None:
+        similarity = CoratedSimilarity(rows)
+
+    neighbors = np.full((n_rows, K), -1, dtype=np.int32)
+    neighbor_scores = np.zeros((n_rows, K), dtype=np.float64)
+    for start in progress(range(0, n_rows, block_size), "neighbor table"):
+        end = min(start + block_size, n_rows)
+        scores = similarity.block(rows[start:end], similarity_name)
+        neighbors[start:end], neighbor_scores[start:end] = topk_per_row(scores, K, exclude=np.arange(start, end))
+
+    # Output: (n_rows, K) row indexes padded with -1, (n_rows, K) scores padded with 0
+    return neighbors, neighbor_scores
+
+
+# Out-of-core neighbor table: the rows are read one block at a time (e.g. from memory-mapped arrays),
+# the similarities are computed one (row block, candidate block) pair at a time and the running top-K
+# lists of every row are merged in memory-mapped .npy files
+
+# K best nonzero entries of each sparse row by (score, column) descending
+def topk_nonzero(scores, K, exclude=None, offset=0):
+    # Input: sparse matrix (b, n), optional global index to exclude per row (b,), global index of column 0
+    scores = sparse.csr_matrix(scores)
+    b = scores.shape[0]
+    rows = np.repeat(np.arange(b), np.diff(scores.indptr))
+    cols = scores.indices.astype(np.int64) + offset
+    values = scores.data
+    keep = values != 0
+    if exclude is not None:
+        keep &= cols != exclude[rows]
+    rows, cols, values = rows[keep], cols[keep], values[keep]
+
+    order = np.lexsort((-cols, -values, rows))
+    rows, cols, values = rows[order], cols[order], values[order]
+    n_nonzero = np.bincount(rows, minlength=b)
+    rank = np.arange(len(rows)) - (np.cumsum(n_nonzero) - n_nonzero)[rows]
+    top = rank < K
+    neighbors = np.full((b, K), -1, dtype=np.int64)
+    neighbor_scores = np.full((b, K), -np.inf)
+    neighbors[rows[top], rank[top]] = cols[top]
+    neighbor_scores[rows[top], rank[top]] = values[top]
+    # Output: (b, K) columns padded with -1, (b, K) scores padded with -inf, (b,) nonzero entries per row
+    return neighbors, neighbor_scores, n_nonzero
+
+# K best of two (b, K) candidate lists by (score, column) descending
+def merge_topk(neighbors1, scores1, neighbors2, scores2, K):
+    neighbors = np.concatenate([neighbors1, neighbors2], axis=1)
+    scores = np.concatenate([scores1, scores2], axis=1)
+    order = np.lexsort((-neighbors, -scores), axis=1)[:, :K]
+    return np.take_along_axis(neighbors, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+# the selection rule of topk_per_row on the merged nonzero candidates: positives first, then
+# negatives only while the zero scores (missing pairs) do not fill the K slots
+def finalize_topk(neighbors, scores, n_nonzero, n_candidates):
+    K = neighbors.shape[1]
+    n_positive = np.count_nonzero(scores > 0, axis=1)
+    n_negative = np.count_nonzero((scores < 0) & np.isfinite(scores), axis=1)
+    n_zero = n_candidates - n_nonzero
+    n_keep = n_positive + np.minimum(np.maximum(K - n_positive - n_zero, 0), n_negative)
+    keep = np.arange(K)[None, :] < n_keep[:, None]
+    return np.where(keep, neighbors, -1).astype(np.int32), np.where(keep, scores, 0.0)
+
+# block sizes of a memory budget: candidate blocks hold the transposed operands of CoratedSimilarity
+# (3 copies of their ratings), row blocks the dense (rows x candidates) products of a block pair
+def candidate_blocks(indptr, memory_budget):
+    max_nnz = max(memory_budget // (4 * 36), 1)
+    bounds = [0]
+    n_rows = len(indptr) - 1
+    while bounds[-1] < n_rows:
+        end = int(np.searchsorted(indptr, indptr[bounds[-1]] + max_nnz, side='right')) - 1
+        bounds.append(min(max(end, bounds[-1] + 1), n_rows))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+# top-K neighbor table computed under a memory budget, written to folder as neighbors.npy / neighbor_scores.npy
+## memory_budget: bytes of the block working set, the table itself lives on disk
+def neighbor_table_out_of_core(rows, K, similarity_name, folder, memory_budget=2 ** 30):
+    # Input: sparse csr matrix (n_rows, n_cols), possibly on memory-mapped arrays
+    check_similarity_name(similarity_name)
+    memory_budget = int(memory_budget)      # block sizes are row counts
+    n_rows = rows.shape[0]
+    indptr = np.asarray(rows.indptr)
+    neighbors = open_array(folder, "neighbors", (n_rows, K), np.int32, fill=-1)
+    neighbor_scores = open_array(folder, "neighbor_scores", (n_rows, K), np.float64, fill=-np.inf)
+    n_nonzero = np.zeros(n_rows, dtype=np.int64)
+
+    for cand_start, cand_end in progress(candidate_blocks(indptr, memory_budget), "neighbor table blocks"):
+        similarity = CoratedSimilarity(rows[cand_start:cand_end])
+        block_size = max(memory_budget // (2 * 64 * (cand_end - cand_start)), 1)
+        for start in range(0, n_rows, block_size):
+            end = min(start + block_size, n_rows)
+            scores = similarity.block(rows[start:end], similarity_name)
+            block_neighbors, block_scores, block_nonzero = topk_nonzero(scores, K, np.arange(start, end), cand_start)
+            merged = merge_topk(np.asarray(neighbors[start:end], dtype=np.int64), neighbor_scores[start:end],
+                                block_neighbors, block_scores, K)
+            neighbors[start:end], neighbor_scores[start:end] = merged
+            n_nonzero[start:end] += block_nonzero
+
+    block_size = max(memory_budget // (64 * max(K, 1)), 1)
+    for start in range(0, n_rows, block_size):
+        end = min(start + block_size, n_rows)
+        neighbors[start:end], neighbor_scores[start:end] = finalize_topk(
+            np.asarray(neighbors[start:end], dtype=np.int64), neighbor_scores[start:end], n_nonzero[start:end], n_rows - 1)
+    neighbors.flush()
+    neighbor_scores.flush()
+    write_manifest(folder, ["neighbors", "neighbor_scores"], {"K": K, "similarity_name": similarity_name})
+    # Output: (n_rows, K) row indexes padded with -1, (n_rows, K) scores padded with 0, memory-mapped
+    return neighbors, neighbor_scores
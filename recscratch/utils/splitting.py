@@ -0,0 +1,152 @@
+# Train / test splits and negative samples on encoded arrays: the rows are grouped by user with one
+# sort instead of a groupby, every split is a boolean test mask (or a fold id) aligned with the rows,
+# so it can be computed on memory-mapped columns and applied to any array of the same length.
+#
+#   train, test = leave_last_n_split(ratings, n=1)        # ratings read with time_col="timestamp"
+#   train, test = ratio_split(ratings, test_size=0.2, seed=22)
+#   for train, test in kfold_split(ratings, n_folds=5, seed=22): ...
+#   negatives = negative_samples(RatingMatrix(ratings), userids, n_negatives=100, seed=22)
+
+# library
+import numpy as np
+import pandas as pd
+
+# local library
+from recscratch.utils.instrumentation import timer
+
+
+# Support function
+# dense codes 0..n_users-1 of a user column (categorical, integer or string ids)
+def user_codes(userids):
+    if isinstance(userids, pd.Series) and isinstance(userids.dtype, pd.CategoricalDtype):
+        return userids.cat.codes.to_numpy(dtype=np.int64)
+    return pd.factorize(np.asarray(userids))[0].astype(np.int64)
+
+# sort keys of the rows inside their user: the timestamps, or a random order
+def order_keys(n_rows, timestamps=None, seed=None):
+    if timestamps is not None:
+        return np.asarray(timestamps)
+    return np.random.default_rng(seed).random(n_rows)
+
+# position of every row inside its user when the rows of a user are sorted on keys, and the size of its user
+def rank_in_user(users, keys):
+    users = np.asarray(users)
+    order = np.lexsort((keys, users))            # stable: equal timestamps keep the row order
+    sorted_users = users[order]
+    starts = np.flatnonzero(np.r_[True, sorted_users[1:] != sorted_users[:-1]]) if len(order) else np.zeros(0, int)
+    sizes = np.diff(np.r_[starts, len(order)])
+    rank = np.empty(len(order), dtype=np.int64)
+    size = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order)) - np.repeat(starts, sizes)
+    size[order] = np.repeat(sizes, sizes)
+    # Output: (n_rows,) rank, (n_rows,) number of rows of the user
+    return rank, size
+
+
+# test mask of the last n rows of every user (by timestamp, random order without timestamps)
+## users with n rows or less stay in train
+def leave_last_n(users, timestamps=None, n=1, seed=None):
+    # Input: (n_rows,) user codes, (n_rows,) timestamps
+    with timer("split.leave_last_n"):
+        rank, size = rank_in_user(users, order_keys(len(users), timestamps, seed))
+        # Output: (n_rows,) boolean, True for the test rows
+        return (rank >= size - n) & (size > n)
+
+# test mask of floor(test_size * n_rows) rows of every user: random rows, the latest ones with timestamps
+def per_user_ratio(users, test_size=0.2, seed=None, timestamps=None):
+    if not 0 <= test_size < 1:
+        raise ValueError("test_size must be in [0, 1), got {!r}".format(test_size))
+    with timer("split.per_user_ratio"):
+        rank, size = rank_in_user(users, order_keys(len(users), timestamps, seed))
+        n_test = np.floor(size * test_size).astype(np.int64)
+        return rank >= size - n_test
+
+# fold id of every row: the rows of a user are dealt round-robin over the folds in a random order,
+# from a random first fold, so every fold holds 1/n_folds of each user (+-1 row)
+def kfold(users, n_folds=5, seed=None):
+    if n_folds < 2:
+        raise ValueError("n_folds must be >= 2, got {!r}".format(n_folds))
+    rng = np.random.default_rng(seed)
+    users = np.asarray(users)
+    with timer("split.kfold"):
+        rank, _ = rank_in_user(users, rng.random(len(users)))
+        offset = rng.integers(0, n_folds, users.max() + 1 if len(users) else 0)
+        # Output: (n_rows,) fold ids in [0, n_folds)
+        return (rank + offset[users]) % n_folds
+
+
+# dataframe splits of the ratings (userid, itemid, rating[, timestamp])
+def leave_last_n_split(ratings, n=1, time_col="timestamp", seed=None):
+    timestamps = ratings[time_col].to_numpy() if time_col is not None else None
+    test = leave_last_n(user_codes(ratings["userid"]), timestamps, n, seed)
+    # Output: train, test dataframes
+    return ratings[~test], ratings[test]
+
+def ratio_split(ratings, test_size=0.2, seed=None, time_col=None):
+    timestamps = ratings[time_col].to_numpy() if time_col is not None else None
+    test = per_user_ratio(user_codes(ratings["userid"]), test_size, seed, timestamps)
+    return ratings[~test], ratings[test]
+
+# (train, test) of every fold
+def kfold_split(ratings, n_folds=5, seed=None):
+    folds = kfold(user_codes(ratings["userid"]), n_folds, seed)
+    for fold in range(n_folds):
+        test = folds == fold
+        yield ratings[~test], ratings[test]
+
+
+# Support function
+# n_negatives unseen item indexes of every user index, uniform with replacement, -1 when every item is seen
+## the k-th unseen item of a user is k + #{j: s_j - j <= k} over its sorted seen items s_j: no rejection loop
+def sample_unseen(csr, users, n_negatives, rng):
+    # Input: csr (n_users, n_items) of the seen items, (b,) user indexes
+    rows = csr[users]
+    rows.sort_indices()
+    n_items = rows.shape[1]
+    n_seen = np.diff(rows.indptr)
+    n_unseen = n_items - n_seen
+    rank = np.floor(rng.random((len(users), n_negatives)) * np.maximum(n_unseen, 1)[:, None]).astype(np.int64)
+
+    # s_j - j is non-decreasing in a row: with the row offset it is one sorted array of flat keys
+    row_of = np.repeat(np.arange(len(users), dtype=np.int64), n_seen)
+    shifted = rows.indices - (np.arange(rows.nnz) - rows.indptr[row_of])
+    keys = row_of * (n_items + 1) + shifted
+    queries = np.arange(len(users), dtype=np.int64)[:, None] * (n_items + 1) + rank
+    below = np.searchsorted(keys, queries, side='right') - rows.indptr[:-1, None]
+    # Output: (b, n_negatives) item indexes
+    return np.where(n_unseen[:, None] > 0, rank + below, -1)
+
+# item ids of n_negatives unseen items of every userid, batch_size users at a time
+## matrix: RatingMatrix of every known interaction (train and test) so a positive is never drawn as negative
+def negative_samples(matrix, userids, n_negatives=100, seed=None, batch_size=4096):
+    rng = np.random.default_rng(seed)
+    users = matrix.encode_users(userids)
+    items = np.full((len(users), n_negatives), -1, dtype=np.int64)
+    known = np.flatnonzero(users >= 0)
+    with timer("split.negative_samples"):
+        for start in range(0, len(known), batch_size):
+            batch = known[start:start + batch_size]
+            items[batch] = sample_unseen(matrix.csr, users[batch], n_negatives, rng)
+    itemids = np.empty(items.shape, dtype=matrix.itemids.dtype)
+    itemids[:] = -1 if itemids.dtype.kind in 'iuf' else None
+    found = items >= 0
+    itemids[found] = matrix.itemids[items[found]]
+    # Output: (n_users, n_negatives) item ids padded with -1 (None for string ids), unknown users are padded
+    return itemids
+
+
+if __name__ == "__main__":
+    from recscratch.utils.processing import rating_processing
+    from recscratch.utils.rating_matrix import RatingMatrix
+
+    ## Movielens dataset ##
+    ratings = rating_processing("../data_example/Movielens/ml-latest-small", "ratings.csv", "userId", "movieId", "rating",
+                                time_col="timestamp")
+
+    ## Test function ##
+    X_train, X_test = leave_last_n_split(ratings, n=1)
+    print(len(X_train), len(X_test))
+    for X_train, X_test in kfold_split(ratings, n_folds=5, seed=22):
+        print(len(X_train), len(X_test))
+    userids = X_test["userid"].unique()
+    print(negative_samples(RatingMatrix(ratings), userids[:3], n_negatives=10, seed=22))
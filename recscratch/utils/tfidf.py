@@ -0,0 +1,127 @@
+# Streaming tf-idf: document frequencies accumulated chunk by chunk, new documents
+# transformed without re-vectorizing the catalog
+
+# library
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer
+from sklearn.preprocessing import normalize
+
+
+class StreamingTfidf():
+    # Same weighting as TfidfVectorizer (smooth idf, l2 norm, same analyzer).
+    # n_features=None: growing vocabulary (term -> column in order of appearance),
+    # n_features=int: hashing trick on n_features columns, nothing to keep per term.
+    def __init__(self, stop_words='english', n_features=None):
+        self.stop_words = stop_words
+        self.n_features = n_features
+        if n_features is None:
+            self.analyzer = CountVectorizer(stop_words=stop_words).build_analyzer()
+            self.hasher = None
+        else:
+            self.analyzer = None
+            self.hasher = HashingVectorizer(stop_words=stop_words, n_features=n_features,
+                                            alternate_sign=False, norm=None)
+        self.vocabulary = {}
+        self.document_frequency = np.zeros(n_features or 0, dtype=np.int64)
+        self.n_documents = 0
+
+    # vocabulary (terms in column order) and document frequencies
+    def get_state(self):
+        terms = np.empty(len(self.vocabulary), dtype=object)
+        terms[list(self.vocabulary.values())] = list(self.vocabulary.keys())
+        arrays = {"terms": terms, "document_frequency": self.document_frequency}
+        meta = {"stop_words": self.stop_words, "n_features": self.n_features, "n_documents": self.n_documents}
+        return arrays, meta
+
+    @classmethod
+    def from_state(cls, arrays, meta):
+        vectorizer = cls(meta["stop_words"], meta["n_features"])
+        vectorizer.vocabulary = {term: index for index, term in enumerate(arrays["terms"].tolist())}
+        vectorizer.document_frequency = np.array(arrays["document_frequency"])  # grows on partial_fit
+        vectorizer.n_documents = meta["n_documents"]
+        return vectorizer
+
+    # Support function
+    @property
+    def n_columns(self):
+        return self.n_features or len(self.vocabulary)
+
+    # term counts of documents, grow=True adds unseen terms to the vocabulary
+    def count(self, documents, grow):
+        if self.hasher is not None:
+            return sparse.csr_matrix(self.hasher.transform(documents))
+
+        vocabulary = self.vocabulary
+        indices, indptr = [], [0]
+        for document in documents:
+            for term in self.analyzer(document):
+                index = vocabulary.get(term)
+                if index is None:
+                    if not grow:
+                        continue
+                    index = vocabulary[term] = len(vocabulary)
+                indices.append(index)
+            indptr.append(len(indices))
+        counts = sparse.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(indptr) - 1, len(vocabulary)))
+        counts.sum_duplicates()
+        # Output: sparse matrix (n_documents, n_columns)
+        return counts
+
+    def update_frequency(self, counts):
+        frequency = np.bincount(counts.indices, minlength=self.n_columns)
+        frequency[:len(self.document_frequency)] += self.document_frequency
+        self.document_frequency = frequency
+        self.n_documents += counts.shape[0]
+
+    # counts weighted by the current idf, l2-normalized rows
+    def weight(self, counts):
+        counts = sparse.csr_matrix(counts, dtype=np.float64)
+        counts.resize(counts.shape[0], self.n_columns)
+        return normalize(counts @ sparse.diags(self.idf()))
+
+    def idf(self):
+        return np.log((1 + self.n_documents) / (1 + self.document_frequency)) + 1
+
+    # rows weighted with an older idf (idf_before) weighted with the current one instead: the l2
+    # normalization cancels the row scale, so the rows equal a transform of their documents today
+    def reweight(self, rows, idf_before):
+        rows = sparse.csr_matrix(rows, dtype=np.float64)
+        rows.resize(rows.shape[0], self.n_columns)
+        ratio = np.ones(self.n_columns)
+        ratio[:len(idf_before)] = self.idf()[:len(idf_before)] / idf_before
+        return normalize(rows @ sparse.diags(ratio))
+
+    # add a chunk of documents to the statistics (new terms, document frequencies)
+    def partial_fit(self, documents):
+        self.update_frequency(self.count(documents, grow=True))
+        return self
+
+    # tf-idf of documents with the current statistics, unseen terms are ignored
+    def transform(self, documents):
+        # Output: sparse matrix (n_documents, n_columns)
+        return self.weight(self.count(documents, grow=False))
+
+    # fit on a stream of document chunks in one pass, then weight every chunk with the final idf
+    def fit_transform_stream(self, chunks):
+        # Input: iterable of lists of documents, e.g. chunks of content_processing(..., chunksize=...)
+        chunk_counts = []
+        for documents in chunks:
+            counts = self.count(documents, grow=True)
+            self.update_frequency(counts)
+            chunk_counts.append(counts)
+        if not chunk_counts:
+            return sparse.csr_matrix((0, self.n_columns))
+        for counts in chunk_counts:
+            counts.resize(counts.shape[0], self.n_columns)
+        # Output: sparse matrix (n_documents, n_columns), equal to TfidfVectorizer up to the column order
+        return self.weight(sparse.vstack(chunk_counts, format='csr'))
+
+
+# rows of new documents appended under a catalog matrix, the narrower one padded with empty columns
+def append_rows(matrix, new_rows):
+    n_columns = max(matrix.shape[1], new_rows.shape[1])
+    matrix, new_rows = sparse.csr_matrix(matrix), sparse.csr_matrix(new_rows)
+    matrix.resize(matrix.shape[0], n_columns)
+    new_rows.resize(new_rows.shape[0], n_columns)
+    return sparse.vstack([matrix, new_rows], format='csr')